@@ -1,15 +1,139 @@
-from . import engine, scene
+from . import engine, scene, batch
+from .batch import generate_diagrams_batch, BatchResult, JobFailed
+from .forkserver import ForkServer
+from .limits import ResourceLimits
+from .asyncpool import AsyncDiagramPool, PoolSaturated
+from .resultcache import ResultCache
 
-def generate_diagrams_for_code(code: str, flags: [int], scene_format='json', **settings) -> dict:
-    py_engine = engine.PythonEngine()
+import time
+
+
+def generate_diagrams_for_code(code: str, flags: [int], scene_format='json', result_cache: ResultCache = None, **settings) -> dict:
+    if result_cache == None or not ResultCache.is_cacheable(code):
+        return _generate_diagrams(code, flags, scene_format, settings)[0]
+
+    cache_key = ResultCache.make_key(code, flags, scene_format, settings)
+    diagrams = result_cache.get(cache_key)
+
+    if diagrams == None:
+        diagrams, ran_out_of_time = _generate_diagrams(code, flags, scene_format, settings)
+
+        # where max_capture_time cut a snapshot off depends on how fast this particular run was
+        if not ran_out_of_time:
+            result_cache.put(cache_key, diagrams)
+
+    return diagrams
+
+
+def _generate_diagrams(code: str, flags: [int], scene_format: str, settings: dict) -> ([dict], bool):
+    # returns the diagrams and whether any of them was cut off by max_capture_time
+    py_engine = engine.PythonEngine(engine.PyEngineSettings.from_dict(settings))
     py_engine.run(code, flags)
 
-    diagram_data = []
+    scene_settings = scene.PySceneSettings.from_dict(settings)
+    bare_language_data = py_engine.get_bare_language_data()
+    output_buffers = py_engine.get_output_buffers()
+    reader = engine.SnapshotReader(bare_language_data, output_buffers)
+    diagrams = []
+
+    for index, snapshot_data in enumerate(bare_language_data):
+        if 'unchanged' in snapshot_data:
+            diagrams.append(_reuse_diagram(diagrams[snapshot_data['unchanged']], engine.resolve_output(snapshot_data, output_buffers)))
+        else:
+            diagrams.append(_export_snapshot(reader[index], scene_format, scene_settings))
+
+    return (diagrams, py_engine.ran_out_of_capture_time())
+
+
+def iter_diagrams_for_code(code: str, flags: [int], scene_format='json', limits: ResourceLimits = None, **settings) -> 'iterator of dict':
+    '''Yield the same diagrams as generate_diagrams_for_code, each one as soon as its flag fires
+
+    The program runs in a child process in lockstep with the iterator: it's paused while a diagram is being consumed,
+    and only resumes when the next one is asked for, so only one snapshot is held at a time. Its output never mixes with
+    the caller's, and closing the iterator early kills it. With limits, the wall time limit only counts time spent
+    waiting on the program (not time it spends paused), so it's enforced from here along with the deadline for a program
+    that ignores its other limits. A run that doesn't finish raises JobFailed after its last diagram'''
+
+    child_limits = ResourceLimits(max_cpu_time=limits.max_cpu_time, max_memory=limits.max_memory) if limits != None else None
+    time_limit = (limits.max_wall_time if limits.max_wall_time != None else limits.get_kill_time()) if limits != None else None
+    waited = 0.0 # time spent waiting on the program, in seconds
+
+    context = batch.create_job_context()
+    conn, child_conn = context.Pipe()
+    process = context.Process(target=batch.stream_batch_job, args=(child_conn, code, flags, scene_format, settings, child_limits), daemon=True)
+    process.start()
+    child_conn.close()
+
+    try:
+        while True:
+            start = time.perf_counter()
+            is_ready = conn.poll(max(time_limit - waited, 0) if time_limit != None else None)
+            waited += time.perf_counter() - start
+
+            if not is_ready:
+                limit = limits.get_kill_limit()
+                raise JobFailed(f'{engine.ResourceLimitExceeded.__name__}: {limits.get_message(limit)}', limit)
+
+            try:
+                message = conn.recv()
+            except EOFError:
+                process.join()
+                raise JobFailed(*batch.describe_exit(process.exitcode, child_limits))
+
+            if message[0] == 'diagram':
+                yield message[1]
+                conn.send('next')
+            elif message[0] == 'failed':
+                raise JobFailed(message[1], message[2])
+            else:
+                break
+    finally:
+        if process.is_alive():
+            process.kill()
+
+        process.join()
+        conn.close()
+
+
+def _stream_diagrams(code: str, flags: [int], scene_format: str, settings: dict, diagram_callback: 'callable(dict)') -> None:
+    # run the program on this thread, handing over each diagram as soon as its snapshot is final
+    py_engine = engine.PythonEngine(engine.PyEngineSettings.from_dict(settings))
+    scene_settings = scene.PySceneSettings.from_dict(settings)
+
+    # an unchanged record always points to the last snapshot that came through whole
+    last_full_diagram = None
+
+    def export_snapshot(snapshot_data: dict):
+        nonlocal last_full_diagram
+
+        if 'unchanged' in snapshot_data:
+            diagram = _reuse_diagram(last_full_diagram, snapshot_data)
+        else:
+            diagram = _export_snapshot(snapshot_data, scene_format, scene_settings)
+            last_full_diagram = diagram
+
+        # the engine is still holding on to the snapshot, so its bld is emptied out instead of just dropped
+        snapshot_data.clear()
+        diagram_callback(diagram)
+
+    py_engine.run(code, flags, snapshot_callback=export_snapshot)
+
+
+def _reuse_diagram(diagram: dict, unchanged_data: dict) -> dict:
+    # the scenes are the same as the diagram the record points to, so they're shared rather than built again
+    return dict(diagram, output=unchanged_data['output'], error=unchanged_data['error'])
+
+
+def _export_snapshot(snapshot_data: dict, scene_format: str, scene_settings: scene.PySceneSettings) -> dict:
+    aliases = snapshot_data['aliases'] if 'aliases' in snapshot_data else {}
+    globals_data = engine.resolve_scene_bld(snapshot_data['objects'], snapshot_data['scenes']['globals'])
 
-    for snapshot_data in py_engine.get_bare_language_data():
-        globals_data, locals_data = (snapshot_data['scenes']['globals'], snapshot_data['scenes']['locals'])
-        snapshot = scene.PySnapshot(globals_data, locals_data, snapshot_data['output'], snapshot_data['error'], scene.PySceneSettings.from_dict(settings))
+    # an aliased scene is handed over as the very same bld, which PySnapshot builds only once
+    if aliases.get('locals') == 'globals':
+        locals_data = globals_data
+    else:
+        locals_data = engine.resolve_scene_bld(snapshot_data['objects'], snapshot_data['scenes']['locals'])
 
-        diagram_data.append(snapshot.export(scene_format=scene_format))
+    snapshot = scene.PySnapshot(globals_data, locals_data, snapshot_data['output'], snapshot_data['error'], scene_settings)
 
-    return diagram_data
+    return snapshot.export(scene_format=scene_format)
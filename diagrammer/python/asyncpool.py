@@ -0,0 +1,198 @@
+from .batch import BatchResult, JobFailed, create_job_context, describe_exit, run_batch_job, stream_batch_job
+from .engine import ResourceLimitExceeded
+from .limits import ResourceLimits
+
+import asyncio, os, time
+
+
+class PoolSaturated(Exception):
+    pass
+
+
+def run_async_job(conn: 'multiprocessing connection', code: str, flags: [int], scene_format: str, settings: dict, limits: ResourceLimits, stream: bool):
+    '''Entry point of a job process, which sends everything back over conn'''
+
+    if stream:
+        stream_batch_job(conn, code, flags, scene_format, settings, limits)
+        return
+
+    try:
+        conn.send(('result', run_batch_job(0, code, flags, scene_format, settings, limits)))
+    except (BrokenPipeError, EOFError):
+        pass # the job was cancelled, so nobody is listening anymore
+    finally:
+        conn.close()
+
+
+class AsyncDiagramPool:
+    '''asyncio front end that runs every job in its own process, at most max_workers at a time
+
+    Callers beyond max_workers wait for a free slot, and once max_waiting of them are already waiting new ones are
+    turned away with PoolSaturated. Cancelling a job (or closing its stream) kills its process outright'''
+
+    def __init__(self, max_workers: int = None, max_waiting: int = None, scene_format='json', limits: ResourceLimits = None, **settings):
+        self._max_workers = max_workers if max_workers != None else os.cpu_count()
+        self._max_waiting = max_waiting
+        self._scene_format = scene_format
+        self._limits = limits
+        self._settings = settings
+
+        self._slots = None # created on first use so it belongs to the running loop
+        self._waiting = 0
+        self._running = 0
+        self._context = create_job_context()
+
+    def get_running_count(self) -> int:
+        return self._running
+
+    def get_waiting_count(self) -> int:
+        return self._waiting
+
+    async def generate_diagrams(self, code: str, flags: [int]) -> BatchResult:
+        '''Run one job to completion, reporting failures (including limits) on the result like the batch API'''
+
+        await self._acquire_slot()
+        job = None
+
+        try:
+            job = await self._start_job(code, flags, False)
+
+            try:
+                _, result = await self._receive(job, self._limits.get_kill_time() if self._limits != None else None)
+                return result
+            except JobFailed as e:
+                return BatchResult(0, None, str(e), job.active_time, job.process.pid, e.limit_exceeded)
+        finally:
+            self._release_slot(job)
+
+    async def stream_diagrams(self, code: str, flags: [int]) -> 'async iterator of dict':
+        '''Yield diagrams as the job produces them, raising JobFailed after the last one if the job didn't finish
+
+        The job only runs ahead of the consumer by one diagram, on its process's main thread so the cpu and memory
+        limits reach it. Its wall time limit only counts time spent waiting on the job (not time the job spends paused
+        for the consumer), so it's enforced from here instead of in the job, and without one the job still gets the
+        deadline from ResourceLimits.get_kill_time in case it ignores its other limits'''
+
+        await self._acquire_slot()
+        job = None
+
+        try:
+            job = await self._start_job(code, flags, True)
+            time_limit = None
+
+            if self._limits != None:
+                time_limit = self._limits.max_wall_time if self._limits.max_wall_time != None else self._limits.get_kill_time()
+
+            while True:
+                message = await self._receive(job, time_limit)
+
+                if message[0] == 'diagram':
+                    yield message[1]
+                    job.conn.send('next')
+                elif message[0] == 'failed':
+                    raise JobFailed(message[1], message[2])
+                else:
+                    break
+        finally:
+            self._release_slot(job)
+
+    async def _acquire_slot(self):
+        if self._slots == None:
+            self._slots = asyncio.Semaphore(self._max_workers)
+
+        if self._slots.locked() and self._max_waiting != None and self._waiting >= self._max_waiting:
+            raise PoolSaturated(f'AsyncDiagramPool: {self._running} jobs running and {self._waiting} waiting')
+
+        self._waiting += 1
+
+        try:
+            await self._slots.acquire()
+        finally:
+            self._waiting -= 1
+
+        self._running += 1
+
+    def _release_slot(self, job: '_AsyncJob'):
+        # reached on cancellation too, which is what kills a job that's still running
+        if job != None:
+            job.stop()
+
+        self._running -= 1
+        self._slots.release()
+
+    async def _start_job(self, code: str, flags: [int], stream: bool) -> '_AsyncJob':
+        limits = self._limits
+
+        if stream and limits != None:
+            limits = ResourceLimits(max_cpu_time=limits.max_cpu_time, max_memory=limits.max_memory)
+
+        conn, child_conn = self._context.Pipe()
+        process = self._context.Process(target=run_async_job, args=(child_conn, code, flags, self._scene_format, self._settings, limits, stream), daemon=True)
+
+        # starting can mean starting the fork server too, which shouldn't hold up the loop
+        job = _AsyncJob(process, conn)
+
+        start = asyncio.get_running_loop().run_in_executor(None, process.start)
+
+        try:
+            await asyncio.shield(start)
+        except asyncio.CancelledError:
+            # the process gets started either way, and it has to have started before it can be killed
+            await start
+            raise
+        finally:
+            child_conn.close()
+
+        return job
+
+    async def _receive(self, job: '_AsyncJob', time_limit: float) -> tuple:
+        loop = asyncio.get_running_loop()
+        readable = loop.create_future()
+        fd = job.conn.fileno()
+        start = time.perf_counter()
+
+        loop.add_reader(fd, lambda: readable.done() or readable.set_result(None))
+
+        try:
+            await asyncio.wait_for(readable, time_limit - job.active_time if time_limit != None else None)
+        except asyncio.TimeoutError:
+            job.stop()
+            limit = self._limits.get_kill_limit()
+            raise JobFailed(f'{ResourceLimitExceeded.__name__}: {self._limits.get_message(limit)}', limit)
+        finally:
+            loop.remove_reader(fd)
+            job.active_time += time.perf_counter() - start
+
+        # the first bytes of a message being there doesn't mean all of it is, so it's read (and a job that ended is
+        # waited on) off the loop
+        recv = loop.run_in_executor(None, job.conn.recv)
+
+        try:
+            return await asyncio.shield(recv)
+        except asyncio.CancelledError:
+            # the read can't be interrupted, so the job is killed (which ends it) before its connection can be closed
+            if job.process.is_alive():
+                job.process.kill()
+
+            await asyncio.gather(recv, return_exceptions=True)
+            raise
+        except EOFError:
+            # a job killed by the kernel for its hard cpu limit is reported as going over that limit
+            await loop.run_in_executor(None, job.process.join)
+            raise JobFailed(*describe_exit(job.process.exitcode, self._limits))
+
+
+class _AsyncJob:
+    def __init__(self, process: 'multiprocessing process', conn: 'multiprocessing connection'):
+        self.process = process
+        self.conn = conn
+        self.active_time = 0.0 # time spent waiting on the job, in seconds
+
+    def stop(self):
+        if self.process.pid != None:
+            if self.process.is_alive():
+                self.process.kill()
+
+            self.process.join()
+
+        self.conn.close()
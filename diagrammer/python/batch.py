@@ -0,0 +1,260 @@
+from .engine import ResourceLimitExceeded
+from .limits import ResourceLimits
+
+import multiprocessing, multiprocessing.connection, os, signal, time
+
+
+class BatchResult:
+    def __init__(self, index: int, diagrams: [dict], error: str, run_time: float, worker_pid: int, limit_exceeded: str = None):
+        self.index = index # position of the job in the submitted batch
+        self.diagrams = diagrams # None if the job failed outside of the submitted code
+        self.error = error
+        self.run_time = run_time # wall time spent on the job inside its worker, in seconds
+        self.worker_pid = worker_pid
+        self.limit_exceeded = limit_exceeded # ResourceLimits.CPU/WALL/MEMORY if a limit stopped the job
+
+    def is_ok(self) -> bool:
+        return self.error == None
+
+    @staticmethod
+    def from_limit(index: int, limits: ResourceLimits, limit: str, run_time: float, worker_pid: int) -> 'BatchResult':
+        # a job whose process was killed for outliving its limits, which takes any diagrams it had with it
+        return BatchResult(index, None, f'{ResourceLimitExceeded.__name__}: {limits.get_message(limit)}', run_time, worker_pid, limit)
+
+
+class JobFailed(Exception):
+    # raised by the streaming apis after the last diagram of a job that didn't finish
+    def __init__(self, message: str, limit_exceeded: str = None):
+        Exception.__init__(self, message)
+        self.limit_exceeded = limit_exceeded
+
+
+def create_job_context() -> 'multiprocessing context':
+    '''The multiprocessing context for processes that each run a single job'''
+
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        # the fork server imports diagrammer once, and every job process is forked from it already warmed up
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload([__name__.rpartition('.')[0]])
+        return context
+    else:
+        return multiprocessing.get_context('spawn')
+
+
+def describe_exit(exitcode: int, limits: ResourceLimits) -> (str, str):
+    '''The error (and the limit that caused it, if any) for a job process that exited without a result'''
+
+    # the kernel kills a process that's used up its hard cpu limit
+    if limits != None and limits.max_cpu_time != None and exitcode in {-signal.SIGKILL, -signal.SIGXCPU}:
+        return (f'{ResourceLimitExceeded.__name__}: {limits.get_message(ResourceLimits.CPU)}', ResourceLimits.CPU)
+
+    return (f'worker exited without a result (exit code {exitcode})', None)
+
+
+def run_batch_job(index: int, code: str, flags: [int], scene_format: str, settings: dict, limits: ResourceLimits = None) -> BatchResult:
+    '''Run one submission in the current (worker) process'''
+
+    # errors raised by the submitted code are already reported inside the diagrams, so only failures of the
+    # engine or scene themselves end up here
+    from . import generate_diagrams_for_code
+
+    start = time.perf_counter()
+    error = None
+    limit_exceeded = None
+
+    try:
+        if limits != None:
+            limits.apply()
+
+        diagrams = generate_diagrams_for_code(code, flags, scene_format, **settings)
+    except (Exception, ResourceLimitExceeded) as e:
+        # limits that go off during the run are handled by the engine, so only ones hit while building diagrams get here
+        diagrams = None
+        error = f'{type(e).__name__}: {e}'
+    finally:
+        if limits != None:
+            limits.clear()
+
+    if limits != None and limits.get_exceeded() != None:
+        # a run stopped by a limit still has the diagrams captured up to that point
+        limit_exceeded = limits.get_exceeded()
+        error = f'{ResourceLimitExceeded.__name__}: {limits.get_message(limit_exceeded)}'
+
+    return BatchResult(index, diagrams, error, time.perf_counter() - start, os.getpid(), limit_exceeded)
+
+
+def stream_batch_job(conn: 'multiprocessing connection', code: str, flags: [int], scene_format: str, settings: dict, limits: ResourceLimits = None):
+    '''Entry point of a process that runs one submission, sending each diagram over conn as soon as its flag fires
+
+    The program runs on the process's main thread, which is where the limits' signals are raised, and it's paused after
+    every diagram until the other end asks for the next one. The last message is ('done',) or ('failed', error, limit)'''
+
+    from . import _stream_diagrams
+
+    def send_diagram(diagram: dict):
+        conn.send(('diagram', diagram))
+
+        # the program stays paused until the consumer asks for the next diagram
+        conn.recv()
+
+    try:
+        if limits != None:
+            limits.apply()
+
+        try:
+            _stream_diagrams(code, flags, scene_format, settings, send_diagram)
+        finally:
+            if limits != None:
+                limits.clear()
+
+        if limits != None and limits.get_exceeded() != None:
+            # the diagrams from before the limit have already been sent, so only the limit is left to report
+            limit_exceeded = limits.get_exceeded()
+            conn.send(('failed', f'{ResourceLimitExceeded.__name__}: {limits.get_message(limit_exceeded)}', limit_exceeded))
+        else:
+            conn.send(('done',))
+    except (BrokenPipeError, EOFError):
+        pass # the consumer went away, so nobody is listening anymore
+    except (Exception, ResourceLimitExceeded) as e:
+        conn.send(('failed', f'{type(e).__name__}: {e}', limits.get_exceeded() if limits != None else None))
+    finally:
+        conn.close()
+
+
+def run_batch_worker(conn: 'multiprocessing connection', scene_format: str, settings: dict, limits: ResourceLimits, max_jobs: int):
+    '''Entry point of a batch worker process, which runs the jobs sent over conn until it's told to stop or retires'''
+
+    if limits != None:
+        limits.reserve(max_jobs if max_jobs != None else ResourceLimits.RESERVED_JOBS)
+
+    jobs_run = 0
+
+    try:
+        while True:
+            job = conn.recv()
+
+            if job == None:
+                break
+
+            result = run_batch_job(*job, scene_format, settings, limits)
+            jobs_run += 1
+
+            # a worker that's run its share of jobs (or used up the cpu time it reserved) is replaced by a fresh one
+            retiring = (max_jobs != None and jobs_run >= max_jobs) or (limits != None and not limits.has_cpu_time_left())
+            conn.send((result, retiring))
+
+            if retiring:
+                break
+    except (BrokenPipeError, EOFError):
+        pass # the batch was stopped, so nobody is listening anymore
+    finally:
+        conn.close()
+
+
+def generate_diagrams_batch(jobs: [(str, [int])], workers: int = None, ordered: bool = True, scene_format='json', limits: ResourceLimits = None, max_jobs_per_worker: int = None, **settings) -> 'iterator of BatchResult':
+    '''Generate diagrams for many (code, flags) jobs across a pool of worker processes
+
+    Each job runs in its own process rather than a thread since the engine redirects the process-wide sys.stdout
+    while running code. Results are yielded in job order if ordered is set, and as soon as they finish otherwise.
+    Workers are replaced after max_jobs_per_worker jobs so memory that builds up across jobs is given back. With limits
+    every job also gets a deadline here (see ResourceLimits.get_kill_time), and a worker still on its job past it is
+    killed and replaced, since code that swallows the limit errors or is stuck in a C loop can't be stopped from inside'''
+
+    jobs = list(jobs)
+    workers = min(workers if workers != None else os.cpu_count(), max(len(jobs), 1))
+    kill_time = limits.get_kill_time() if limits != None else None
+
+    context = multiprocessing.get_context()
+    job_iter = enumerate(jobs)
+    next_job = next(job_iter, None)
+    idle = []
+    busy = {} # connection -> worker
+    finished = {}
+    next_index = 0
+
+    try:
+        while next_job != None or len(busy) > 0:
+            while next_job != None and (len(idle) > 0 or len(idle) + len(busy) < workers):
+                worker = idle.pop() if len(idle) > 0 else _BatchWorker(context, scene_format, settings, limits, max_jobs_per_worker)
+                worker.assign(next_job)
+                busy[worker.conn] = worker
+                next_job = next(job_iter, None)
+
+            for conn in multiprocessing.connection.wait(list(busy), _BatchWorker.WATCHDOG_INTERVAL if kill_time != None else None):
+                worker = busy.pop(conn)
+
+                try:
+                    result, retiring = conn.recv()
+                except EOFError:
+                    # the worker itself went down, which takes the job with it
+                    finished[worker.index] = worker.collect_exit(limits)
+                    continue
+
+                finished[result.index] = result
+
+                if retiring:
+                    worker.stop()
+                else:
+                    idle.append(worker)
+
+            if kill_time != None:
+                for worker in list(busy.values()):
+                    if time.perf_counter() - worker.start_time > kill_time:
+                        del busy[worker.conn]
+                        worker.kill()
+                        finished[worker.index] = BatchResult.from_limit(worker.index, limits, limits.get_kill_limit(), time.perf_counter() - worker.start_time, worker.process.pid)
+
+            if ordered:
+                while next_index in finished:
+                    yield finished.pop(next_index)
+                    next_index += 1
+            else:
+                for index in list(finished):
+                    yield finished.pop(index)
+    finally:
+        # stopping iteration early shouldn't leave the rest of the batch running
+        for worker in idle:
+            worker.stop()
+
+        for worker in busy.values():
+            worker.kill()
+
+
+class _BatchWorker:
+    WATCHDOG_INTERVAL = 0.05 # seconds between checks for jobs that outlived their limits
+
+    def __init__(self, context: 'multiprocessing context', scene_format: str, settings: dict, limits: ResourceLimits, max_jobs: int):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=run_batch_worker, args=(child_conn, scene_format, settings, limits, max_jobs), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+        self.index = None # the job it's running
+        self.start_time = None
+
+    def assign(self, job: (int, (str, [int]))) -> None:
+        index, (code, flags) = job
+        self.index = index
+        self.start_time = time.perf_counter()
+        self.conn.send((index, code, flags))
+
+    def collect_exit(self, limits: ResourceLimits) -> BatchResult:
+        self.process.join()
+        self.conn.close()
+        error, limit_exceeded = describe_exit(self.process.exitcode, limits)
+
+        return BatchResult(self.index, None, error, time.perf_counter() - self.start_time, self.process.pid, limit_exceeded)
+
+    def stop(self) -> None:
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass # it's already retired
+
+        self.process.join()
+        self.conn.close()
+
+    def kill(self) -> None:
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
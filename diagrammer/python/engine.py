@@ -1,8 +1,8 @@
 from ..core import engine
 
-from . import utils
+from . import utils, instrument, tracing
 
-import io, sys, types
+import bisect, collections, collections.abc, io, itertools, math, sys, time, types
 
 
 class ModuleProxy(types.ModuleType):
@@ -34,6 +34,13 @@ class RestrictionError(Exception):
     pass
 
 
+class ResourceLimitExceeded(BaseException):
+    # a BaseException so that submitted code can't swallow it with a plain except Exception
+    def __init__(self, limit: str, message: str):
+        BaseException.__init__(self, message)
+        self.limit = limit
+
+
 class BlockedConstruct:
     def __init__(self, name: str):
         self._name = name
@@ -42,108 +49,1020 @@ class BlockedConstruct:
         raise RestrictionError(f"Illegal attempt to use blocked construct '{self._name}'")
 
 
-class PythonEngine(engine.DiagrammerEngine):
-    BASE_DATA_GENERATION_CODE = '_engine_internals.__gen__(_engine_internals.__globals__(), _engine_internals.__locals__(), _engine_internals.__strout__.getvalue(), _engine_internals.__strerr__.getvalue())'
+class BLDRefs:
+    # what the val of an object table entry refers to, for entries whose val holds ids instead of data
+    Option = str
+
+    ELEMENTS = 'elements' # list of element ids
+    ITEMS = 'items' # mapping of key to value id
+    DDICT = 'ddict' # id of the object's __dict__
+
+
+def resolve_scene_bld(objects: {str : dict}, scene_refs: {str : str}) -> {str : dict}:
+    '''Turn a scene's variable -> id mapping into nested bld by linking object table entries together'''
+
+    # every object gets exactly one linked copy no matter how many references point to it, so shared objects (and
+    # cycles) come out as the same dict instead of being duplicated along every path
+    linked = {}
+    to_link = []
+
+    def get_linked(obj_id: str) -> dict:
+        if obj_id not in linked:
+            linked[obj_id] = {key : value for key, value in objects[obj_id].items() if key != 'refs'}
+            to_link.append(obj_id)
+
+        return linked[obj_id]
+
+    scene_bld = {name : get_linked(obj_id) for name, obj_id in scene_refs.items()}
+
+    while len(to_link) > 0:
+        obj_id = to_link.pop()
+        refs = objects[obj_id].get('refs')
+        node = linked[obj_id]
+
+        if refs == BLDRefs.ELEMENTS:
+            node['val'] = [get_linked(element_id) for element_id in node['val']]
+        elif refs == BLDRefs.ITEMS:
+            node['val'] = {key : get_linked(value_id) for key, value_id in node['val'].items()}
+        elif refs == BLDRefs.DDICT:
+            node['val'] = get_linked(node['val'])
+
+    return scene_bld
+
+
+def bld_equal(a: object, b: object) -> bool:
+    '''== for bld, except everything in it (mapping keys too) has to have the same type and dicts the same order, since
+    1 and True or 1 and 1.0 are equal but drawn differently'''
+
+    if type(a) is not type(b):
+        return False
+    elif type(a) is dict:
+        return len(a) == len(b) and all(bld_equal(key_a, key_b) and bld_equal(value_a, value_b) for (key_a, value_a), (key_b, value_b) in zip(a.items(), b.items()))
+    elif type(a) is list or type(a) is tuple:
+        return len(a) == len(b) and all(bld_equal(item_a, item_b) for item_a, item_b in zip(a, b))
+    else:
+        return a == b
+
+
+def share_unchanged_objects(previous_objects: {str : dict}, objects: {str : dict}) -> None:
+    '''Swap every entry in objects that's equal to previous_objects' entry for the same id for that entry, so
+    snapshots only hold their own copy of what changed'''
+
+    for obj_id, entry in objects.items():
+        previous_entry = previous_objects.get(obj_id)
+
+        if previous_entry != None and bld_equal(previous_entry, entry):
+            objects[obj_id] = previous_entry
+
+
+def encode_snapshot_deltas(bare_language_data: [dict]) -> [dict]:
+    '''Keep the first snapshot's object table whole and replace every later one with what changed since the one before
+
+    A delta snapshot has changed_objects (entries that were added or changed, by id) and removed_objects (ids that
+    are gone) in place of objects. Everything else about it is left as is'''
+
+    encoded = []
+    previous_objects = None
+
+    for snapshot_data in bare_language_data:
+        # unchanged records don't have an object table of their own to encode
+        if 'unchanged' in snapshot_data:
+            encoded.append(snapshot_data)
+            continue
+
+        objects = snapshot_data['objects']
+
+        if previous_objects == None:
+            encoded.append(snapshot_data)
+        else:
+            delta = {key : value for key, value in snapshot_data.items() if key != 'objects'}
+
+            # entries shared with the previous snapshot are skipped without comparing them
+            delta['changed_objects'] = {obj_id : entry for obj_id, entry in objects.items() if obj_id not in previous_objects or (previous_objects[obj_id] is not entry and not bld_equal(previous_objects[obj_id], entry))}
+            delta['removed_objects'] = [obj_id for obj_id in previous_objects if obj_id not in objects]
+            encoded.append(delta)
+
+        previous_objects = objects
+
+    return encoded
+
+
+class SnapshotReader:
+    '''Materializes the snapshots of a run on demand, whether they're delta encoded or not
+
+    The object table is rebuilt by applying deltas starting from the last snapshot that was read (or from the start
+    when going backwards), so reading every snapshot in order only applies each delta once. Entries that didn't change
+    are shared between the snapshots it returns. With the run's output_buffers each snapshot's output and error are read
+    back as text too'''
+
+    DELTA_KEYS = ('changed_objects', 'removed_objects')
+
+    def __init__(self, bare_language_data: [dict], output_buffers: {str : 'OutputBuffer'} = None):
+        self._bare_language_data = bare_language_data
+        self._output_buffers = output_buffers
+        self._index = None
+        self._objects = None
+
+    def __len__(self) -> int:
+        return len(self._bare_language_data)
+
+    def __iter__(self) -> 'iterator of dict':
+        for index in range(len(self)):
+            yield self[index]
+
+    def __getitem__(self, index: int) -> dict:
+        if index < 0:
+            index += len(self)
+
+        if not 0 <= index < len(self):
+            raise IndexError('SnapshotReader: snapshot index out of range')
+
+        if self._index == None or index < self._index:
+            self._index = 0
+            self._objects = dict(self._bare_language_data[0]['objects'])
+
+        while self._index < index:
+            self._index += 1
+            self._apply(self._bare_language_data[self._index])
+
+        snapshot_data = self._bare_language_data[index]
+
+        # an unchanged record shows the same scenes as the snapshot it points to, only with its own output
+        if 'unchanged' in snapshot_data:
+            snapshot_data = dict(self._bare_language_data[snapshot_data['unchanged']], output=snapshot_data['output'], error=snapshot_data['error'])
+
+        snapshot_data = {key : value for key, value in snapshot_data.items() if key not in SnapshotReader.DELTA_KEYS}
+        snapshot_data['objects'] = dict(self._objects)
+
+        return resolve_output(snapshot_data, self._output_buffers) if self._output_buffers != None else snapshot_data
+
+    def _apply(self, snapshot_data: dict) -> None:
+        # the table doesn't change for an unchanged record, and a snapshot that isn't a delta replaces it outright
+        if 'unchanged' in snapshot_data:
+            return
+        elif 'objects' in snapshot_data:
+            self._objects = dict(snapshot_data['objects'])
+            return
+
+        for obj_id in snapshot_data['removed_objects']:
+            del self._objects[obj_id]
+
+        self._objects.update(snapshot_data['changed_objects'])
+
+
+def fingerprint_snapshot(snapshot_data: dict) -> tuple:
+    '''A frozen copy of a snapshot's scenes and object table, which is equal for snapshots that would be drawn the same'''
+
+    # every value is tagged with its type, so the fingerprints are only equal when bld_equal would be
+    def freeze(value: object) -> object:
+        if type(value) is dict:
+            return (dict, tuple((freeze(key), freeze(item)) for key, item in value.items()))
+        elif type(value) is list or type(value) is tuple:
+            return (type(value), tuple(freeze(item) for item in value))
+        else:
+            return (type(value), value)
+
+    return (freeze(snapshot_data['scenes']), freeze(snapshot_data['objects']))
+
+
+class UnchangedSnapshotFilter:
+    '''Replaces each snapshot whose fingerprint matches the one before it with an unchanged record
+
+    Snapshots have to be passed in their final order. A record only has unchanged (the index of the last snapshot that
+    was kept whole, which has the same scenes) and its own output and error, so the scenes don't have to be built,
+    laid out or exported again'''
 
     def __init__(self):
-        engine.DiagrammerEngine.__init__(self)
+        self._count = 0
+        self._last_fingerprint = None
+        self._last_hash = None
+        self._last_index = None
 
-    def generate_data_for_obj(self, obj: object, strings_in_chain=None, id_string_override=None) -> dict:
-        if id_string_override != None:
-            id_string = id_string_override
+    def filter(self, snapshot_data: dict) -> dict:
+        index = self._count
+        self._count += 1
+        fingerprint = fingerprint_snapshot(snapshot_data)
+        fingerprint_hash = hash(fingerprint)
+
+        # different hashes settle most changes quickly, but equal ones can collide so the fingerprints still get compared
+        if self._last_index != None and fingerprint_hash == self._last_hash and fingerprint == self._last_fingerprint:
+            return {'unchanged' : self._last_index, 'output' : snapshot_data['output'], 'error' : snapshot_data['error']}
+
+        self._last_fingerprint = fingerprint
+        self._last_hash = fingerprint_hash
+        self._last_index = index
+
+        return snapshot_data
+
+
+class OutputBuffer(io.TextIOBase):
+    '''Append-only stand-in for stdout/stderr that every snapshot of a run shares
+
+    Snapshots only record the (start, end) span of the output they show, and the text is put together from the buffer
+    when they're read (see resolve_output), so a program that prints on every flag doesn't keep a copy of everything so
+    far per snapshot. With max_size set a snapshot's span only covers the newest max_size characters before it, and the
+    buffer only keeps text inside some snapshot's span (or still new enough to end up in one), so output that's
+    printed between flags can't pile up. A span that leaves earlier output out reads back with TRUNCATION_MARKER first'''
+
+    TRUNCATION_MARKER = '...\n'
+
+    def __init__(self, max_size: int = None):
+        io.TextIOBase.__init__(self)
+
+        self.max_size = max_size
+        self._segments = [] # [start, end, chunks] for the text snapshots' spans cover, in order and never overlapping
+        self._segment_starts = []
+        self._chunks = collections.deque() # text written since the last span was taken
+        self._head_dropped = 0 # characters at the front of the oldest chunk that have already been truncated
+        self._start = 0 # offset of the oldest character in chunks
+        self._end = 0 # offset just past the newest character
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        if type(text) is not str:
+            raise TypeError(f'write() argument must be str, not {type(text).__name__}')
+
+        if len(text) > 0:
+            self._chunks.append(text)
+            self._end += len(text)
+
+            if self.max_size != None:
+                self._truncate_to(self.max_size)
+
+        return len(text)
+
+    def tell(self) -> int:
+        return self._end
+
+    def get_span(self) -> (int, int):
+        '''The span of output a snapshot taken now shows, whose text is kept from here on'''
+
+        start = max(self._end - self.max_size, 0) if self.max_size != None else 0
+
+        # everything written since the last span is inside this one (anything older was already truncated)
+        if len(self._chunks) > 0:
+            text = ''.join(self._chunks)[self._head_dropped:]
+
+            if len(self._segments) > 0 and self._segments[-1][1] == self._start:
+                self._segments[-1][1] = self._end
+                self._segments[-1][2].append(text)
+            else:
+                self._segments.append([self._start, self._end, [text]])
+                self._segment_starts.append(self._start)
+
+            self._chunks.clear()
+            self._head_dropped = 0
+            self._start = self._end
+
+        return (start, self._end)
+
+    def getvalue(self, span: (int, int) = None) -> str:
+        '''The text of span (a snapshot taken now by default)'''
+
+        start, end = span if span != None else (max(self._end - self.max_size, 0) if self.max_size != None else 0, self._end)
+        pieces = []
+
+        for segment in self._segments[max(bisect.bisect_right(self._segment_starts, start) - 1, 0):]:
+            segment_start, _, chunks = segment
+
+            if segment_start >= end:
+                break
+
+            # written in small pieces but read back whole, so pieces are merged the first time they're read
+            if len(chunks) > 1:
+                segment[2] = chunks = [''.join(chunks)]
+
+            pieces.append(chunks[0][max(start - segment_start, 0):end - segment_start])
+
+        if end > self._start:
+            pieces.append(''.join(self._chunks)[self._head_dropped:][max(start - self._start, 0):end - self._start])
+
+        text = ''.join(pieces)
+        return OutputBuffer.TRUNCATION_MARKER + text if start > 0 else text
+
+    def get_kept_size(self) -> int:
+        '''Characters of output the buffer is holding on to'''
+
+        return sum(segment_end - segment_start for segment_start, segment_end, _ in self._segments) + self._end - self._start
+
+    def _truncate_to(self, size: int) -> None:
+        excess = self._end - self._start - size
+
+        # the oldest chunk is only marked as partly dropped rather than sliced, so each write stays cheap
+        while excess > 0:
+            oldest_kept = len(self._chunks[0]) - self._head_dropped
+
+            if oldest_kept <= excess:
+                self._chunks.popleft()
+                self._head_dropped = 0
+                dropped = oldest_kept
+            else:
+                self._head_dropped += excess
+                dropped = excess
+
+            self._start += dropped
+            excess -= dropped
+
+
+def resolve_output(snapshot_data: dict, output_buffers: {str : OutputBuffer}) -> dict:
+    '''snapshot_data with the text of its output and error in place of their spans'''
+
+    return dict(snapshot_data, output=output_buffers['output'].getvalue(snapshot_data['output']), error=output_buffers['error'].getvalue(snapshot_data['error']))
+
+
+class CaptureBudget:
+    # how much of the heap a single snapshot may walk; None means unlimited
+    CLOCK_CHECK_INTERVAL = 64 # nodes between deadline checks, so the clock isn't read for every object
+
+    def __init__(self, max_depth: int = None, max_elements: int = None, max_nodes: int = None, max_time: float = None, max_repr_length: int = None):
+        self.max_depth = max_depth
+        self.max_elements = max_elements
+        self.max_nodes = max_nodes
+        self.max_repr_length = max_repr_length
+
+        self._deadline = time.perf_counter() + max_time if max_time != None else None
+        self._nodes_used = 0
+        self._out_of_time = False
+
+    def is_too_deep(self, depth: int) -> bool:
+        return self.max_depth != None and depth > self.max_depth
+
+    def is_exhausted(self) -> bool:
+        if self.max_nodes != None and self._nodes_used >= self.max_nodes:
+            return True
+
+        if self._deadline != None and not self._out_of_time and self._nodes_used % CaptureBudget.CLOCK_CHECK_INTERVAL == 0:
+            self._out_of_time = time.perf_counter() > self._deadline
+
+        return self._out_of_time
+
+    def is_out_of_time(self) -> bool:
+        return self._out_of_time
+
+    def use_node(self) -> None:
+        self._nodes_used += 1
+
+    def get_nodes_used(self) -> int:
+        return self._nodes_used
+
+    def sample_elements(self, elements: 'sized iterable') -> ([object], int):
+        '''Return the first and last elements that fit in max_elements, and how many were left out in between'''
+
+        length = len(elements)
+
+        if self.max_elements == None or length <= self.max_elements:
+            return (list(elements), 0)
+
+        head_size = (self.max_elements + 1) // 2
+        tail_size = self.max_elements - head_size
+
+        if isinstance(elements, collections.abc.Sequence):
+            head = list(elements[:head_size])
+            tail = list(elements[length - tail_size:])
         else:
-            id_string = f'{id(obj)}'
+            iterator = iter(elements)
+            head = list(itertools.islice(iterator, head_size))
+
+            # only iterate through the whole thing when it can't be walked backwards
+            if hasattr(elements, '__reversed__'):
+                tail = list(itertools.islice(reversed(elements), tail_size))[::-1]
+            else:
+                tail = list(collections.deque(iterator, maxlen=tail_size))
+
+        return (head + tail, length - self.max_elements)
+
+    def repr_value(self, value: object) -> (str, {str : int}):
+        '''Return repr(value) cut down to max_repr_length, and any of its original size that got left out of the repr'''
+
+        return bounded_repr(value, self.max_repr_length)
+
+
+BITS_PER_DECIMAL_DIGIT = math.log2(10)
+
+def bounded_repr(value: object, max_length: int = None) -> (str, {str : int}):
+    '''repr a basic value without paying for more of it than max_length characters
+
+    Strings and bytes are sliced before they're repr'd (their full length is returned as 'length') and ints too large to
+    show are summarized by their bit length (returned as 'bit_length'). Anything else is repr'd and then cut down. A
+    repr that fails, like an int over the interpreter's digit limit, is summarized instead of ending the snapshot'''
+
+    if isinstance(value, (str, bytes, bytearray)) and max_length != None and len(value) > max_length:
+        return (f'{value[:max_length]!r}...', {'length' : len(value)})
+
+    # the digit count is known from the bit length without converting the whole thing
+    if type(value) is int and max_length != None and value.bit_length() / BITS_PER_DECIMAL_DIGIT > max_length:
+        return (f'<int of {value.bit_length()} bits>', {'bit_length' : value.bit_length()})
+
+    try:
+        text = repr(value)
+    except Exception:
+        if type(value) is int:
+            return (f'<int of {value.bit_length()} bits>', {'bit_length' : value.bit_length()})
+
+        return (f'<{type(value).__name__} object>', {})
+
+    if max_length != None and len(text) > max_length:
+        return (f'{text[:max_length]}...', {})
+
+    return (text, {})
+
+
+class FlagPolicy:
+    # which of a flag's hits become snapshots; None means no restriction. condition is a python expression evaluated in
+    # the flagged line's scope, and only hits where it's true count at all. every_nth then picks hits 1, n+1, 2n+1, ...
+    # and first_k / last_k keep the first and last of those (both together keep a head and a tail, like elision)
+    def __init__(self, every_nth: int = None, first_k: int = None, last_k: int = None, condition: str = None):
+        self.every_nth = every_nth
+        self.first_k = first_k
+        self.last_k = last_k
+        self.condition = condition
+
+        # compiled once here rather than on every hit
+        self.compiled_condition = FlagPolicy._compile_condition(condition) if condition != None else None
+
+    @staticmethod
+    def _compile_condition(condition: str) -> types.CodeType:
+        try:
+            return compile(condition, '<condition>', 'eval')
+        except SyntaxError as e:
+            raise ValueError(f'FlagPolicy: condition {condition!r} is not a valid expression ({e.msg})')
+
+    @staticmethod
+    def from_dict(policy_dict: {str : object}) -> 'FlagPolicy':
+        every_nth = policy_dict['every_nth'] if 'every_nth' in policy_dict else None
+        first_k = policy_dict['first_k'] if 'first_k' in policy_dict else None
+        last_k = policy_dict['last_k'] if 'last_k' in policy_dict else None
+        condition = policy_dict['condition'] if 'condition' in policy_dict else None
+
+        return FlagPolicy(every_nth=every_nth, first_k=first_k, last_k=last_k, condition=condition)
+
+
+class FlagSampler:
+    '''Decides which flag hits become snapshots, before any data is generated for them'''
+
+    def __init__(self, policies: {int : FlagPolicy}, max_snapshots: int = None):
+        self._policies = policies
+        self._max_snapshots = max_snapshots
+
+        self._hits = {flag : 0 for flag in policies}
+        self._sampled_hits = {flag : 0 for flag in policies} # hits that made it past every_nth
+        self._buffers = {flag : collections.deque(maxlen=policy.last_k) for flag, policy in policies.items() if policy.last_k != None}
+        self._snapshot_count = 0 # snapshots kept so far, including the ones waiting in a buffer
+        self._next_order = 0
+
+    def is_conditional(self, flag: int) -> bool:
+        return self._policies[flag].compiled_condition != None
+
+    def is_hit_sampled(self, flag: int, global_contents: dict = None, local_contents: dict = None) -> bool:
+        '''Whether a hit should be captured, given the scope it happened in if the flag is conditional'''
+
+        policy = self._policies[flag]
 
-        data = {
-            'id' : id_string,
-            'type_str' : obj.__class__.__name__,
-            'val' : None
-        }
+        if policy.compiled_condition != None and not FlagSampler._is_condition_met(policy.compiled_condition, global_contents, local_contents):
+            return False
 
+        self._hits[flag] += 1
+
+        if policy.every_nth != None and (self._hits[flag] - 1) % policy.every_nth != 0:
+            return False
+
+        self._sampled_hits[flag] += 1
+
+        if self._is_buffered(flag):
+            # a full buffer trades its oldest snapshot for this one, which doesn't add to the total
+            if len(self._buffers[flag]) == policy.last_k:
+                return True
+        elif policy.first_k != None and self._sampled_hits[flag] > policy.first_k:
+            return False
+
+        return self._max_snapshots == None or self._snapshot_count < self._max_snapshots
+
+    def keep(self, flag: int, snapshot_data: dict) -> [(int, dict)]:
+        '''Take the snapshot for the hit just sampled, returning the (order, snapshot) pairs that are final right away'''
+
+        order = self._next_order
+        self._next_order += 1
+
+        if self._is_buffered(flag):
+            buffer = self._buffers[flag]
+
+            if len(buffer) < buffer.maxlen:
+                self._snapshot_count += 1
+
+            # only the last hits are kept, so whatever falls out of the buffer is dropped
+            buffer.append((order, snapshot_data))
+            return []
+        else:
+            self._snapshot_count += 1
+            return [(order, snapshot_data)]
+
+    def flush(self) -> [(int, dict)]:
+        '''Release every buffered snapshot, once no more hits can come in'''
+
+        flushed = sorted(itertools.chain.from_iterable(self._buffers.values()), key=lambda kept: kept[0])
+
+        for buffer in self._buffers.values():
+            buffer.clear()
+
+        return flushed
+
+    def get_flags(self) -> [int]:
+        return list(self._policies)
+
+    def next_order(self) -> int:
+        order = self._next_order
+        self._next_order += 1
+        return order
+
+    @staticmethod
+    def _is_condition_met(compiled_condition: types.CodeType, global_contents: dict, local_contents: dict) -> bool:
+        try:
+            return bool(eval(compiled_condition, global_contents, local_contents))
+        except Exception:
+            # a condition that can't be evaluated yet (say a name that isn't defined until later) just isn't met
+            return False
+
+    def _is_buffered(self, flag: int) -> bool:
+        # hits covered by first_k are final as soon as they happen, the rest wait to see if they're among the last
+        policy = self._policies[flag]
+        return policy.last_k != None and (policy.first_k == None or self._sampled_hits[flag] > policy.first_k)
+
+
+class PyEngineSettings:
+    # capture modes. REWRITE is the default, AST and TRACE have to be asked for
+    AST = 'ast' # inject data generation calls into the syntax tree after flagged statements
+    REWRITE = 'rewrite' # inject data generation calls into the source text after flagged lines
+    TRACE = 'trace' # leave the source untouched and snapshot from line events
+
+    MAX_REPR_LENGTH = 1000 # default, so a single huge string or int can't dominate a snapshot
+
+    def __init__(self, capture_mode = REWRITE, max_depth = None, max_elements = None, max_nodes = None, max_capture_time = None, max_snapshots = None, flag_policy = None, max_output = None, max_repr_length = MAX_REPR_LENGTH, expand_modules = (), delta_snapshots = False, skip_unchanged = False):
+        self.capture_mode = capture_mode
+        self.delta_snapshots = delta_snapshots # keep every snapshot after the first as a delta from the one before it
+        self.skip_unchanged = skip_unchanged # replace snapshots that look the same as the one before them with a record
+        self.max_output = max_output # characters of stdout (and of stderr) kept per run, dropping the oldest first
+
+        # modules (and their packages' submodules) whose contents are captured instead of summarized
+        self.expand_modules = tuple(expand_modules)
+
+        # snapshot sampling, applied to flag hits before they're captured
+        self.max_snapshots = max_snapshots
+        self.flag_policy = flag_policy if flag_policy != None else FlagPolicy() # for flags without their own policy
+
+        # capture budgets, applied to each snapshot
+        self.max_depth = max_depth
+        self.max_elements = max_elements
+        self.max_nodes = max_nodes
+        self.max_capture_time = max_capture_time
+        self.max_repr_length = max_repr_length # characters of each basic value's repr
+
+    def is_module_expanded(self, module_name: str) -> bool:
+        return any(module_name == name or module_name.startswith(f'{name}.') for name in self.expand_modules)
+
+    def create_budget(self) -> CaptureBudget:
+        return CaptureBudget(self.max_depth, self.max_elements, self.max_nodes, self.max_capture_time, self.max_repr_length)
+
+    def create_sampler(self, flags: '[int] or {int : FlagPolicy}') -> FlagSampler:
+        policies = {}
+
+        for flag in flags:
+            policy = flags[flag] if isinstance(flags, dict) else None
+
+            if policy == None:
+                policy = self.flag_policy
+            elif isinstance(policy, str):
+                policy = FlagPolicy(condition=policy)
+            elif isinstance(policy, dict):
+                policy = FlagPolicy.from_dict(policy)
+
+            policies[flag] = policy
+
+        return FlagSampler(policies, self.max_snapshots)
+
+    @staticmethod
+    def from_dict(settings_dict: {str : object}) -> 'PyEngineSettings':
+        capture_mode = settings_dict['capture_mode'] if 'capture_mode' in settings_dict else PyEngineSettings.REWRITE
+        max_depth = settings_dict['max_depth'] if 'max_depth' in settings_dict else None
+        max_elements = settings_dict['max_elements'] if 'max_elements' in settings_dict else None
+        max_nodes = settings_dict['max_nodes'] if 'max_nodes' in settings_dict else None
+        max_capture_time = settings_dict['max_capture_time'] if 'max_capture_time' in settings_dict else None
+        max_snapshots = settings_dict['max_snapshots'] if 'max_snapshots' in settings_dict else None
+        flag_policy = FlagPolicy.from_dict(settings_dict)
+        max_output = settings_dict['max_output'] if 'max_output' in settings_dict else None
+        max_repr_length = settings_dict['max_repr_length'] if 'max_repr_length' in settings_dict else PyEngineSettings.MAX_REPR_LENGTH
+        expand_modules = settings_dict['expand_modules'] if 'expand_modules' in settings_dict else ()
+        delta_snapshots = settings_dict['delta_snapshots'] if 'delta_snapshots' in settings_dict else False
+        skip_unchanged = settings_dict['skip_unchanged'] if 'skip_unchanged' in settings_dict else False
+
+        return PyEngineSettings(capture_mode=capture_mode, max_depth=max_depth, max_elements=max_elements, max_nodes=max_nodes, max_capture_time=max_capture_time, max_snapshots=max_snapshots, flag_policy=flag_policy, max_output=max_output, max_repr_length=max_repr_length, expand_modules=expand_modules, delta_snapshots=delta_snapshots, skip_unchanged=skip_unchanged)
+
+
+class PythonEngine(engine.DiagrammerEngine):
+    BASE_DATA_GENERATION_CODE = '_engine_internals.__gen__(_engine_internals.__globals__(), _engine_internals.__locals__(), _engine_internals.__strout__.get_span(), _engine_internals.__strerr__.get_span())'
+
+    # flagged captures ask the sampler first, so skipped hits don't even read the program's state or output. only
+    # conditional flags hand their scope to the sampler, since building locals() isn't free inside functions
+    FLAG_DATA_GENERATION_CODE = 'if _engine_internals.__hit__({flag}): _engine_internals.__gen__(_engine_internals.__globals__(), _engine_internals.__locals__(), _engine_internals.__strout__.get_span(), _engine_internals.__strerr__.get_span(), {flag})'
+    CONDITIONAL_FLAG_DATA_GENERATION_CODE = 'if _engine_internals.__hit__({flag}, _engine_internals.__globals__(), _engine_internals.__locals__()): _engine_internals.__gen__(_engine_internals.__globals__(), _engine_internals.__locals__(), _engine_internals.__strout__.get_span(), _engine_internals.__strerr__.get_span(), {flag})'
+
+    # compiled submissions shared by every engine, so identical (code, flags) pairs skip parsing and compilation
+    CODE_CACHE = instrument.CodeCache(256)
+
+    BLOCKED_BUILTINS = ('input', 'open', 'exec', 'eval')
+
+    # restricted builtins template, built once per process (forked workers inherit it ready-made)
+    SANDBOX_BUILTINS = None
+
+    def __init__(self, engine_settings: PyEngineSettings = None):
+        engine.DiagrammerEngine.__init__(self)
+
+        self._engine_settings = engine_settings if engine_settings != None else PyEngineSettings()
+        self._output_buffers = {'output' : OutputBuffer(), 'error' : OutputBuffer()}
+        self._ran_out_of_capture_time = False
+
+    @staticmethod
+    def get_sandbox_builtins() -> {str : object}:
+        if PythonEngine.SANDBOX_BUILTINS == None:
+            import builtins
+
+            sandbox_builtins = dict(builtins.__dict__)
+
+            # blacklist
+            for name in PythonEngine.BLOCKED_BUILTINS:
+                sandbox_builtins[name] = BlockedConstruct(name)
+
+            PythonEngine.SANDBOX_BUILTINS = sandbox_builtins
+
+        return PythonEngine.SANDBOX_BUILTINS
+
+    def get_output_buffers(self) -> {str : OutputBuffer}:
+        '''The last run's stdout and stderr, which the spans in its snapshots' output and error point into'''
+
+        return self._output_buffers
+
+    def ran_out_of_capture_time(self) -> bool:
+        '''Whether max_capture_time cut off any snapshot of the last run, which makes it depend on how fast that run was'''
+
+        return self._ran_out_of_capture_time
+
+    def generate_data_for_obj(self, obj: object, strings_in_chain=None, id_string_override=None) -> dict:
         if strings_in_chain == None:
             strings_in_chain = set()
 
-        # "base case": if it's self-ref, set None as the value
-        if id_string in strings_in_chain:
-            return data
+        def create_data(current: object, id_string: str) -> dict:
+            return {
+                'id' : id_string,
+                'type_str' : current.__class__.__name__,
+                'val' : None
+            }
+
+        root_data = create_data(obj, id_string_override if id_string_override != None else f'{id(obj)}')
+
+        # explicit stack instead of recursion so deep structures don't hit the recursion limit. each object is
+        # entered, its children are walked, and then it's exited (leaving the chain) once they're all done
+        to_visit = [(obj, root_data, False)]
+        # finished objects by id, so shared substructure (a DAG) is walked once and its value reused
+        built = {}
+
+        while len(to_visit) > 0:
+            current, data, exiting = to_visit.pop()
+            id_string = data['id']
+
+            # only objects on the current path count as self-refs, siblings sharing an object still get its full value
+            if exiting:
+                strings_in_chain.discard(id_string)
+                built[id_string] = data
+                continue
+
+            # "base case": if it's self-ref, leave None as the value
+            if id_string in strings_in_chain:
+                continue
+
+            if id_string in built:
+                data.update(built[id_string])
+                continue
+
+            strings_in_chain.add(id_string)
+            to_visit.append((current, data, True))
+
+            is_basic, collection_type_info, is_instance = utils.classify(current)
+
+            if is_basic:
+                data['val'], original_size = bounded_repr(current)
+                data['kind'] = utils.BLDKinds.BASIC
+                data.update(original_size)
+            elif collection_type_info != None:
+                # subclasses of the builtin collections have a __dict__ too, but they're drawn as the collection
+                collection_type, ordering = collection_type_info
+                data['kind'] = utils.COLLECTION_KINDS[collection_type_info]
+
+                if collection_type == utils.CollectionTypes.LINEAR:
+                    elements = list(current)
+                    data['val'] = [None] * len(elements)
+
+                    for i, element in enumerate(elements):
+                        data['val'][i] = create_data(element, f'{id(element)}')
+                        to_visit.append((element, data['val'][i], False))
+                elif collection_type == utils.CollectionTypes.MAPPING:
+                    data['val'] = {}
+
+                    for key, value in current.items():
+                        data['val'][key] = create_data(value, f'{id(value)}')
+                        to_visit.append((value, data['val'][key], False))
+            elif is_instance:
+                is_class = data['type_str'] == 'type'
+                data['val'] = create_data(current.__dict__, f'{current.__name__}->ddict' if is_class else f'{id(current.__dict__)}')
+                data['val']['obj_type'] = 'class' if is_class else 'obj'
+                data['kind'] = utils.BLDKinds.CLASS if is_class else utils.BLDKinds.OBJECT
+                to_visit.append((current.__dict__, data['val'], False))
+
+        return root_data
 
-        strings_in_chain.add(id_string)
+    def get_library_summary(self, obj: object) -> str:
+        '''What to show for obj if it's a module or comes from a library that isn't expanded (None otherwise)'''
 
-        if utils.is_basic_value(obj):
-            data['val'] = repr(obj)
-        elif utils.is_instance(obj):
-            id_string_override = f'{obj.__name__}->ddict' if data['type_str'] == 'type' else None
-            data['val'] = self.generate_data_for_obj(obj.__dict__, strings_in_chain, id_string_override)
-            data['val']['obj_type'] = 'class' if data['type_str'] == 'type' else 'obj'
+        module_name = utils.get_library_module(obj)
+
+        if module_name == None or self._engine_settings.is_module_expanded(module_name):
+            return None
+        elif isinstance(obj, types.ModuleType):
+            return f"<module '{module_name}'>"
+        elif isinstance(obj, type):
+            return f"<class '{module_name}.{obj.__qualname__}'>"
         else:
-            collection_type_info = utils.is_collection(obj)
+            return f'<{module_name}.{type(obj).__qualname__} object>'
+
+    def generate_table_for_obj(self, obj: object, objects: {str : dict}, id_string_override=None, budget: CaptureBudget = None) -> str:
+        '''Add obj and everything reachable from it to the object table, returning obj's id'''
+
+        if budget == None:
+            budget = CaptureBudget()
+
+        root_id = id_string_override if id_string_override != None else f'{id(obj)}'
+
+        # breadth first, so a depth or node budget cuts off the far end of the structure instead of one deep branch
+        to_visit = collections.deque([(obj, root_id, None, 0)])
+
+        while len(to_visit) > 0:
+            current, id_string, obj_type, depth = to_visit.popleft()
+
+            # every object is serialized once per table, however many references (or scopes) lead to it
+            if id_string in objects:
+                if obj_type != None and not objects[id_string].get('truncated', False):
+                    objects[id_string]['obj_type'] = obj_type
+
+                continue
+
+            data = {
+                'id' : id_string,
+                'type_str' : current.__class__.__name__,
+                'val' : None
+            }
+
+            objects[id_string] = data
+            is_basic, collection_type_info, is_instance = utils.classify(current)
+
+            # an object's __dict__ (obj_type != None) is part of the object itself, so it's never cut off on its own
+            if obj_type == None and (budget.is_exhausted() or (not is_basic and budget.is_too_deep(depth))):
+                data['val'] = '...'
+                data['kind'] = utils.BLDKinds.BASIC
+                data['truncated'] = True
+                continue
+
+            if obj_type != None:
+                data['obj_type'] = obj_type
+
+            budget.use_node()
+
+            # collections from libraries (like OrderedDict) are still shown with their contents
+            library_summary = self.get_library_summary(current) if collection_type_info == None else None
+
+            # what else the type of a collection or object inherits from, which its kind alone doesn't say
+            if not is_basic and library_summary == None:
+                mro_names = utils.get_mro_names(current)
 
-            if collection_type_info != None:
+                if mro_names != None:
+                    data['mro'] = mro_names
+
+            if library_summary != None:
+                # modules and library objects are shown by name, walking them would capture the library's internals
+                data['val'] = library_summary
+                data['kind'] = utils.BLDKinds.BASIC
+                data['summarized'] = True
+            elif is_basic:
+                data['val'], original_size = budget.repr_value(current)
+                data['kind'] = utils.BLDKinds.BASIC
+                data.update(original_size)
+            elif collection_type_info != None:
+                # subclasses of the builtin collections have a __dict__ too, but they're drawn as the collection
                 collection_type, ordering = collection_type_info
+                data['kind'] = utils.COLLECTION_KINDS[collection_type_info]
 
                 if collection_type == utils.CollectionTypes.LINEAR:
+                    elements, elided = budget.sample_elements(current)
                     data['val'] = []
+                    data['refs'] = BLDRefs.ELEMENTS
 
-                    for element in obj:
-                        data['val'].append(self.generate_data_for_obj(element, strings_in_chain))
+                    for element in elements:
+                        data['val'].append(f'{id(element)}')
+                        to_visit.append((element, f'{id(element)}', None, depth + 1))
                 elif collection_type == utils.CollectionTypes.MAPPING:
+                    items, elided = budget.sample_elements(current.items())
                     data['val'] = {}
+                    data['refs'] = BLDRefs.ITEMS
 
-                    for key, value in obj.items():
-                        data['val'][key] = self.generate_data_for_obj(value, strings_in_chain)
+                    for key, value in items:
+                        data['val'][key] = f'{id(value)}'
+                        to_visit.append((value, f'{id(value)}', None, depth + 1))
 
-        return data
+                # the elided elements sit between the first and last elements that were kept
+                if elided > 0:
+                    data['elided'] = elided
+                    data['elided_at'] = (budget.max_elements + 1) // 2
+            elif is_instance:
+                is_class = data['type_str'] == 'type'
+                ddict_id = f'{current.__name__}->ddict' if is_class else f'{id(current.__dict__)}'
 
-    def run(self, code: str, flags: [int]):
-        self._bare_language_data = []
+                if ddict_id in objects and objects[ddict_id].get('truncated', False):
+                    # the __dict__ was already reached (and cut off) on its own, so the object can't be shown either
+                    data['val'] = '...'
+                    data['kind'] = utils.BLDKinds.BASIC
+                    data['truncated'] = True
+                    continue
 
-        lines = code.split('\n')
-        exec_builtins = types.ModuleType('__builtins__')
+                data['val'] = ddict_id
+                data['kind'] = utils.BLDKinds.CLASS if is_class else utils.BLDKinds.OBJECT
+                data['refs'] = BLDRefs.DDICT
+                to_visit.appendleft((current.__dict__, ddict_id, 'class' if is_class else 'obj', depth))
 
-        import builtins
+        return root_id
 
-        for key, value in builtins.__dict__.items():
-            exec_builtins.__dict__[key] = value
+    def run(self, code: str, flags: '[int] or {int : FlagPolicy}', snapshot_callback: 'callable(dict)' = None):
+        '''Run code, keeping a snapshot for every flag (or handing each one to snapshot_callback as soon as it's final)'''
 
-        # blacklist
-        exec_builtins.__dict__['input'] = BlockedConstruct('input')
-        exec_builtins.__dict__['open'] = BlockedConstruct('open')
-        exec_builtins.__dict__['exec'] = BlockedConstruct('exec')
-        exec_builtins.__dict__['eval'] = BlockedConstruct('eval')
+        if self._engine_settings.capture_mode not in {PyEngineSettings.AST, PyEngineSettings.REWRITE, PyEngineSettings.TRACE}:
+            raise ValueError(f'PythonEngine.run: capture mode {self._engine_settings.capture_mode} is not valid')
+
+        self._bare_language_data = []
+        self._ran_out_of_capture_time = False
+
+        # every run gets its own copy of the template, so code that modifies its builtins can't leak into later runs
+        exec_builtins = types.ModuleType('__builtins__')
+        exec_builtins.__dict__.update(PythonEngine.get_sandbox_builtins())
 
         data_generation_blacklist = {id(exec_builtins)}
 
-        def generate_data_for_flag(global_contents: dict, local_contents: dict, output: str, error: str):
+        sampler = self._engine_settings.create_sampler(flags)
+        kept_snapshots = [] # (order, snapshot) pairs, since buffered snapshots are only kept after later ones
+        previous_objects = None # the last snapshot's object table, which the next one shares unchanged entries with
+        unchanged_filter = UnchangedSnapshotFilter() if self._engine_settings.skip_unchanged else None
+
+        def generate_data_for_flag(global_contents: dict, local_contents: dict, output: (int, int), error: (int, int), flag: int = None):
             '''Convert Python globals() and locals() to bare language data'''
 
             nonlocal self
             nonlocal data_generation_blacklist
+            nonlocal previous_objects
 
-            self._bare_language_data.append({
+            # globals and locals share one object table (and one budget), so anything reachable from both is only walked once
+            objects = {}
+            budget = self._engine_settings.create_budget()
+
+            global_refs = {name : self.generate_table_for_obj(obj, objects, budget=budget) for name, obj in global_contents.items() if id(obj) not in data_generation_blacklist}
+
+            # at module level globals() and locals() are the same dict, so its scene is only captured (and later built) once
+            if local_contents is global_contents:
+                local_refs = global_refs
+            else:
+                local_refs = {name : self.generate_table_for_obj(obj, objects, budget=budget) for name, obj in local_contents.items() if id(obj) not in data_generation_blacklist}
+
+            if budget.is_out_of_time():
+                self._ran_out_of_capture_time = True
+
+            snapshot_data = {
                 'scenes' : {
-                    'globals' : {name : self.generate_data_for_obj(obj) for name, obj in global_contents.items() if id(obj) not in data_generation_blacklist},
-                    'locals' : {name : self.generate_data_for_obj(obj) for name, obj in local_contents.items() if id(obj) not in data_generation_blacklist},
+                    'globals' : global_refs,
+                    'locals' : local_refs,
                 },
+                'objects' : objects,
                 'output' : output,
                 'error' : error,
-            })
+            }
+
+            if local_refs is global_refs:
+                snapshot_data['aliases'] = {'locals' : 'globals'}
+
+            # the snapshots of a run that's delta encoded share entries from the start, not only once they're encoded
+            if self._engine_settings.delta_snapshots and snapshot_callback == None:
+                if previous_objects != None:
+                    share_unchanged_objects(previous_objects, objects)
+
+                previous_objects = objects
+
+            if flag != None:
+                final_snapshots = sampler.keep(flag, snapshot_data)
+            else:
+                # the snapshot at the end of the run (or at its error) is always kept, after anything still buffered
+                final_snapshots = sampler.flush() + [(sampler.next_order(), snapshot_data)]
+
+            # from here on only the sampler and final_snapshots hold on to the snapshot, so a callback can let it go
+            del objects, snapshot_data, global_refs, local_refs
+
+            if snapshot_callback == None:
+                kept_snapshots.extend(final_snapshots)
+            else:
+                # the callback isn't part of the program, so it gets the real stdout and stderr back while it runs
+                sys.stdout = orig_stdout
+                sys.stderr = orig_stderr
+
+                try:
+                    # popped one at a time so each snapshot is let go of as soon as it's been handed over
+                    while len(final_snapshots) > 0:
+                        snapshot_data = final_snapshots.pop(0)[1]
+
+                        if unchanged_filter != None:
+                            snapshot_data = unchanged_filter.filter(snapshot_data)
+
+                        # it's exported as soon as it's handed over, so it gets the text of its output right away
+                        snapshot_callback(resolve_output(snapshot_data, output_buffers))
+                        del snapshot_data
+                finally:
+                    sys.stdout = engine_internals.__strout__
+                    sys.stderr = engine_internals.__strerr__
+
+        # snapshots only hold spans of these, see resolve_output
+        output_buffers = {'output' : OutputBuffer(self._engine_settings.max_output), 'error' : OutputBuffer(self._engine_settings.max_output)}
+        self._output_buffers = output_buffers
 
         engine_internals = ModuleProxy('_engine_internals', {
             '__gen__' : generate_data_for_flag,
-            '__strout__' : io.StringIO(),
-            '__strerr__' : io.StringIO(),
+            '__hit__' : sampler.is_hit_sampled,
+            '__strout__' : output_buffers['output'],
+            '__strerr__' : output_buffers['error'],
             '__globals__' : globals,
             '__locals__' : locals,
         })
 
         data_generation_blacklist.add(id(engine_internals))
 
-        orig_stdout = sys.stdout
-        sys.stdout = engine_internals.__strout__
+        exec_globals = {'__builtins__' : exec_builtins, '_engine_internals' : engine_internals}
 
+        orig_stdout = sys.stdout
         orig_stderr = sys.stderr
-        sys.stderr = engine_internals.__strerr__
 
+        try:
+            # swapped inside the try, so a resource limit signal that lands right after the swap still gets them restored
+            sys.stdout = engine_internals.__strout__
+            sys.stderr = engine_internals.__strerr__
+
+            if self._engine_settings.capture_mode == PyEngineSettings.AST:
+                exec(self._compile_instrumented(code, sampler), exec_globals)
+            elif self._engine_settings.capture_mode == PyEngineSettings.TRACE:
+                self._exec_traced(code, sampler, exec_globals, engine_internals)
+            else:
+                exec(self._rewrite_code(code, sampler), exec_globals)
+        except (Exception, ResourceLimitExceeded) as e:
+            # a run stopped by a resource limit keeps the snapshots it already captured, like any other error
+            print(f'{e.__class__.__name__}: {e}', file=engine_internals.__strerr__)
+            engine_internals.__gen__({}, {}, engine_internals.__strout__.get_span(), engine_internals.__strerr__.get_span())
+        finally:
+            sys.stdout = orig_stdout
+            sys.stderr = orig_stderr
+
+            self._bare_language_data = [snapshot_data for _, snapshot_data in sorted(kept_snapshots, key=lambda kept: kept[0])]
+
+            if unchanged_filter != None:
+                self._bare_language_data = [unchanged_filter.filter(snapshot_data) for snapshot_data in self._bare_language_data]
+
+            if self._engine_settings.delta_snapshots:
+                self._bare_language_data = encode_snapshot_deltas(self._bare_language_data)
+
+            # the program's classes would otherwise be kept alive (along with everything they reference) by the cache,
+            # while builtin and library types stay classified for the next run
+            utils.evict_program_types()
+
+    @staticmethod
+    def _create_flag_captures(sampler: FlagSampler) -> {int : str}:
+        # the data generation code injected for each flag
+        return {flag : (PythonEngine.CONDITIONAL_FLAG_DATA_GENERATION_CODE if sampler.is_conditional(flag) else PythonEngine.FLAG_DATA_GENERATION_CODE).format(flag=flag) for flag in sampler.get_flags()}
+
+    def _compile_instrumented(self, code: str, sampler: FlagSampler) -> types.CodeType:
+        # conditional flags are instrumented differently, so they're part of the key too
+        conditional_flags = [flag for flag in sampler.get_flags() if sampler.is_conditional(flag)]
+        cache_key = instrument.CodeCache.make_key(PyEngineSettings.AST, code, sampler.get_flags(), conditional_flags)
+        compiled = PythonEngine.CODE_CACHE.get(cache_key)
+
+        if compiled == None:
+            compiled = instrument.instrument_code(code, PythonEngine._create_flag_captures(sampler), PythonEngine.BASE_DATA_GENERATION_CODE)
+            PythonEngine.CODE_CACHE.put(cache_key, compiled)
+
+        return compiled
+
+    def _rewrite_code(self, code: str, sampler: FlagSampler) -> str:
+        flag_captures = PythonEngine._create_flag_captures(sampler)
+        lines = code.split('\n')
         to_exec = ''
 
         for i, line in enumerate(lines):
@@ -161,17 +1080,42 @@ class PythonEngine(engine.DiagrammerEngine):
             # add diagram generation after the line
             to_exec += line
 
-            if i in flags:
-                to_exec += f'{spaces}{PythonEngine.BASE_DATA_GENERATION_CODE}\n'
+            if i in flag_captures:
+                to_exec += f'{spaces}{flag_captures[i]}\n'
 
         # add diagram generation at the end no matter what
         to_exec += f'{PythonEngine.BASE_DATA_GENERATION_CODE}\n'
 
+        return to_exec
+
+    def _exec_traced(self, code: str, sampler: FlagSampler, exec_globals: dict, engine_internals: ModuleProxy) -> None:
+        # the source itself is untouched, so the flags don't need to be part of the key
+        cache_key = instrument.CodeCache.make_key(PyEngineSettings.TRACE, code, [])
+        compiled = PythonEngine.CODE_CACHE.get(cache_key)
+
+        if compiled == None:
+            compiled = compile(code, '<string>', 'exec')
+            PythonEngine.CODE_CACHE.put(cache_key, compiled)
+
+        def capture_frame(frame: types.FrameType, lineno: int):
+            flag = lineno - 1
+
+            if sampler.is_conditional(flag):
+                is_hit_sampled = engine_internals.__hit__(flag, frame.f_globals, frame.f_locals)
+            else:
+                is_hit_sampled = engine_internals.__hit__(flag)
+
+            if is_hit_sampled:
+                engine_internals.__gen__(frame.f_globals, frame.f_locals, engine_internals.__strout__.get_span(), engine_internals.__strerr__.get_span(), flag)
+
+        # flags are 0-indexed but code objects count lines from 1
+        capture = tracing.create_line_capture(compiled, {flag + 1 for flag in sampler.get_flags()}, capture_frame, code)
+        capture.start()
+
         try:
-            exec(to_exec, {'__builtins__' : exec_builtins, '_engine_internals' : engine_internals})
-        except Exception as e:
-            print(f'{e.__class__.__name__}: {e}', file=engine_internals.__strerr__)
-            engine_internals.__gen__({}, {}, engine_internals.__strout__.getvalue(), engine_internals.__strerr__.getvalue())
+            exec(compiled, exec_globals)
         finally:
-            sys.stdout = orig_stdout
-            sys.stderr = orig_stderr
+            capture.stop()
+
+        # add diagram generation at the end no matter what (at module level globals() and locals() are the same dict)
+        engine_internals.__gen__(exec_globals, exec_globals, engine_internals.__strout__.get_span(), engine_internals.__strerr__.get_span())
@@ -0,0 +1,202 @@
+from . import engine
+from .batch import BatchResult, run_batch_job
+from .limits import ResourceLimits
+
+import gc, io, os, pickle, selectors, signal, sys, time
+
+
+class ForkServer:
+    '''Runs each job in a child forked from a warmed up parent
+
+    The parent pays for imports, the sandbox builtins and the engine's first-run costs once, and every child starts
+    from a copy-on-write image of it instead of a fresh interpreter. Children only live for one job, so nothing a
+    submission does can leak into the next one, and a child that won't stop at its limits can just be killed.
+    Forking is only safe from a single-threaded process'''
+
+    WARM_UP_CODE = 'x = [0, "a", {1: (2.0,)}]\nclass Warm:\n\tpass\nw = Warm()'
+    WATCHDOG_INTERVAL = 0.05 # seconds between checks for children that outlived their limits
+
+    def __init__(self, scene_format='json', limits: ResourceLimits = None, **settings):
+        if not hasattr(os, 'fork'):
+            raise RuntimeError('ForkServer: os.fork is not available on this platform')
+
+        self._scene_format = scene_format
+        self._settings = settings
+        self._limits = limits
+        self._is_warm = False
+
+    def warm_up(self) -> None:
+        if self._is_warm:
+            return
+
+        engine.PythonEngine.get_sandbox_builtins()
+
+        # one full job pulls in everything that's imported or cached lazily along the way
+        run_batch_job(-1, ForkServer.WARM_UP_CODE, [0], self._scene_format, self._settings)
+
+        # whatever the warm up left behind is collected now, instead of separately in every child
+        gc.collect()
+
+        self._is_warm = True
+
+    def run(self, code: str, flags: [int]) -> BatchResult:
+        return next(self.run_many([(code, flags)]))
+
+    def run_many(self, jobs: [(str, [int])], workers: int = 1, ordered: bool = True) -> 'iterator of BatchResult':
+        '''Run jobs with up to workers children alive at once, yielding results like generate_diagrams_batch'''
+
+        self.warm_up()
+
+        job_iter = enumerate(jobs)
+        selector = selectors.DefaultSelector()
+        kill_time = self._limits.get_kill_time() if self._limits != None else None
+        finished = {}
+        next_index = 0
+        jobs_left = True
+
+        try:
+            while jobs_left or len(selector.get_map()) > 0:
+                while jobs_left and len(selector.get_map()) < workers:
+                    job = next(job_iter, None)
+
+                    if job == None:
+                        jobs_left = False
+                    else:
+                        index, (code, flags) = job
+                        forked_job = self._fork_job(index, code, flags)
+                        selector.register(forked_job.read_fd, selectors.EVENT_READ, forked_job)
+
+                # the last job can turn out to have been started already, with nothing left to wait on
+                if len(selector.get_map()) == 0:
+                    continue
+
+                for key, _ in selector.select(ForkServer.WATCHDOG_INTERVAL if kill_time != None else None):
+                    forked_job = key.data
+                    chunk = os.read(forked_job.read_fd, 1 << 16)
+
+                    if len(chunk) > 0:
+                        forked_job.chunks.append(chunk)
+                        continue
+
+                    selector.unregister(forked_job.read_fd)
+                    os.close(forked_job.read_fd)
+                    finished[forked_job.index] = self._collect_job(forked_job)
+
+                if kill_time != None:
+                    # children that hang on to the cpu without running code (or swallow the limit errors) are killed
+                    # from here, and collected once their pipe closes
+                    for key in selector.get_map().values():
+                        forked_job = key.data
+
+                        if not forked_job.killed and time.perf_counter() - forked_job.start_time > kill_time:
+                            forked_job.killed = True
+                            os.kill(forked_job.pid, signal.SIGKILL)
+
+                if ordered:
+                    while next_index in finished:
+                        yield finished.pop(next_index)
+                        next_index += 1
+                else:
+                    for index in list(finished):
+                        yield finished.pop(index)
+        finally:
+            # stopping iteration early kills whatever is still running
+            for key in list(selector.get_map().values()):
+                forked_job = key.data
+                os.close(forked_job.read_fd)
+                os.kill(forked_job.pid, signal.SIGKILL)
+                os.waitpid(forked_job.pid, 0)
+
+            selector.close()
+
+    def _fork_job(self, index: int, code: str, flags: [int]) -> '_ForkedJob':
+        read_fd, write_fd = os.pipe()
+
+        # anything still buffered would otherwise be written by both the parent and the child
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        pid = ForkServer._fork_frozen()
+
+        if pid == 0:
+            exit_code = 1
+
+            try:
+                os.close(read_fd)
+
+                # the child only lives for this job, so its hard cpu limit is just this job's
+                result = run_batch_job(index, code, flags, self._scene_format, self._settings, self._limits)
+
+                with os.fdopen(write_fd, 'wb') as result_pipe:
+                    pickle.dump(result, result_pipe, pickle.HIGHEST_PROTOCOL)
+
+                exit_code = 0
+            finally:
+                # skip the parent's cleanup (atexit handlers, buffered files) entirely
+                os._exit(exit_code)
+
+        os.close(write_fd)
+        return _ForkedJob(index, pid, read_fd)
+
+    @staticmethod
+    def _fork_frozen() -> int:
+        # objects that exist before forking are never collected in the child, so moving them out of the gc's reach
+        # keeps collections there from writing to (and un-sharing) their pages. the parent gets them back right after
+        can_freeze = hasattr(gc, 'freeze')
+        pid = -1
+
+        if can_freeze:
+            gc.freeze()
+
+        try:
+            pid = os.fork()
+        finally:
+            if can_freeze and pid != 0:
+                gc.unfreeze()
+
+        return pid
+
+    def _collect_job(self, forked_job: '_ForkedJob') -> BatchResult:
+        _, status, usage = os.wait4(forked_job.pid, 0)
+        run_time = time.perf_counter() - forked_job.start_time
+        failure = f'worker exited without a result (status {status})'
+
+        if len(forked_job.chunks) > 0:
+            try:
+                result = _ResultUnpickler(io.BytesIO(b''.join(forked_job.chunks))).load()
+
+                if type(result) is BatchResult:
+                    return result
+
+                failure = f'worker sent a {type(result).__name__} instead of a result (status {status})'
+            except Exception as e:
+                # a child killed partway through writing its result only leaves part of it
+                failure = f'worker sent a result that couldn\'t be read ({type(e).__name__}: {e}, status {status})'
+
+        if self._limits != None:
+            # without a result there are no partial diagrams either, but the limit that ended the job is still known
+            if forked_job.killed:
+                return BatchResult.from_limit(forked_job.index, self._limits, self._limits.get_kill_limit(), run_time, forked_job.pid)
+            elif self._limits.max_cpu_time != None and usage.ru_utime + usage.ru_stime >= self._limits.max_cpu_time:
+                return BatchResult.from_limit(forked_job.index, self._limits, ResourceLimits.CPU, run_time, forked_job.pid)
+
+        return BatchResult(forked_job.index, None, failure, run_time, forked_job.pid)
+
+
+class _ResultUnpickler(pickle.Unpickler):
+    # the child ran the submitted code with the pipe open, so what comes back can't be trusted to only be a result
+    def find_class(self, module: str, name: str) -> type:
+        if module == BatchResult.__module__ and name == BatchResult.__name__:
+            return BatchResult
+
+        raise pickle.UnpicklingError(f'{module}.{name} is not allowed in a result')
+
+
+class _ForkedJob:
+    def __init__(self, index: int, pid: int, read_fd: int):
+        self.index = index
+        self.pid = pid
+        self.read_fd = read_fd
+        self.chunks = []
+        self.start_time = time.perf_counter()
+        self.killed = False
@@ -0,0 +1,135 @@
+from collections import OrderedDict
+
+import ast
+import copy
+import hashlib
+import types
+
+
+class FlagInstrumenter(ast.NodeTransformer):
+    # statements whose header line is flagged capture at the top of each branch they might enter, and loops also
+    # capture once they're done (which is where a line-by-line view of the program would next stop)
+    LOOPS = (ast.For, ast.AsyncFor, ast.While)
+    BRANCHES = (ast.If,)
+    BLOCKS = (ast.With, ast.AsyncWith, ast.Try) + ((ast.TryStar,) if hasattr(ast, 'TryStar') else ()) + ((ast.Match,) if hasattr(ast, 'Match') else ())
+    CLAUSES = (ast.excepthandler,) + ((ast.match_case,) if hasattr(ast, 'match_case') else ())
+
+    def __init__(self, capture_codes: {int : str}):
+        self._capture_codes = capture_codes # capture statement for each flagged line (counted from 1 like the ast)
+        self._flagged_lines = set(capture_codes)
+        self._capture_stmts = {}
+
+    def generic_visit(self, node: ast.AST) -> ast.AST:
+        ast.NodeTransformer.generic_visit(self, node)
+
+        for field, value in ast.iter_fields(node):
+            if type(value) is list and len(value) > 0 and isinstance(value[0], ast.stmt):
+                setattr(node, field, self._instrument_body(value))
+
+        # except/case clauses aren't statements, so their headers are handled here instead of in _instrument_body
+        if isinstance(node, FlagInstrumenter.CLAUSES):
+            flagged_line = self._get_owned_flagged_line(node)
+
+            if flagged_line != None:
+                node.body.insert(0, self._create_capture(node.body[0], flagged_line))
+
+        return node
+
+    def _instrument_body(self, body: [ast.stmt]) -> [ast.stmt]:
+        instrumented = []
+
+        for stmt in body:
+            capture_after = False
+            flagged_line = self._get_owned_flagged_line(stmt)
+
+            if flagged_line != None:
+                if isinstance(stmt, FlagInstrumenter.LOOPS):
+                    stmt.body.insert(0, self._create_capture(stmt.body[0], flagged_line))
+                    capture_after = True
+                elif isinstance(stmt, FlagInstrumenter.BRANCHES):
+                    stmt.body.insert(0, self._create_capture(stmt.body[0], flagged_line))
+
+                    if len(stmt.orelse) > 0:
+                        stmt.orelse.insert(0, self._create_capture(stmt.orelse[0], flagged_line))
+                    else:
+                        capture_after = True
+                elif isinstance(stmt, FlagInstrumenter.BLOCKS):
+                    # match statements have cases instead of a body, and their cases are clauses
+                    if len(getattr(stmt, 'body', [])) > 0:
+                        stmt.body.insert(0, self._create_capture(stmt.body[0], flagged_line))
+                else:
+                    # simple statements (including ones spanning several lines) and definitions
+                    capture_after = True
+
+            instrumented.append(stmt)
+
+            if capture_after:
+                instrumented.append(self._create_capture(stmt, flagged_line))
+
+        return instrumented
+
+    def _get_owned_flagged_line(self, node: ast.AST) -> int:
+        # a node owns every line of its span that isn't part of a nested statement or clause. a node owning several
+        # flagged lines still only captures once, on behalf of its first one
+        start = min([node.lineno] + [decorator.lineno for decorator in getattr(node, 'decorator_list', [])])
+        owned_lines = set(range(start, FlagInstrumenter._end_lineno(node) + 1))
+
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, (ast.stmt,) + FlagInstrumenter.CLAUSES):
+                owned_lines -= set(range(child.lineno, FlagInstrumenter._end_lineno(child) + 1))
+
+        owned_flagged_lines = owned_lines & self._flagged_lines
+        return min(owned_flagged_lines) if len(owned_flagged_lines) > 0 else None
+
+    @staticmethod
+    def _end_lineno(node: ast.AST) -> int:
+        # end_lineno only exists on 3.8+, before that a node is treated as a single line
+        end_lineno = getattr(node, 'end_lineno', None)
+        return end_lineno if end_lineno != None else node.lineno
+
+    def _create_capture(self, location: ast.AST, flagged_line: int) -> ast.stmt:
+        if flagged_line not in self._capture_stmts:
+            self._capture_stmts[flagged_line] = ast.parse(self._capture_codes[flagged_line]).body[0]
+
+        return ast.copy_location(copy.deepcopy(self._capture_stmts[flagged_line]), location)
+
+
+def instrument_code(code: str, capture_codes: {int : str}, final_capture_code: str) -> types.CodeType:
+    tree = ast.parse(code, '<string>', 'exec')
+
+    # flags are 0-indexed but the ast counts lines from 1
+    tree = FlagInstrumenter({flag + 1 : capture_code for flag, capture_code in capture_codes.items()}).visit(tree)
+    tree.body.append(ast.parse(final_capture_code).body[0]) # add diagram generation at the end no matter what
+
+    return compile(ast.fix_missing_locations(tree), '<string>', 'exec')
+
+
+class CodeCache:
+    def __init__(self, max_size: int):
+        self._max_size = max_size
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def make_key(mode: str, code: str, flags: [int], conditional_flags: [int] = ()) -> str:
+        key_str = f'{mode}\n{sorted(set(flags))}\n{sorted(set(conditional_flags))}\n{code}'
+        return hashlib.sha256(key_str.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> types.CodeType:
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        else:
+            return None
+
+    def put(self, key: str, compiled: types.CodeType) -> None:
+        self._entries[key] = compiled
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
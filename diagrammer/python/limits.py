@@ -0,0 +1,210 @@
+from .engine import ResourceLimitExceeded
+
+import math, os, signal, time
+
+try:
+    import resource
+except ImportError:
+    resource = None # not available on windows
+
+
+class ResourceLimits:
+    '''CPU time, wall time and memory limits for running jobs in the current process
+
+    Exceeding a limit raises ResourceLimitExceeded inside the running code, so the engine stops with the snapshots
+    captured so far. All three are checked by a watchdog timer, with RLIMIT_CPU backing up the cpu limit (it only
+    has whole second precision) and RLIMIT_AS backing up the memory limit for allocations too large to ever be seen
+    by the watchdog.
+
+    None of that can stop code that swallows the error or never returns to the interpreter (like a long C loop), so
+    whoever starts the process also has to kill it once get_kill_time passes. A hard RLIMIT_CPU is always set as well,
+    and since it can never be raised again, processes that run several jobs reserve cpu time for all of them up front'''
+
+    CPU = 'cpu'
+    WALL = 'wall'
+    MEMORY = 'memory'
+
+    WATCHDOG_INTERVAL = 0.01 # seconds between wall time and memory checks
+    KILL_GRACE = 1.0 # seconds past a limit before a job that ignores it is killed outright
+    RESERVED_JOBS = 16 # jobs a reused process reserves cpu time for when it doesn't say how many it will run
+
+    def __init__(self, max_cpu_time: float = None, max_wall_time: float = None, max_memory: int = None):
+        self.max_cpu_time = max_cpu_time # seconds
+        self.max_wall_time = max_wall_time # seconds
+        self.max_memory = max_memory # bytes of resident memory for the whole process
+
+        self._exceeded = None
+        self._start_time = None
+        self._start_cpu_time = None
+        self._orig_handlers = {}
+        self._orig_rlimits = {}
+
+    @staticmethod
+    def from_dict(limits_dict: {str : object}) -> 'ResourceLimits':
+        max_cpu_time = limits_dict['max_cpu_time'] if 'max_cpu_time' in limits_dict else None
+        max_wall_time = limits_dict['max_wall_time'] if 'max_wall_time' in limits_dict else None
+        max_memory = limits_dict['max_memory'] if 'max_memory' in limits_dict else None
+
+        return ResourceLimits(max_cpu_time=max_cpu_time, max_wall_time=max_wall_time, max_memory=max_memory)
+
+    def is_limited(self) -> bool:
+        return self.max_cpu_time != None or self.max_wall_time != None or self.max_memory != None
+
+    def get_exceeded(self) -> str:
+        '''The limit that stopped the last job, if any'''
+
+        return self._exceeded
+
+    def get_message(self, limit: str) -> str:
+        if limit == ResourceLimits.CPU:
+            return f'cpu time limit of {self.max_cpu_time}s exceeded'
+        elif limit == ResourceLimits.WALL:
+            return f'wall time limit of {self.max_wall_time}s exceeded'
+        else:
+            return f'memory limit of {self.max_memory} bytes exceeded'
+
+    def get_kill_time(self) -> float:
+        '''Wall time after which a job that outlived its limits should be killed from outside (None if never)'''
+
+        times = [limit for limit in [self.max_cpu_time, self.max_wall_time] if limit != None]
+        return max(times) + ResourceLimits.KILL_GRACE if len(times) > 0 else None
+
+    def get_kill_limit(self) -> str:
+        '''The limit to report for a job that was killed from outside after get_kill_time'''
+
+        return ResourceLimits.WALL if self.max_wall_time != None else ResourceLimits.CPU
+
+    def reserve(self, jobs: int) -> None:
+        '''Set this process's hard cpu limit to what jobs more jobs can use at most, before running the first of them'''
+
+        if self.max_cpu_time == None:
+            return
+
+        if resource == None:
+            raise RuntimeError('ResourceLimits.reserve: resource limits are not supported on this platform')
+
+        hard_limit = resource.getrlimit(resource.RLIMIT_CPU)[1]
+        reserved = math.ceil(time.process_time()) + jobs * ResourceLimits._get_job_cpu_time(self.max_cpu_time)
+
+        # a hard limit can only ever be lowered. the soft limit is set for each job by apply
+        if hard_limit == resource.RLIM_INFINITY or reserved < hard_limit:
+            resource.setrlimit(resource.RLIMIT_CPU, (reserved, reserved))
+
+    def has_cpu_time_left(self) -> bool:
+        '''Whether this process's hard cpu limit leaves enough for another job'''
+
+        if self.max_cpu_time == None or resource == None:
+            return True
+
+        hard_limit = resource.getrlimit(resource.RLIMIT_CPU)[1]
+        return hard_limit == resource.RLIM_INFINITY or math.ceil(time.process_time()) + ResourceLimits._get_job_cpu_time(self.max_cpu_time) <= hard_limit
+
+    def apply(self) -> None:
+        '''Start enforcing the limits for a job about to run in this process
+
+        The kernel also kills the process once it ignores the cpu limit for a grace period. A process with no hard cpu
+        limit yet gets one for this job alone, so one that runs several jobs has to reserve them first'''
+
+        if resource == None or not hasattr(signal, 'setitimer'):
+            raise RuntimeError('ResourceLimits.apply: resource limits are not supported on this platform')
+
+        if not self.has_cpu_time_left():
+            raise RuntimeError('ResourceLimits.apply: the cpu time reserved for this process is used up')
+
+        self._exceeded = None
+        self._start_time = time.monotonic()
+        self._start_cpu_time = time.process_time()
+
+        if self.max_cpu_time != None:
+            # cpu time is counted over the whole process, so reused workers have to start from what they've used so far
+            soft_limit = math.ceil(self._start_cpu_time + self.max_cpu_time)
+            hard_limit = resource.getrlimit(resource.RLIMIT_CPU)[1]
+
+            if hard_limit == resource.RLIM_INFINITY:
+                hard_limit = soft_limit + math.ceil(ResourceLimits.KILL_GRACE)
+
+            self._set_handler(signal.SIGXCPU, self._on_cpu_limit)
+            self._set_rlimit(resource.RLIMIT_CPU, soft_limit, hard_limit)
+
+        if self.max_memory != None:
+            # address space is always larger than what's resident, so this only catches what the watchdog can't
+            hard_limit = resource.getrlimit(resource.RLIMIT_AS)[1]
+            soft_limit = ResourceLimits._get_virtual_memory() + self.max_memory
+
+            if hard_limit == resource.RLIM_INFINITY or soft_limit < hard_limit:
+                self._set_rlimit(resource.RLIMIT_AS, soft_limit, hard_limit)
+
+        if self.is_limited():
+            self._set_handler(signal.SIGALRM, self._on_watchdog)
+            signal.setitimer(signal.ITIMER_REAL, ResourceLimits.WATCHDOG_INTERVAL, ResourceLimits.WATCHDOG_INTERVAL)
+
+    def clear(self) -> None:
+        '''Stop enforcing the limits, leaving the process the way it was before apply'''
+
+        if signal.SIGALRM in self._orig_handlers:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+        for resource_id, orig_limits in self._orig_rlimits.items():
+            try:
+                resource.setrlimit(resource_id, orig_limits)
+            except (ValueError, OSError):
+                # a hard limit lowered by apply can't be raised again without privileges
+                hard_limit = resource.getrlimit(resource_id)[1]
+                resource.setrlimit(resource_id, (hard_limit, hard_limit))
+
+        for signum, handler in self._orig_handlers.items():
+            signal.signal(signum, handler)
+
+        self._orig_handlers = {}
+        self._orig_rlimits = {}
+
+    def _set_handler(self, signum: int, handler: 'callable(signum, frame)') -> None:
+        self._orig_handlers[signum] = signal.signal(signum, handler)
+
+    def _set_rlimit(self, resource_id: int, soft_limit: int, hard_limit: int) -> None:
+        self._orig_rlimits[resource_id] = resource.getrlimit(resource_id)
+        resource.setrlimit(resource_id, (soft_limit, hard_limit))
+
+    def _exceed(self, limit: str) -> None:
+        # only the first limit counts, later signals arrive while the run is already unwinding
+        if self._exceeded != None:
+            return
+
+        self._exceeded = limit
+        signal.setitimer(signal.ITIMER_REAL, 0)
+
+        raise ResourceLimitExceeded(limit, self.get_message(limit))
+
+    def _on_cpu_limit(self, signum: int, frame: 'frame') -> None:
+        self._exceed(ResourceLimits.CPU)
+
+    def _on_watchdog(self, signum: int, frame: 'frame') -> None:
+        if self.max_cpu_time != None and time.process_time() - self._start_cpu_time > self.max_cpu_time:
+            self._exceed(ResourceLimits.CPU)
+        elif self.max_wall_time != None and time.monotonic() - self._start_time > self.max_wall_time:
+            self._exceed(ResourceLimits.WALL)
+        elif self.max_memory != None and ResourceLimits._get_resident_memory() > self.max_memory:
+            self._exceed(ResourceLimits.MEMORY)
+
+    @staticmethod
+    def _get_job_cpu_time(max_cpu_time: float) -> int:
+        # the most cpu time a job can use before the kernel kills it, in the whole seconds rlimits count in
+        return math.ceil(max_cpu_time) + math.ceil(ResourceLimits.KILL_GRACE)
+
+    @staticmethod
+    def _get_resident_memory() -> int:
+        try:
+            with open('/proc/self/statm', 'rb') as statm:
+                return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except OSError:
+            # without procfs only the peak is known (in kilobytes on linux, bytes on macos)
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return peak if os.uname().sysname == 'Darwin' else peak * 1024
+
+    @staticmethod
+    def _get_virtual_memory() -> int:
+        try:
+            with open('/proc/self/statm', 'rb') as statm:
+                return int(statm.read().split()[0]) * os.sysconf('SC_PAGE_SIZE')
+        except OSError:
+            return ResourceLimits._get_resident_memory()
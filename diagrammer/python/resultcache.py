@@ -0,0 +1,190 @@
+from .. import __version__
+from .engine import FlagPolicy
+
+from collections import OrderedDict
+
+import ast, hashlib, json, os, re, sys, tempfile
+
+
+class ResultCache:
+    '''Content addressed cache of finished diagrams, shared by every request that goes through it
+
+    Results are keyed on a hash of everything that goes into them (code, flags, settings, scene format and the
+    diagrammer and python versions) and kept as json, least recently used first out once they add up to more than
+    max_size characters. If cache_dir is set they're also written there, so they outlive the process and every worker using
+    the same directory shares them. Programs that could come out differently from one run to the next are never
+    cached: ones that use anything random, time or address dependent, ones that build sets (whose order follows string
+    hashing, so PYTHONHASHSEED, or addresses), ones whose output shows an address and runs that max_capture_time cut
+    short. Sets a program gets some other way, like dict.keys() & other, aren't caught, so their order in a cached
+    result is the one from the process that ran it'''
+
+    # imports and builtins that let a program see something that changes between runs. eval, exec, __import__,
+    # importlib and getattr are here because there's no telling what they'll pull in, sys and builtins because they
+    # hand out everything else (sys.modules, builtins.id), and set and frozenset because their order follows hashing
+    NONDETERMINISTIC_MODULES = frozenset(['random', 'time', 'datetime', 'uuid', 'secrets', 'os', 'gc', 'threading', 'importlib', 'sys', 'builtins'])
+    NONDETERMINISTIC_BUILTINS = frozenset(['id', 'hash', 'input', 'open', 'eval', 'exec', '__import__', 'getattr', '__builtins__', 'set', 'frozenset'])
+
+    # attributes (or subscripts, like globals()['__builtins__']) that lead back to the real builtins or to other
+    # modules' globals, such as print.__self__ being the builtins module itself
+    NONDETERMINISTIC_ATTRIBUTES = frozenset(['__builtins__', '__self__', '__globals__', '__subclasses__', '__import__'])
+
+    # what the default repr of an object looks like, since its address changes on every run
+    ADDRESS_PATTERN = re.compile(r' at 0x[0-9a-fA-F]+')
+
+    def __init__(self, max_size: int, cache_dir: str = None):
+        self._max_size = max_size # characters of json kept in memory
+        self._cache_dir = cache_dir
+        self._entries = OrderedDict()
+        self._size = 0
+
+        if cache_dir != None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(code: str, flags: '[int] or {int : FlagPolicy}', scene_format: str, settings: dict) -> str:
+        # a list of flags means the same as the default policy for each of them
+        flag_policies = {flag : (flags[flag] if isinstance(flags, dict) else None) for flag in flags}
+
+        # the python version is there too, since things like error messages change between versions
+        key_data = {
+            'version' : __version__,
+            'python' : sys.version,
+            'code' : code,
+            'flags' : sorted(flag_policies.items()),
+            'scene_format' : scene_format,
+            'settings' : settings,
+        }
+
+        key_str = json.dumps(key_data, sort_keys=True, default=ResultCache._key_value)
+        return hashlib.sha256(key_str.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def is_cacheable(code: str) -> bool:
+        '''Whether code always does the same thing, as far as can be told without running it'''
+
+        try:
+            tree = ast.parse(code)
+        except (SyntaxError, ValueError):
+            # code that doesn't compile always fails the same way
+            return True
+
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                modules = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom):
+                modules = [node.module] if node.module != None else []
+            elif isinstance(node, ast.Name) and node.id in ResultCache.NONDETERMINISTIC_BUILTINS:
+                return False
+            elif isinstance(node, (ast.Set, ast.SetComp)):
+                return False
+            elif isinstance(node, ast.Attribute) and node.attr in ResultCache.NONDETERMINISTIC_ATTRIBUTES:
+                return False
+            elif isinstance(node, ast.Constant) and node.value in ResultCache.NONDETERMINISTIC_ATTRIBUTES:
+                return False
+            else:
+                continue
+
+            if any(module.split('.')[0] in ResultCache.NONDETERMINISTIC_MODULES for module in modules):
+                return False
+
+        return True
+
+    def get(self, key: str) -> [dict]:
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return json.loads(self._entries[key])
+
+        result_json = self._read_file(key)
+
+        if result_json == None:
+            return None
+
+        try:
+            diagrams = json.loads(result_json)
+        except ValueError:
+            # only partly there if something went wrong while it was written
+            return None
+
+        self._store(key, result_json)
+        return diagrams
+
+    def put(self, key: str, diagrams: [dict]) -> bool:
+        '''Cache diagrams under key, unless they show something that changes between runs (returns whether they were cached)'''
+
+        try:
+            result_json = json.dumps(diagrams)
+        except (TypeError, ValueError):
+            return False
+
+        if any(ResultCache.ADDRESS_PATTERN.search(diagram['output'] + diagram['error']) != None for diagram in diagrams):
+            return False
+
+        self._store(key, result_json)
+        self._write_file(key, result_json)
+
+        return True
+
+    def clear(self) -> None:
+        # only the memory tier, files are left for the other processes that might be using them
+        self._entries.clear()
+        self._size = 0
+
+    def get_size(self) -> int:
+        return self._size
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _store(self, key: str, result_json: str) -> None:
+        # a result bigger than the whole cache would only push everything else out before being dropped itself
+        if len(result_json) > self._max_size:
+            return
+
+        if key in self._entries:
+            self._size -= len(self._entries[key])
+
+        self._entries[key] = result_json
+        self._entries.move_to_end(key)
+        self._size += len(result_json)
+
+        while self._size > self._max_size:
+            _, evicted_json = self._entries.popitem(last=False)
+            self._size -= len(evicted_json)
+
+    def _get_path(self, key: str) -> str:
+        return os.path.join(self._cache_dir, f'{key}.json')
+
+    def _read_file(self, key: str) -> str:
+        if self._cache_dir == None:
+            return None
+
+        try:
+            with open(self._get_path(key), 'r', encoding='utf-8') as result_file:
+                return result_file.read()
+        except OSError:
+            return None
+
+    def _write_file(self, key: str, result_json: str) -> None:
+        if self._cache_dir == None:
+            return
+
+        # written to a temporary file first and moved into place, so readers never see half of it
+        fd, temp_path = tempfile.mkstemp(dir=self._cache_dir, suffix='.tmp')
+
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as temp_file:
+                temp_file.write(result_json)
+
+            os.replace(temp_path, self._get_path(key))
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    @staticmethod
+    def _key_value(value: object) -> object:
+        # flag policies are keyed on what they do. anything else json can't handle falls back to its repr, which at
+        # worst (an address in it) just means the key is never hit again
+        if isinstance(value, FlagPolicy):
+            return [value.every_nth, value.first_k, value.last_k, value.condition]
+        else:
+            return repr(value)
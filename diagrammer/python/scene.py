@@ -1,6 +1,7 @@
 # notes for meeting: talk about valuefactory and testing export vs object (i think we should test object for language and export for general scene)
 
 from ..scene import basic
+from .utils import BLDKinds
 from collections import OrderedDict, defaultdict
 
 import types
@@ -9,23 +10,33 @@ import json
 import time
 
 
-def is_instance_for_bld(bld: 'python bld value', type_obj: type) -> bool:
-    # special cases
-    # type is a special case because type() is its own function
-    if bld['type_str'] == 'type':
-        class A:
-            pass
-
-        return isinstance(A(), type)
-
-    # general cases
-    if bld['type_str'] == type_obj.__name__:
-        return True
-
-    try:
-        return eval(f"isinstance({bld['type_str']}(), {type_obj.__name__})")
-    except NameError:
-        return False
+# kinds for bld that wasn't tagged by the engine (like bld written by hand), by type_str
+TYPE_STR_KINDS = {
+    'list' : BLDKinds.ORDERED,
+    'tuple' : BLDKinds.ORDERED,
+    'set' : BLDKinds.UNORDERED,
+    'dict' : BLDKinds.MAPPING,
+    'mappingproxy' : BLDKinds.MAPPING,
+    'OrderedDict' : BLDKinds.MAPPING,
+    'defaultdict' : BLDKinds.MAPPING,
+}
+
+
+def get_bld_kind(bld: 'python bld value') -> str:
+    '''The BLDKinds value bld is drawn as (None if it isn't a valid value)'''
+
+    if 'kind' in bld:
+        return bld['kind']
+    elif bld['type_str'] in PyBasicValue.WHITELISTED_TYPES or PyBasicValue.is_truncated(bld) or PyBasicValue.is_summarized(bld):
+        return BLDKinds.BASIC
+    elif bld['type_str'] in TYPE_STR_KINDS:
+        return TYPE_STR_KINDS[bld['type_str']]
+    elif type(bld['val']) is dict and PyNamespaceCollection.is_object_ddict(bld['val']):
+        return BLDKinds.OBJECT
+    elif type(bld['val']) is dict and PyNamespaceCollection.is_class_ddict(bld['val']):
+        return BLDKinds.CLASS
+    else:
+        return None
 
 
 def value_to_str(type_str: str, val: str) -> str:
@@ -36,7 +47,7 @@ def value_to_str(type_str: str, val: str) -> str:
         return ':'.join(arg.strip() for arg in args)
     elif type_str == 'complex':
         return val[1:-1]
-    elif type_str in {'int', 'str', 'bool', 'float', 'NoneType'}:
+    elif type_str in {'int', 'str', 'bool', 'float', 'NoneType', 'bytes', 'bytearray'}:
         return val
     else:
         return '...'
@@ -47,15 +58,19 @@ class BLDError(Exception):
 
 
 class PyConstruct:
+    __slots__ = ()
+
     def is_constructed(self) -> bool:
         pass
 
 
 class PyRvalue(PyConstruct):
-    pass
+    __slots__ = ()
 
 
 class PyVariable(basic.Square, PyConstruct):
+    __slots__ = ('_reference',)
+
     SIZE = 50
 
     # the reason PyVariable doesn't have a construct is because it doesn't have a bld, and construct takes in a bld
@@ -71,6 +86,8 @@ class PyVariable(basic.Square, PyConstruct):
 
 
 class PyPrimitive(basic.Square, PyConstruct):
+    __slots__ = ()
+
     SIZE = 50
 
     # the reason PyPrimitive doesn't have a construct is because it doesn't have a bld, and construct takes in a bld
@@ -83,7 +100,24 @@ class PyPrimitive(basic.Square, PyConstruct):
         return bld['type_str'] in {'int', 'bool', 'float', 'NoneType'}
 
 
+class PyEllipsis(basic.Square, PyConstruct):
+    # stands in for the elements a capture budget left out of a collection
+    __slots__ = ('_elided',)
+
+    SIZE = 50
+
+    def __init__(self, elided: int):
+        basic.Square.__init__(self)
+        basic.Square.construct(self, PyEllipsis.SIZE, f'+{elided}', '...')
+        self._elided = elided
+
+    def get_elided(self) -> int:
+        return self._elided
+
+
 class PyReference(basic.Arrow, PyConstruct):
+    __slots__ = ()
+
     SETTINGS = basic.ArrowSettings(
         basic.ArrowSettings.SOLID,
         basic.ArrowSettings.EDGE,
@@ -98,23 +132,39 @@ class PyReference(basic.Arrow, PyConstruct):
 
 
 class PyBasicValue(basic.RoundedRect, PyRvalue):
+    __slots__ = ()
+
     RADIUS = 25
     TEXT_MARGIN = 10
     LETTER_WIDTH = 8
-    WHITELISTED_TYPES = {'int', 'str', 'bool', 'float', 'complex', 'range', 'function', 'NoneType', 'getset_descriptor', types.FunctionType.__name__, types.BuiltinFunctionType.__name__, types.MethodDescriptorType.__name__,
+    WHITELISTED_TYPES = {'int', 'str', 'bool', 'float', 'complex', 'range', 'function', 'NoneType', 'getset_descriptor', 'bytes', 'bytearray', types.FunctionType.__name__, types.BuiltinFunctionType.__name__, types.MethodDescriptorType.__name__,
         types.WrapperDescriptorType.__name__, types.MethodWrapperType.__name__, types.ClassMethodDescriptorType.__name__}
 
     def construct(self, scene: 'PyScene', bld: dict):
-        text_width = len(bld['val']) * PyBasicValue.LETTER_WIDTH # + 2 for the quotes
+        # sized from the text that's actually shown, which the engine already cut down for large values
+        text = bld['val'] if PyBasicValue.is_summarized(bld) else value_to_str(bld['type_str'], bld['val'])
+        text_width = len(text) * PyBasicValue.LETTER_WIDTH
         width = max(PyBasicValue.TEXT_MARGIN * 2 + text_width, PyBasicValue.RADIUS * 2)
-        basic.RoundedRect.construct(self, width, PyBasicValue.RADIUS * 2, PyBasicValue.RADIUS, bld['type_str'], value_to_str(bld['type_str'], bld['val']))
+        basic.RoundedRect.construct(self, width, PyBasicValue.RADIUS * 2, PyBasicValue.RADIUS, bld['type_str'], text)
 
     @staticmethod
     def is_basic_value(bld: 'python bld value'):
-        return bld['type_str'] in PyBasicValue.WHITELISTED_TYPES
+        # values cut off by a capture budget or summarized (modules and library objects) have no contents, so they're
+        # shown like basic values
+        return get_bld_kind(bld) == BLDKinds.BASIC
+
+    @staticmethod
+    def is_truncated(bld: 'python bld value'):
+        return bld.get('truncated', False)
+
+    @staticmethod
+    def is_summarized(bld: 'python bld value'):
+        return bld.get('summarized', False)
 
 
 class PySimpleContents(basic.CollectionContents):
+    __slots__ = ('_elements', '_reorderable')
+
     def __init__(self, elements: [PyVariable], reorderable: bool):
         self._elements = elements
         self._reorderable = reorderable
@@ -139,20 +189,36 @@ class PySimpleContents(basic.CollectionContents):
 
 
 class PySimpleCollection(basic.Collection, PyRvalue):
+    __slots__ = ()
+
     SETTINGS = basic.CollectionSettings(15, 15, 50, basic.CollectionSettings.HORIZONTAL, PyVariable.SIZE, 20)
 
     def construct(self, scene: 'PyScene', bld: dict):
+        elided, elided_at = PySimpleCollection.get_elision(bld)
+
         if PySimpleCollection.is_ordered_collection(bld):
-            contents = PySimpleContents([scene.create_variable(f'{i}', bld_val) for i, bld_val in enumerate(bld['val'])], False)
+            # elements after the elided ones keep their real indices
+            elements = [scene.create_variable(f'{i if i < elided_at else i + elided}', bld_val) for i, bld_val in enumerate(bld['val'])]
+            reorderable = False
         elif PySimpleCollection.is_unordered_collection(bld):
             if PySimpleCollection.is_mapping_collection(bld):
-                contents = PySimpleContents([scene.create_variable(key, bld_val) for key, bld_val in bld['val'].items()], True)
+                elements = [scene.create_variable(key, bld_val) for key, bld_val in bld['val'].items()]
             else:
-                contents = PySimpleContents([scene.create_variable('', bld_val) for bld_val in bld['val']], True)
+                elements = [scene.create_variable('', bld_val) for bld_val in bld['val']]
+
+            reorderable = True
         else:
             raise BLDError(f'PySimpleCollection.construct: {bld} is neither an ordered collection nor an unordered collection')
 
-        basic.Collection.construct(self, bld['type_str'], contents, PySimpleCollection.SETTINGS)
+        if elided > 0:
+            elements.insert(elided_at, scene.create_ellipsis(elided))
+
+        basic.Collection.construct(self, bld['type_str'], PySimpleContents(elements, reorderable), PySimpleCollection.SETTINGS)
+
+    @staticmethod
+    def get_elision(bld: 'python bld value') -> (int, int):
+        # how many elements a capture budget left out, and where in the kept elements they belong
+        return (bld.get('elided', 0), bld.get('elided_at', len(bld['val'])))
 
     @staticmethod
     def is_simple_collection(bld: 'python bld value') -> bool:
@@ -160,21 +226,20 @@ class PySimpleCollection(basic.Collection, PyRvalue):
 
     @staticmethod
     def is_ordered_collection(bld: 'python bld value') -> bool:
-        valid_types = {list, tuple}
-        return not PyNamespaceCollection.is_namespace_collection(bld) and any(is_instance_for_bld(bld, collection_type) for collection_type in valid_types)
+        return not PyNamespaceCollection.is_namespace_collection(bld) and get_bld_kind(bld) == BLDKinds.ORDERED
 
     @staticmethod
     def is_unordered_collection(bld: 'python bld value') -> bool:
-        valid_types = {set, dict, types.MappingProxyType}
-        return not PyNamespaceCollection.is_namespace_collection(bld) and any(is_instance_for_bld(bld, collection_type) for collection_type in valid_types)
+        return not PyNamespaceCollection.is_namespace_collection(bld) and get_bld_kind(bld) in {BLDKinds.UNORDERED, BLDKinds.MAPPING}
 
     @staticmethod
     def is_mapping_collection(bld: dict) -> bool:
-        valid_types = {dict, types.MappingProxyType}
-        return not PyNamespaceCollection.is_namespace_collection(bld) and any(is_instance_for_bld(bld, collection_type) for collection_type in valid_types)
+        return not PyNamespaceCollection.is_namespace_collection(bld) and get_bld_kind(bld) == BLDKinds.MAPPING
 
 
 class PyNamespaceContents(basic.CollectionContents):
+    __slots__ = ('_sections', '_section_order')
+
     def __init__(self, sections: {str : [PyVariable]}, section_order: [str]):
         self._sections = sections
         self._section_order = section_order
@@ -217,6 +282,8 @@ class PyNamespaceContents(basic.CollectionContents):
 
 
 class PyNamespaceCollection(basic.Collection, PyRvalue):
+    __slots__ = ()
+
     OBJECT = 0
     CLASS = 1
     COLLECTION_SETTINGS_DIR = {
@@ -230,10 +297,15 @@ class PyNamespaceCollection(basic.Collection, PyRvalue):
         if not PyNamespaceCollection.is_namespace_collection(bld):
             raise BLDError(f'PyNamespaceCollection.construct: {bld} is not an object collection')
 
+        elided, elided_at = PySimpleCollection.get_elision(bld)
+
         if PyNamespaceCollection.is_object_ddict(bld):
             sections = {'attrs' : [scene.create_variable(key, bld_val) for key, bld_val in bld['val'].items()]}
             section_order = ['attrs']
 
+            if elided > 0:
+                sections['attrs'].insert(elided_at, scene.create_ellipsis(elided))
+
             contents = PyNamespaceContents(sections, section_order)
             collection_settings = PyNamespaceCollection.COLLECTION_SETTINGS_DIR[PyNamespaceCollection.OBJECT]
         elif PyNamespaceCollection.is_class_ddict(bld):
@@ -254,6 +326,9 @@ class PyNamespaceCollection(basic.Collection, PyRvalue):
                 var = scene.create_variable(name, bld_val)
                 sections[section].append(var)
 
+            if elided > 0:
+                sections['attrs'].append(scene.create_ellipsis(elided))
+
             contents = PyNamespaceContents(sections, section_order)
             collection_settings = PyNamespaceCollection.COLLECTION_SETTINGS_DIR[PyNamespaceCollection.CLASS]
         else:
@@ -277,6 +352,8 @@ class PyNamespaceCollection(basic.Collection, PyRvalue):
 
 
 class PyNamespace(basic.Container, PyRvalue):
+    __slots__ = ()
+
     OBJECT = 0
     CLASS = 1
     MARGINS = {
@@ -303,11 +380,11 @@ class PyNamespace(basic.Container, PyRvalue):
 
     @staticmethod
     def is_object(bld: 'python bld value'):
-        return PyNamespaceCollection.is_object_ddict(bld['val'])
+        return get_bld_kind(bld) == BLDKinds.OBJECT
 
     @staticmethod
     def is_class(bld: 'python bld value'):
-        return PyNamespaceCollection.is_class_ddict(bld['val'])
+        return get_bld_kind(bld) == BLDKinds.CLASS
 
 
 class PySceneSettings:
@@ -327,12 +404,33 @@ class PyScene(basic.Scene):
     GRID_SIZE = 100
     MIN_GRID_MARGIN = 5
 
+    # the value class each kind of bld is drawn with, and the ones for type_strs that are drawn their own way (which
+    # take priority over their kind). see register_value_class
+    KIND_VALUE_CLASSES = {
+        BLDKinds.BASIC : PyBasicValue,
+        BLDKinds.ORDERED : PySimpleCollection,
+        BLDKinds.UNORDERED : PySimpleCollection,
+        BLDKinds.MAPPING : PySimpleCollection,
+        BLDKinds.OBJECT : PyNamespace,
+        BLDKinds.CLASS : PyNamespace,
+    }
+    TYPE_STR_VALUE_CLASSES = {}
+
+    # (type_str, kind) -> value class, worked out once for each and shared by every scene
+    VALUE_CLASS_CACHE_MAX_SIZE = 4096
+    _value_class_cache = {}
+
     def __init__(self, scene_settings: PySceneSettings):
         basic.Scene.__init__(self)
 
         self._scene_settings = scene_settings
         self._nonvalue_id = -1
 
+        # values waiting to be constructed, so nested values are built from a work stack instead of by recursion
+        self._pending_values = []
+        self._pending_ids = set()
+        self._constructing_pending = False
+
     def construct(self, bld: dict):
         for var_name, value_bld in bld.items():
             self.create_variable(var_name, value_bld)
@@ -363,7 +461,8 @@ class PyScene(basic.Scene):
             self._add_nonvalue_obj(prim)
             return prim
         else:
-            val = self.create_value(bld)
+            # the value a variable points to only has to exist here, it can be constructed later
+            val = self._request_value(bld)
             var = PyVariable(name)
             ref = PyReference(var, val)
             var.set_ref(ref)
@@ -374,31 +473,110 @@ class PyScene(basic.Scene):
             if type(val) is PyBasicValue:
                 val.inc_in_degree()
 
+            self._construct_pending_values()
+
             return var
 
+    def create_ellipsis(self, elided: int) -> PyEllipsis:
+        ellipsis = PyEllipsis(elided)
+        self._add_nonvalue_obj(ellipsis)
+        return ellipsis
+
     def create_value(self, bld: dict) -> PyRvalue:
+        if bld['id'] in self._directory:
+            val = self._directory[bld['id']]
+
+            # values that were only requested so far have to be constructed now, since the caller needs them whole
+            if bld['id'] in self._pending_ids:
+                self._pending_ids.discard(bld['id'])
+                val.construct(self, bld, **self._get_construct_settings(val))
+        else:
+            val = self._allocate_value(bld)
+            val.construct(self, bld, **self._get_construct_settings(val))
+
+        self._construct_pending_values()
+
+        return val
+
+    def _request_value(self, bld: dict) -> PyRvalue:
         if bld['id'] in self._directory:
             return self._directory[bld['id']]
+
+        val = self._allocate_value(bld)
+
+        # basic values have no contents so they're built right away (which also keeps their in degree intact)
+        if type(val) is PyBasicValue:
+            val.construct(self, bld)
         else:
-            settings = {}
-
-            if PyBasicValue.is_basic_value(bld):
-                val = PyBasicValue()
-            elif PySimpleCollection.is_simple_collection(bld):
-                val = PySimpleCollection()
-            elif PyNamespace.is_namespace(bld):
-                val = PyNamespace()
-            elif PyNamespaceCollection.is_namespace_collection(bld):
-                val = PyNamespaceCollection()
-
-                settings['show_class_internal_vars'] = self._scene_settings.show_class_internal_vars
-            else:
-                raise BLDError(f'PyScene.create_value: {bld} is not a valid value bld')
+            self._pending_values.append((val, bld))
+            self._pending_ids.add(bld['id'])
+
+        return val
+
+    def _allocate_value(self, bld: dict) -> PyRvalue:
+        value_class = PyScene.get_value_class(bld)
+
+        if value_class == None:
+            raise BLDError(f'PyScene.create_value: {bld} is not a valid value bld')
+
+        val = value_class()
+        self._directory[bld['id']] = val
+
+        return val
+
+    @staticmethod
+    def get_value_class(bld: dict) -> type:
+        '''The value class bld is drawn with (None if it isn't a valid value)'''
+
+        # an object's __dict__ is always drawn inside the object, whatever kind of mapping it is
+        if PyNamespaceCollection.is_namespace_collection(bld):
+            return PyNamespaceCollection
+
+        key = (bld['type_str'], get_bld_kind(bld))
+
+        if key not in PyScene._value_class_cache:
+            if len(PyScene._value_class_cache) >= PyScene.VALUE_CLASS_CACHE_MAX_SIZE:
+                PyScene._value_class_cache.clear()
+
+            type_str, kind = key
+            PyScene._value_class_cache[key] = PyScene.TYPE_STR_VALUE_CLASSES.get(type_str, PyScene.KIND_VALUE_CLASSES.get(kind))
 
-            self._directory[bld['id']] = val
-            val.construct(self, bld, **settings)
+        return PyScene._value_class_cache[key]
 
-            return val
+    @staticmethod
+    def register_value_class(value_class: type, kind: str = None, type_str: str = None) -> None:
+        '''Draw bld of kind, or bld with type_str whatever its kind, with value_class (a PyRvalue that constructs from bld)'''
+
+        if kind != None:
+            PyScene.KIND_VALUE_CLASSES[kind] = value_class
+
+        if type_str != None:
+            PyScene.TYPE_STR_VALUE_CLASSES[type_str] = value_class
+
+        PyScene._value_class_cache.clear()
+
+    def _get_construct_settings(self, val: PyRvalue) -> dict:
+        if type(val) is PyNamespaceCollection:
+            return {'show_class_internal_vars' : self._scene_settings.show_class_internal_vars}
+        else:
+            return {}
+
+    def _construct_pending_values(self) -> None:
+        # only the outermost call works through the stack, calls made while constructing just add to it
+        if self._constructing_pending:
+            return
+
+        self._constructing_pending = True
+
+        try:
+            while len(self._pending_values) > 0:
+                val, bld = self._pending_values.pop()
+
+                if bld['id'] in self._pending_ids:
+                    self._pending_ids.discard(bld['id'])
+                    val.construct(self, bld, **self._get_construct_settings(val))
+        finally:
+            self._constructing_pending = False
 
     def get_directory(self) -> {int : PyRvalue}:
         return self._directory
@@ -457,23 +635,54 @@ class PyScene(basic.Scene):
             if not obj.is_positioned():
                 self.set_grid(obj, 10, 10)
 
+        # shapes keep their geometry in their own slots rather than in a shared column store: layout and export read it
+        # one shape at a time, which array columns make slower (every read boxes a new float) and shapes bigger
         if len(self._positionable_objects) > 0:
             self._width = max(obj.get_x() + obj.get_width() for obj in self._positionable_objects)
             self._height = max(obj.get_y() + obj.get_height() for obj in self._positionable_objects)
         else:
             self._width = self._height = 0
 
-    def _position_collection(self, collection_or_container: 'basic.Collection or basic.Container', start_row: int, start_col: int) -> None:
+    def _position_collection(self, collection_or_container: 'basic.Collection or basic.Container', start_row: int, start_col: int) -> int:
+        # nested collections are positioned from an explicit stack instead of by recursion, so deep structures (like
+        # long linked lists) don't hit the recursion limit. each frame is one collection working through the
+        # collections nested inside it, and when a frame finishes its last row goes back to the frame below it
+        stack = [self._position_collection_values(collection_or_container, start_row, start_col)]
+        finished_row = None
+
+        while len(stack) > 0:
+            frame = stack[-1]
+
+            if finished_row != None:
+                frame.next_layer_current_row = finished_row
+                finished_row = None
+
+            if frame.next_layer_index < len(frame.next_layer):
+                val = frame.next_layer[frame.next_layer_index]
+                frame.next_layer_index += 1
+                frame.next_layer_current_row += 1
+
+                if not val.is_positioned():
+                    stack.append(self._position_collection_values(val, frame.next_layer_current_row, frame.next_layer_start_col))
+            else:
+                stack.pop()
+                finished_row = max(frame.current_row, frame.next_layer_current_row)
+
+        return finished_row
+
+    def _position_collection_values(self, collection_or_container: 'basic.Collection or basic.Container', start_row: int, start_col: int) -> '_CollectionPositioning':
         current_row = start_row
         self.set_grid(collection_or_container, current_row, start_col)
         collection = collection_or_container if type(collection_or_container) is PySimpleCollection else collection_or_container.get_coll()
-        collection_vars = [var for var in collection if type(var) is PyVariable]
+
+        # keep each variable's cell index, since cells that aren't variables (e.g. ellipses) still take up a column
+        collection_vars = [(i, var) for (i, var) in enumerate(collection) if type(var) is PyVariable]
 
         # position 1 wide basic values
         one_wides_exist = False
         any_values_exist = False
 
-        for (i, var) in enumerate(collection_vars):
+        for (i, var) in collection_vars:
             val = var.get_head_obj()
 
             if type(val) == PyBasicValue and val.get_width() <= PyScene.GRID_SIZE - PyScene.MIN_GRID_MARGIN * 2:
@@ -486,7 +695,7 @@ class PyScene(basic.Scene):
                     self.set_grid(val, current_row, start_col + i)
 
         # position >1 wide basic values
-        for (i, var) in reversed([(inner_i, inner_var) for (inner_i, inner_var) in enumerate(collection_vars)]):
+        for (i, var) in reversed(collection_vars):
             val = var.get_head_obj()
 
             if type(val) == PyBasicValue and val.get_width() > PyScene.GRID_SIZE - PyScene.MIN_GRID_MARGIN * 2:
@@ -495,17 +704,21 @@ class PyScene(basic.Scene):
                     any_values_exist = True
                     self.set_grid(val, current_row, start_col + i)
 
-        # position next layer of collections
-        next_layer_current_row = start_row
+        # the next layer of collections gets positioned by _position_collection
+        next_layer = [var.get_head_obj() for (_, var) in collection_vars if type(var.get_head_obj()) in {PySimpleCollection, PyNamespace}]
         next_layer_start_col = start_col + len(collection) if any_values_exist else start_col + 1
 
-        for i, val in enumerate([var.get_head_obj() for var in collection_vars if type(var.get_head_obj()) in {PySimpleCollection, PyNamespace}]):
-            next_layer_current_row += 1
+        return _CollectionPositioning(current_row, next_layer, start_row, next_layer_start_col)
 
-            if not val.is_positioned():
-                next_layer_current_row = self._position_collection(val, next_layer_current_row, next_layer_start_col)
 
-        return max(current_row, next_layer_current_row)
+class _CollectionPositioning:
+    # progress of one collection in PyScene._position_collection
+    def __init__(self, current_row: int, next_layer: [PyRvalue], next_layer_current_row: int, next_layer_start_col: int):
+        self.current_row = current_row
+        self.next_layer = next_layer
+        self.next_layer_index = 0
+        self.next_layer_current_row = next_layer_current_row
+        self.next_layer_start_col = next_layer_start_col
 
 
 class PySnapshot(basic.Snapshot):
@@ -514,8 +727,12 @@ class PySnapshot(basic.Snapshot):
         global_scene.construct(globals_bld)
         global_scene.gps()
 
-        local_scene = PyScene(scene_settings)
-        local_scene.construct(locals_bld)
-        local_scene.gps()
+        # at module level both are the same bld, and the scene built for it is shared instead of built twice
+        if locals_bld is globals_bld:
+            local_scene = global_scene
+        else:
+            local_scene = PyScene(scene_settings)
+            local_scene.construct(locals_bld)
+            local_scene.gps()
 
         basic.Snapshot.__init__(self, {'globals' : global_scene, 'locals' : local_scene}, output, error)
@@ -0,0 +1,225 @@
+import ast
+import dis
+import sys
+import types
+
+
+def find_flagged_code(code: types.CodeType, flagged_lines: {int}) -> {types.CodeType}:
+    '''Collect every code object (the module itself and any nested functions) that owns a flagged line'''
+
+    flagged_code = set()
+    to_visit = [code]
+
+    while len(to_visit) > 0:
+        current = to_visit.pop()
+
+        if any(lineno in flagged_lines for _, lineno in dis.findlinestarts(current)):
+            flagged_code.add(current)
+
+        to_visit.extend(const for const in current.co_consts if type(const) is types.CodeType)
+
+    return flagged_code
+
+
+def find_statement_flags(source: str, flagged_lines: {int}) -> {int : int}:
+    '''Map every line of a flagged simple statement spanning several lines to the flagged line it reports as'''
+
+    statement_flags = {}
+
+    for node in ast.walk(ast.parse(source, '<string>', 'exec')):
+        # compound statements keep their line by line behavior, since their bodies run lines of their own
+        if not isinstance(node, ast.stmt) or any(isinstance(child, ast.stmt) for child in ast.iter_child_nodes(node)):
+            continue
+
+        # end_lineno only exists on 3.8+, before that a statement is treated as a single line
+        end_lineno = getattr(node, 'end_lineno', None)
+        span = range(node.lineno, (end_lineno if end_lineno != None else node.lineno) + 1)
+        span_flagged_lines = [lineno for lineno in span if lineno in flagged_lines]
+
+        # like the ast backend, a statement owning several flagged lines reports once, for its first one
+        if len(span) > 1 and len(span_flagged_lines) > 0:
+            for lineno in span:
+                statement_flags[lineno] = span_flagged_lines[0]
+
+    return statement_flags
+
+
+class LineCapture:
+    # a capture fires its callback with the frame (and the flagged line) *after* a flagged line has run, which is the
+    # same point where the rewriting backend injects its data generation call. since a line only finishes when the frame moves on to its
+    # next line (or leaves the frame), each frame keeps a "pending" marker that's resolved on the next event. a flagged
+    # statement spanning several lines gets line events for each of them (in any order), so it's only finished once
+    # the frame reaches a line outside of it
+
+    def __init__(self, code: types.CodeType, flagged_lines: {int}, callback: 'callable(frame, lineno)', source: str = None):
+        self._statement_flags = find_statement_flags(source, flagged_lines) if source != None else {}
+        self._flagged_lines = set(flagged_lines) | set(self._statement_flags)
+        self._callback = callback
+        self._flagged_code = find_flagged_code(code, self._flagged_lines)
+
+    def _on_line_reached(self, frame: types.FrameType, pending_line: int, lineno: int) -> int:
+        '''Report pending_line if the frame moved past its statement, and return the line the frame now waits on'''
+
+        flagged_line = self._statement_flags[lineno] if lineno in self._statement_flags else (lineno if lineno in self._flagged_lines else None)
+
+        if pending_line != None and lineno in self._statement_flags and flagged_line == pending_line:
+            return pending_line
+
+        if pending_line != None:
+            self._callback(frame, pending_line)
+
+        return flagged_line
+
+    def start(self) -> None:
+        pass
+
+    def stop(self) -> None:
+        pass
+
+
+class SettraceCapture(LineCapture):
+    YIELD_OPCODES = {dis.opmap[name] for name in ('YIELD_VALUE', 'YIELD_FROM') if name in dis.opmap}
+
+    def __init__(self, code: types.CodeType, flagged_lines: {int}, callback: 'callable(frame, lineno)', source: str = None):
+        LineCapture.__init__(self, code, flagged_lines, callback, source)
+        self._orig_trace = None
+
+    def start(self) -> None:
+        self._orig_trace = sys.gettrace()
+        sys.settrace(self._global_trace)
+
+    def stop(self) -> None:
+        sys.settrace(self._orig_trace)
+
+    def _global_trace(self, frame: types.FrameType, event: str, arg: object) -> 'trace function':
+        # frames without flagged lines get no local tracer, so they run without line events
+        if frame.f_code not in self._flagged_code:
+            return None
+
+        # a resumed generator gets a new 'call', but it's still waiting on whatever it was before it suspended
+        if frame.f_trace != None:
+            return frame.f_trace
+
+        pending_line = None
+
+        def local_trace(frame: types.FrameType, event: str, arg: object) -> 'trace function':
+            nonlocal pending_line
+
+            if event == 'line':
+                pending_line = self._on_line_reached(frame, pending_line, frame.f_lineno)
+            elif event == 'return':
+                # a yield also shows up as 'return', but the yielding line only finishes once the generator resumes
+                if frame.f_code.co_code[frame.f_lasti] in SettraceCapture.YIELD_OPCODES:
+                    return local_trace
+
+                if pending_line != None:
+                    self._callback(frame, pending_line)
+
+                pending_line = None
+            elif event == 'exception':
+                # a line that raised never finished, so it doesn't get a snapshot
+                pending_line = None
+
+            return local_trace
+
+        return local_trace
+
+
+class MonitoringCapture(LineCapture):
+    TOOL_NAME = 'diagrammer'
+
+    def __init__(self, code: types.CodeType, flagged_lines: {int}, callback: 'callable(frame, lineno)', source: str = None):
+        LineCapture.__init__(self, code, flagged_lines, callback, source)
+        self._tool_id = None
+        self._pending_frames = {} # frame : flagged line it's waiting to report
+        self._disabled_any = False
+
+    def start(self) -> None:
+        monitoring = sys.monitoring
+
+        for tool_id in range(monitoring.DEBUGGER_ID, monitoring.OPTIMIZER_ID):
+            if monitoring.get_tool(tool_id) == None:
+                monitoring.use_tool_id(tool_id, MonitoringCapture.TOOL_NAME)
+                self._tool_id = tool_id
+                break
+        else:
+            raise RuntimeError('MonitoringCapture.start: no free sys.monitoring tool id')
+
+        monitoring.register_callback(self._tool_id, monitoring.events.LINE, self._on_line)
+        monitoring.register_callback(self._tool_id, monitoring.events.PY_RETURN, self._on_return)
+        monitoring.register_callback(self._tool_id, monitoring.events.RAISE, self._on_raise)
+
+        # only code objects that own a flagged line get events, everything else runs at full speed. raising can't be
+        # watched per code object, but it's rare enough that getting it everywhere is cheap
+        for code in self._flagged_code:
+            monitoring.set_local_events(self._tool_id, code, monitoring.events.LINE | monitoring.events.PY_RETURN)
+
+        monitoring.set_events(self._tool_id, monitoring.events.RAISE)
+
+        # cached code objects can still have locations disabled by an earlier run
+        monitoring.restart_events()
+
+    def stop(self) -> None:
+        monitoring = sys.monitoring
+
+        if self._tool_id == None:
+            return
+
+        for code in self._flagged_code:
+            monitoring.set_local_events(self._tool_id, code, monitoring.events.NO_EVENTS)
+
+        monitoring.set_events(self._tool_id, monitoring.events.NO_EVENTS)
+        monitoring.register_callback(self._tool_id, monitoring.events.LINE, None)
+        monitoring.register_callback(self._tool_id, monitoring.events.PY_RETURN, None)
+        monitoring.register_callback(self._tool_id, monitoring.events.RAISE, None)
+        monitoring.free_tool_id(self._tool_id)
+
+        self._tool_id = None
+        self._pending_frames = {}
+        self._disabled_any = False
+
+    def _on_line(self, code: types.CodeType, lineno: int) -> object:
+        frame = sys._getframe(1)
+        pending_line = self._on_line_reached(frame, self._pending_frames.pop(frame, None), lineno)
+
+        if pending_line != None:
+            self._pending_frames[frame] = pending_line
+
+            # whichever line runs next has to report back, so bring back every location disabled so far
+            if self._disabled_any:
+                self._disabled_any = False
+                sys.monitoring.restart_events()
+
+            return None
+        else:
+            return self._disable_if_idle()
+
+    def _on_return(self, code: types.CodeType, offset: int, retval: object) -> object:
+        frame = sys._getframe(1)
+
+        if frame in self._pending_frames:
+            self._callback(frame, self._pending_frames.pop(frame))
+
+        return self._disable_if_idle()
+
+    def _on_raise(self, code: types.CodeType, offset: int, exception: BaseException) -> None:
+        # a line that raised never finished, so it doesn't get a snapshot (this fires in every frame the exception
+        # passes through, whether or not it's caught there)
+        self._pending_frames.pop(sys._getframe(1), None)
+
+    def _disable_if_idle(self) -> object:
+        # unflagged locations only matter right after a flagged line, so while no frame is waiting on one they're
+        # switched off until the next flagged hit
+        if len(self._pending_frames) > 0:
+            return None
+
+        self._disabled_any = True
+        return sys.monitoring.DISABLE
+
+
+def create_line_capture(code: types.CodeType, flagged_lines: {int}, callback: 'callable(frame, lineno)', source: str = None) -> LineCapture:
+    # sys.monitoring (PEP 669) only exists on 3.12+, older interpreters fall back to sys.settrace
+    if hasattr(sys, 'monitoring'):
+        return MonitoringCapture(code, flagged_lines, callback, source)
+    else:
+        return SettraceCapture(code, flagged_lines, callback, source)
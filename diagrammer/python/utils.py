@@ -1,13 +1,10 @@
 import types
 import collections
+import os
+import sys
+import sysconfig
 
 # TYPE CHECKING
-def is_basic_value(obj: object) -> bool:
-    # list of "function-like" types, which are special cases
-    special_cases = [types.FunctionType, types.BuiltinFunctionType, types.MethodDescriptorType,
-        types.WrapperDescriptorType, types.MethodWrapperType, types.ClassMethodDescriptorType]
-    return type(obj) in special_cases or (not is_collection(obj) and not is_instance(obj))
-
 class CollectionTypes:
     Option = int
 
@@ -17,29 +14,174 @@ class CollectionTypes:
     ORDERED = 2
     UNORDERED = 3
 
+class BLDKinds:
+    # what each bld node is drawn as, decided by the engine from the object's type so the scene never has to guess
+    # from its type_str
+    BASIC = 'basic'
+    ORDERED = 'ordered'
+    UNORDERED = 'unordered'
+    MAPPING = 'mapping'
+    OBJECT = 'object'
+    CLASS = 'class'
+
+# list of "function-like" types, which are special cases
+SPECIAL_CASES = frozenset([types.FunctionType, types.BuiltinFunctionType, types.MethodDescriptorType,
+    types.WrapperDescriptorType, types.MethodWrapperType, types.ClassMethodDescriptorType])
+
+BASE_COLLECTION_TYPES = (
+    ((list, tuple), (CollectionTypes.LINEAR, CollectionTypes.ORDERED)),
+    ((set,), (CollectionTypes.LINEAR, CollectionTypes.UNORDERED)),
+    ((collections.OrderedDict,), (CollectionTypes.MAPPING, CollectionTypes.ORDERED)),
+    ((dict, types.MappingProxyType), (CollectionTypes.MAPPING, CollectionTypes.ORDERED)),
+)
+
+COLLECTION_KINDS = {
+    (CollectionTypes.LINEAR, CollectionTypes.ORDERED) : BLDKinds.ORDERED,
+    (CollectionTypes.LINEAR, CollectionTypes.UNORDERED) : BLDKinds.UNORDERED,
+    (CollectionTypes.MAPPING, CollectionTypes.ORDERED) : BLDKinds.MAPPING,
+}
+
+# attributes that python level classes can override to change what isinstance and hasattr see for each object
+DYNAMIC_ATTRIBUTES = ('__getattr__', '__getattribute__', '__class__')
+
+# (is_basic_value, is_collection, is_instance) for every type classified so far. builtin and library types are kept
+# across runs, but a run's own classes are only needed while it runs, so the engine evicts them after each one (see
+# evict_program_types), and the whole cache is also cleared if it somehow grows past the max
+TYPE_CACHE_MAX_SIZE = 4096
+_type_cache = {}
+_mro_cache = {}
+_program_types = set() # cached types that the programs run so far defined themselves
+
+# set on types created at runtime (by a class statement, say), but never on the interpreter's own builtin types
+HEAP_TYPE_FLAG = 1 << 9
+
+def classify(obj: object) -> (bool, (CollectionTypes.Option, CollectionTypes.Option), bool):
+    '''is_basic_value, is_collection and is_instance for obj, worked out once per type'''
+
+    obj_type = type(obj)
+
+    if obj_type in _type_cache:
+        return _type_cache[obj_type]
+
+    classification = _classify_obj(obj)
+
+    if not _has_dynamic_attributes(obj_type):
+        if len(_type_cache) >= TYPE_CACHE_MAX_SIZE:
+            _type_cache.clear()
+
+        _type_cache[obj_type] = classification
+        _track_program_type(obj_type)
+
+    return classification
+
+def clear_type_cache() -> None:
+    _type_cache.clear()
+    _mro_cache.clear()
+    _program_types.clear()
+
+def evict_program_types() -> None:
+    '''Drop the cached types that the programs run so far defined themselves, keeping builtin and library ones'''
+
+    # popped one at a time, since another engine's run in this process could be adding to it meanwhile
+    while len(_program_types) > 0:
+        obj_type = _program_types.pop()
+        _type_cache.pop(obj_type, None)
+        _mro_cache.pop(obj_type, None)
+
+def get_mro_names(obj: object) -> [str]:
+    '''The names of the classes in obj's type's mro, or None if it has no bases besides object'''
+
+    obj_type = type(obj)
+
+    if obj_type not in _mro_cache:
+        if len(_mro_cache) >= TYPE_CACHE_MAX_SIZE:
+            _mro_cache.clear()
+
+        mro = obj_type.__mro__
+        _mro_cache[obj_type] = [klass.__name__ for klass in mro] if len(mro) > 2 else None
+        _track_program_type(obj_type)
+
+    return _mro_cache[obj_type]
+
+def is_basic_value(obj: object) -> bool:
+    return classify(obj)[0]
+
 def is_collection(obj: object) -> (CollectionTypes.Option, CollectionTypes.Option):
-    base_collection_types = {
-        'linear' : {
-            'ordered' : [list, tuple],
-            'unordered' : [set],
-        },
-
-        'mapping' : {
-            'ordered' : [collections.OrderedDict],
-            'unordered' : [dict, types.MappingProxyType],
-        }
-    }
-
-    if any(isinstance(obj, collection_type) for collection_type in base_collection_types['linear']['ordered']):
-        return (CollectionTypes.LINEAR, CollectionTypes.ORDERED)
-    elif any(isinstance(obj, collection_type) for collection_type in base_collection_types['linear']['unordered']):
-        return (CollectionTypes.LINEAR, CollectionTypes.UNORDERED)
-    elif any(isinstance(obj, collection_type) for collection_type in base_collection_types['mapping']['ordered']):
-        return (CollectionTypes.MAPPING, CollectionTypes.ORDERED)
-    elif any(isinstance(obj, collection_type) for collection_type in base_collection_types['mapping']['unordered']):
-        return (CollectionTypes.MAPPING, CollectionTypes.ORDERED)
-    else:
-        return None
+    return classify(obj)[1]
 
 def is_instance(obj: object) -> bool:
-    return hasattr(obj, '__dict__')
\ No newline at end of file
+    return classify(obj)[2]
+
+def _classify_obj(obj: object) -> (bool, (CollectionTypes.Option, CollectionTypes.Option), bool):
+    collection_info = None
+
+    for collection_types, info in BASE_COLLECTION_TYPES:
+        if isinstance(obj, collection_types):
+            collection_info = info
+            break
+
+    instance = hasattr(obj, '__dict__')
+    basic_value = type(obj) in SPECIAL_CASES or (collection_info == None and not instance)
+
+    return (basic_value, collection_info, instance)
+
+def _track_program_type(obj_type: type) -> None:
+    # the submission's own classes report builtins as their module (see get_library_module), but unlike the real
+    # builtin types they're created at runtime
+    module_name = obj_type.__module__
+
+    if obj_type.__flags__ & HEAP_TYPE_FLAG != 0 and (type(module_name) is not str or module_name == 'builtins' or not is_library_module(module_name)):
+        _program_types.add(obj_type)
+
+def _has_dynamic_attributes(obj_type: type) -> bool:
+    # builtin types implement these in c the same way for every object, but a python override could answer
+    # differently for each one, so objects of those types are classified one by one
+    for klass in obj_type.__mro__:
+        for name in DYNAMIC_ATTRIBUTES:
+            if name in klass.__dict__ and not isinstance(klass.__dict__[name], (types.WrapperDescriptorType, types.GetSetDescriptorType)):
+                return True
+
+    return False
+
+# LIBRARY DETECTION
+# where the standard library and installed packages live, anything imported from here isn't the submission's own code
+LIBRARY_PATHS = tuple(sorted({os.path.normcase(os.path.realpath(path)) for name, path in sysconfig.get_paths().items() if name in {'stdlib', 'platstdlib', 'purelib', 'platlib'}}))
+PACKAGE_DIRS = ('site-packages', 'dist-packages')
+
+# whether each module name belongs to a library, which never changes once a module is imported
+_library_modules = {}
+
+def get_library_module(obj: object) -> str:
+    '''The name of the module obj is, or of the library module obj's class comes from (None if it's the program's own)'''
+
+    # a module's namespace is never the program's own, so every module counts
+    if isinstance(obj, types.ModuleType):
+        return obj.__name__
+
+    # the submission's own classes report builtins as their module (it runs without a __name__), so builtins itself
+    # never counts as a library here
+    module_name = obj.__module__ if isinstance(obj, type) else type(obj).__module__
+    return module_name if type(module_name) is str and module_name != 'builtins' and is_library_module(module_name) else None
+
+def is_library_module(module_name: str) -> bool:
+    if module_name in _library_modules:
+        return _library_modules[module_name]
+
+    module = sys.modules.get(module_name)
+
+    # only modules that have been imported can be looked up, and one that hasn't been yet might still be later
+    if module == None:
+        return False
+
+    _library_modules[module_name] = _is_library_module(module)
+    return _library_modules[module_name]
+
+def _is_library_module(module: types.ModuleType) -> bool:
+    path = getattr(module, '__file__', None)
+
+    # modules compiled into the interpreter (or frozen) have no file at all
+    if path == None:
+        return True
+
+    path = os.path.normcase(os.path.realpath(path))
+    return any(path.startswith(library_path + os.sep) for library_path in LIBRARY_PATHS) or any(package_dir in path.split(os.sep) for package_dir in PACKAGE_DIRS)
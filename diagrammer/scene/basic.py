@@ -1,6 +1,13 @@
-from collections import OrderedDict, namedtuple
+from collections import OrderedDict, defaultdict, namedtuple
+import itertools
 import math
 
+# numpy is optional, without it arrows are always clipped one at a time
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 class ConstructorError(Exception):
     pass
@@ -51,6 +58,10 @@ class ReorderException(Exception):
 
 
 class SceneObject:
+    # every shape uses __slots__ instead of a __dict__, since a big scene is made of tens of thousands of them. a
+    # subclass that doesn't declare its own __slots__ gets a __dict__ back (and the memory that goes with it)
+    __slots__ = ()
+
     def export(self) -> 'json':
         return dict()
 
@@ -59,6 +70,8 @@ class SceneObject:
 
 
 class BasicShape(SceneObject):
+    __slots__ = ('_width', '_height', '_header', '_content', '_x', '_y', '_in_degree')
+
     HEADER_MARGIN = 5
 
     def construct(self, width: float, height: float, header: str, content: str):
@@ -75,6 +88,18 @@ class BasicShape(SceneObject):
     def calculate_edge_pos(self, angle: float) -> (float, float):
         return (self._x, self._y)
 
+    @staticmethod
+    def gather_geometry(shapes: ['BasicShape']) -> ('numpy.ndarray', 'numpy.ndarray', 'numpy.ndarray', 'numpy.ndarray'):
+        '''x, y, width and height of every shape as numpy arrays (nan where a position isn't set)'''
+
+        geometry = numpy.array([(shape._x, shape._y, shape._width, shape._height) for shape in shapes], dtype=numpy.float64)
+        return tuple(geometry.reshape(-1, 4).T)
+
+    @staticmethod
+    def calculate_edge_positions(shapes: ['BasicShape'], x: 'numpy.ndarray', y: 'numpy.ndarray', width: 'numpy.ndarray', height: 'numpy.ndarray', angle: 'numpy.ndarray') -> ('numpy.ndarray', 'numpy.ndarray'):
+        # calculate_edge_pos for a batch of shapes of one class (see Arrow.clip_all), nan where it would raise
+        return (x, y)
+
     def set_width(self, width: float) -> None:
         self._width = width
 
@@ -203,6 +228,8 @@ class BasicShape(SceneObject):
 
 
 class Square(BasicShape):
+    __slots__ = ()
+
     SHAPE = Shape.SQUARE
 
     def construct(self, size: float, header: str, content: str):
@@ -226,6 +253,23 @@ class Square(BasicShape):
         else:
             raise FloatingPointError(f'Square._calculate_square_edge_pos: angle {angle} is invalid')
 
+    @staticmethod
+    def calculate_edge_positions(shapes: ['Square'], x: 'numpy.ndarray', y: 'numpy.ndarray', width: 'numpy.ndarray', height: 'numpy.ndarray', angle: 'numpy.ndarray') -> ('numpy.ndarray', 'numpy.ndarray'):
+        standard_dangle = numpy.degrees(angle) % 360
+        right_tri_height, top_tri_width, left_tri_height, bottom_tri_width = _get_side_offsets(width, height, angle)
+
+        sides = [
+            ((315 <= standard_dangle) & (standard_dangle < 360)) | ((0 <= standard_dangle) & (standard_dangle < 45)),
+            (45 <= standard_dangle) & (standard_dangle < 135),
+            (135 <= standard_dangle) & (standard_dangle < 225),
+            (225 <= standard_dangle) & (standard_dangle < 315),
+        ]
+
+        edge_x = numpy.select(sides, [x + width / 2, x + top_tri_width, x - width / 2, x - bottom_tri_width], numpy.nan)
+        edge_y = numpy.select(sides, [y - right_tri_height, y - height / 2, y - left_tri_height, y + height / 2], numpy.nan)
+
+        return (edge_x, edge_y)
+
     def svg(self) -> str:
         return f'''
         <g>
@@ -237,6 +281,8 @@ class Square(BasicShape):
 
 
 class Circle(BasicShape):
+    __slots__ = ()
+
     SHAPE = Shape.CIRCLE
 
     def construct(self, radius: float, header: str, content: str):
@@ -245,6 +291,10 @@ class Circle(BasicShape):
     def calculate_edge_pos(self, angle: float) -> (float, float):
         return (self._x + self._width / 2 * math.cos(angle), self._y - self._height / 2 * math.sin(angle))
 
+    @staticmethod
+    def calculate_edge_positions(shapes: ['Circle'], x: 'numpy.ndarray', y: 'numpy.ndarray', width: 'numpy.ndarray', height: 'numpy.ndarray', angle: 'numpy.ndarray') -> ('numpy.ndarray', 'numpy.ndarray'):
+        return (x + width / 2 * numpy.cos(angle), y - height / 2 * numpy.sin(angle))
+
     def svg(self) -> str:
         return f'''
         <g>
@@ -256,8 +306,15 @@ class Circle(BasicShape):
 
 
 class RoundedRect(BasicShape):
+    __slots__ = ('_corner_radius', '_straight_width', '_straight_height', '_transition_dangles')
+
     SHAPE = Shape.ROUNDED_RECT
 
+    # the transition angles only depend on the size, and most rounded rects in a scene share one of a few sizes, so
+    # each size's are worked out once and shared
+    TRANSITION_DANGLES_CACHE_MAX_SIZE = 4096
+    _transition_dangles_cache = {}
+
     def construct(self, width: float, height: float, corner_radius: float, header: str, content: str):
         BasicShape.construct(self, width, height, header, content)
         self._corner_radius = corner_radius
@@ -265,13 +322,29 @@ class RoundedRect(BasicShape):
         # precalculate variables used for calculate_edge_pos
         self._straight_width = width - corner_radius * 2
         self._straight_height = height - corner_radius * 2
+        self._transition_dangles = RoundedRect._get_transition_dangles(width, height, corner_radius)
+
+    @staticmethod
+    def _get_transition_dangles(width: float, height: float, corner_radius: float) -> (float,):
+        key = (width, height, corner_radius)
+
+        if key not in RoundedRect._transition_dangles_cache:
+            if len(RoundedRect._transition_dangles_cache) >= RoundedRect.TRANSITION_DANGLES_CACHE_MAX_SIZE:
+                RoundedRect._transition_dangles_cache.clear()
+
+            straight_width = width - corner_radius * 2
+            straight_height = height - corner_radius * 2
 
-        atan_heights = [self._straight_height / 2, height / 2, height / 2, self._straight_height / 2, -self._straight_height / 2, -height / 2, -height / 2, -self._straight_height / 2]
-        atan_widths = [width / 2, self._straight_width / 2, -self._straight_width / 2, -width / 2, -width / 2, -self._straight_width / 2, self._straight_width / 2, width / 2]
-        self._transition_dangles = [math.degrees(math.atan2(atan_heights[i], atan_widths[i])) % 360 for i in range(8)]
+            atan_heights = [straight_height / 2, height / 2, height / 2, straight_height / 2, -straight_height / 2, -height / 2, -height / 2, -straight_height / 2]
+            atan_widths = [width / 2, straight_width / 2, -straight_width / 2, -width / 2, -width / 2, -straight_width / 2, straight_width / 2, width / 2]
+            transition_dangles = [math.degrees(math.atan2(atan_heights[i], atan_widths[i])) % 360 for i in range(8)]
 
-        if (self._transition_dangles[7] == 0):
-            self._transition_dangles[7] = 360
+            if (transition_dangles[7] == 0):
+                transition_dangles[7] = 360
+
+            RoundedRect._transition_dangles_cache[key] = tuple(transition_dangles)
+
+        return RoundedRect._transition_dangles_cache[key]
 
     def calculate_edge_pos(self, angle: float) -> (float, float):
         standard_dangle = math.degrees(angle) % 360
@@ -308,6 +381,47 @@ class RoundedRect(BasicShape):
         else:
             raise ValueError(f'RoundedRect._calculate_square_edge_pos: standard_dangle {standard_dangle} is invalid')
 
+    @staticmethod
+    def calculate_edge_positions(shapes: ['RoundedRect'], x: 'numpy.ndarray', y: 'numpy.ndarray', width: 'numpy.ndarray', height: 'numpy.ndarray', angle: 'numpy.ndarray') -> ('numpy.ndarray', 'numpy.ndarray'):
+        standard_dangle = numpy.degrees(angle) % 360
+        transition_dangles = numpy.fromiter(itertools.chain.from_iterable(shape._transition_dangles for shape in shapes), dtype=numpy.float64, count=len(shapes) * 8).reshape(-1, 8).T
+        corner_radius = numpy.array([shape._corner_radius for shape in shapes], dtype=numpy.float64)
+        straight_width = numpy.array([shape._straight_width for shape in shapes], dtype=numpy.float64)
+        straight_height = numpy.array([shape._straight_height for shape in shapes], dtype=numpy.float64)
+
+        right_tri_height, top_tri_width, left_tri_height, bottom_tri_width = _get_side_offsets(width, height, angle)
+        corner_dx = corner_radius * numpy.cos(angle)
+        corner_dy = corner_radius * numpy.sin(angle)
+
+        # the same eight sections as calculate_edge_pos, going around from the right side
+        sections = [
+            ((transition_dangles[7] <= standard_dangle) & (standard_dangle < 360)) | ((0 <= standard_dangle) & (standard_dangle < transition_dangles[0])),
+        ] + [(transition_dangles[i] <= standard_dangle) & (standard_dangle < transition_dangles[i + 1]) for i in range(7)]
+
+        edge_x = numpy.select(sections, [
+            x + width / 2,
+            x + straight_width / 2 + corner_dx,
+            x + top_tri_width,
+            x - straight_width / 2 + corner_dx,
+            x - width / 2,
+            x - straight_width / 2 + corner_dx,
+            x - bottom_tri_width,
+            x + straight_width / 2 + corner_dx,
+        ], numpy.nan)
+
+        edge_y = numpy.select(sections, [
+            y - right_tri_height,
+            y - straight_height / 2 - corner_dy,
+            y - height / 2,
+            y - straight_height / 2 - corner_dy,
+            y - left_tri_height,
+            y + straight_height / 2 - corner_dy,
+            y + height / 2,
+            y + straight_height / 2 - corner_dy,
+        ], numpy.nan)
+
+        return (edge_x, edge_y)
+
     def export(self) -> 'json':
         json = BasicShape.export(self)
 
@@ -330,19 +444,43 @@ class RoundedRect(BasicShape):
         '''
 
 
+def _get_side_offsets(width: 'numpy.ndarray', height: 'numpy.ndarray', angle: 'numpy.ndarray') -> ('numpy.ndarray',):
+    # how far along the right, top, left and bottom side (of a box width by height) angle meets it, for every angle.
+    # each one is worked out for every angle even though only one side is picked for it, so the others can divide by zero
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        return (
+            numpy.sin(angle) * (width / 2) / numpy.sin(numpy.pi / 2 - angle),
+            numpy.sin(numpy.pi / 2 - angle) * (height / 2) / numpy.sin(angle),
+            numpy.sin(numpy.pi - angle) * (width / 2) / numpy.sin(angle - numpy.pi / 2),
+            numpy.sin(3 * numpy.pi / 2 - angle) * (height / 2) / numpy.sin(angle - numpy.pi),
+        )
+
+
 class Arrow(SceneObject):
+    __slots__ = ('_tail_obj', '_head_obj', '_settings', '_old_tail_pos', '_old_head_pos', '_tail_edge_pos', '_head_edge_pos')
+
     HEAD = 'head'
     TAIL = 'tail'
 
+    # the batched version of each calculate_edge_pos, used by clip_all. a shape class that overrides calculate_edge_pos
+    # without a batched version of its own is clipped one shape at a time
+    EDGE_POS_KERNELS = {
+        BasicShape.calculate_edge_pos : BasicShape.calculate_edge_positions,
+        Square.calculate_edge_pos : Square.calculate_edge_positions,
+        Circle.calculate_edge_pos : Circle.calculate_edge_positions,
+        RoundedRect.calculate_edge_pos : RoundedRect.calculate_edge_positions,
+    }
+
     def __init__(self, tail_obj: BasicShape, head_obj: BasicShape, settings: ArrowSettings):
         self._tail_obj = tail_obj
         self._head_obj = head_obj
         self._settings = settings
 
-        # caching
+        # caching, with both edge positions in their own slots rather than a dict per arrow
         self._old_tail_pos = None
         self._old_head_pos = None
-        self._edge_pos_cache = {Arrow.HEAD: None, Arrow.TAIL: None}
+        self._tail_edge_pos = None
+        self._head_edge_pos = None
 
     def get_tail_pos(self) -> (float, float):
         return self._get_end_pos(Arrow.TAIL)
@@ -364,11 +502,9 @@ class Arrow(SceneObject):
 
     def _get_end_pos(self, side: str, say_cached = False) -> (float, float):
         if side == Arrow.TAIL:
-            edge_angle = self.get_tail_angle()
             arrow_position = self._settings.tail_position
             base_obj = self._tail_obj
         elif side == Arrow.HEAD:
-            edge_angle = self.get_head_angle()
             arrow_position = self._settings.head_position
             base_obj = self._head_obj
         else:
@@ -380,14 +516,91 @@ class Arrow(SceneObject):
             if self._old_tail_pos == self._tail_obj.get_pos() and self._old_head_pos == self._head_obj.get_pos():
                 if say_cached:
                     return 'cached'
-
-                return self._edge_pos_cache[side]
             else:
                 self._old_tail_pos = self._tail_obj.get_pos()
                 self._old_head_pos = self._head_obj.get_pos()
-                self._edge_pos_cache[Arrow.TAIL] = self._tail_obj.calculate_edge_pos(self.get_tail_angle())
-                self._edge_pos_cache[Arrow.HEAD] = self._head_obj.calculate_edge_pos(self.get_head_angle())
-                return self._edge_pos_cache[side]
+                self._tail_edge_pos = self._tail_obj.calculate_edge_pos(self.get_tail_angle())
+                self._head_edge_pos = self._head_obj.calculate_edge_pos(self.get_head_angle())
+
+            return self._tail_edge_pos if side == Arrow.TAIL else self._head_edge_pos
+
+    @staticmethod
+    def clip_all(arrows: ['Arrow']) -> None:
+        '''Work out the edge end points of every arrow at once with numpy, which fills each arrow's cache with the same points
+        it would have worked out itself (does nothing without numpy, arrows just work theirs out when they're asked)'''
+
+        if numpy == None or len(arrows) == 0:
+            return
+
+        tails = [arrow._tail_obj for arrow in arrows]
+        heads = [arrow._head_obj for arrow in arrows]
+        tail_x, tail_y, tail_width, tail_height = BasicShape.gather_geometry(tails)
+        head_x, head_y, head_width, head_height = BasicShape.gather_geometry(heads)
+
+        # arrows with an end that isn't positioned yet are left alone, to fail on their own if anything asks for their ends
+        positioned = ~(numpy.isnan(tail_x) | numpy.isnan(tail_y) | numpy.isnan(head_x) | numpy.isnan(head_y))
+
+        # only the ends that are drawn at the edge are clipped, the cache is never asked for the others
+        tail_ends = numpy.flatnonzero(positioned & numpy.fromiter((arrow._settings.tail_position == ArrowSettings.EDGE for arrow in arrows), dtype=bool, count=len(arrows)))
+        head_ends = numpy.flatnonzero(positioned & numpy.fromiter((arrow._settings.head_position == ArrowSettings.EDGE for arrow in arrows), dtype=bool, count=len(arrows)))
+
+        edge_x, edge_y = Arrow._calculate_edge_positions(
+            [tails[i] for i in tail_ends.tolist()] + [heads[i] for i in head_ends.tolist()],
+            numpy.concatenate((tail_x[tail_ends], head_x[head_ends])),
+            numpy.concatenate((tail_y[tail_ends], head_y[head_ends])),
+            numpy.concatenate((tail_width[tail_ends], head_width[head_ends])),
+            numpy.concatenate((tail_height[tail_ends], head_height[head_ends])),
+            numpy.concatenate((
+                numpy.arctan2(tail_y[tail_ends] - head_y[tail_ends], head_x[tail_ends] - tail_x[tail_ends]),
+                numpy.arctan2(head_y[head_ends] - tail_y[head_ends], tail_x[head_ends] - head_x[head_ends]),
+            )),
+        )
+
+        edge_pos = list(zip(edge_x.tolist(), edge_y.tolist()))
+        tail_edge_pos = [None] * len(arrows)
+        head_edge_pos = [None] * len(arrows)
+
+        for (end, i) in enumerate(tail_ends.tolist()):
+            tail_edge_pos[i] = edge_pos[end]
+
+        for (end, i) in enumerate(head_ends.tolist(), len(tail_ends)):
+            head_edge_pos[i] = edge_pos[end]
+
+        # the cache is keyed on the positions the ends were worked out for, which is where both ends are now
+        old_tail_pos = zip(tail_x.tolist(), tail_y.tolist())
+        old_head_pos = zip(head_x.tolist(), head_y.tolist())
+
+        for arrow, arrow_positioned, tail_pos, head_pos, tail_edge, head_edge in zip(arrows, positioned.tolist(), old_tail_pos, old_head_pos, tail_edge_pos, head_edge_pos):
+            if arrow_positioned:
+                arrow._old_tail_pos = tail_pos
+                arrow._old_head_pos = head_pos
+                arrow._tail_edge_pos = tail_edge
+                arrow._head_edge_pos = head_edge
+
+    @staticmethod
+    def _calculate_edge_positions(shapes: [BasicShape], x: 'numpy.ndarray', y: 'numpy.ndarray', width: 'numpy.ndarray', height: 'numpy.ndarray', angle: 'numpy.ndarray') -> ('numpy.ndarray', 'numpy.ndarray'):
+        edge_x = numpy.full(len(shapes), numpy.nan)
+        edge_y = numpy.full(len(shapes), numpy.nan)
+
+        # each class's shapes go through its kernel together
+        batches = defaultdict(list)
+
+        for (i, shape) in enumerate(shapes):
+            batches[type(shape)].append(i)
+
+        for shape_class, indices in batches.items():
+            kernel = Arrow.EDGE_POS_KERNELS.get(shape_class.calculate_edge_pos)
+
+            if kernel != None:
+                batch_shapes = [shapes[i] for i in indices]
+                indices = numpy.array(indices, dtype=numpy.intp)
+                edge_x[indices], edge_y[indices] = kernel(batch_shapes, x[indices], y[indices], width[indices], height[indices], angle[indices])
+
+        # shapes without a kernel, and angles a kernel couldn't place (where calculate_edge_pos raises), go one by one
+        for i in numpy.flatnonzero(numpy.isnan(edge_x) | numpy.isnan(edge_y)).tolist():
+            edge_x[i], edge_y[i] = shapes[i].calculate_edge_pos(float(angle[i]))
+
+        return (edge_x, edge_y)
 
     def get_tail_angle(self) -> float:
         return math.atan2(self._tail_obj.get_y() - self._head_obj.get_y(), self._head_obj.get_x() - self._tail_obj.get_x())
@@ -397,12 +610,14 @@ class Arrow(SceneObject):
 
     def export(self) -> 'json':
         json = SceneObject.export(self)
+        tail_x, tail_y = self.get_tail_pos()
+        head_x, head_y = self.get_head_pos()
 
         add_json = {
-            'tail_x': self.get_tail_x(),
-            'tail_y': self.get_tail_y(),
-            'head_x': self.get_head_x(),
-            'head_y': self.get_head_y(),
+            'tail_x': tail_x,
+            'tail_y': tail_y,
+            'head_x': head_x,
+            'head_y': head_y,
             'arrow_type': self._settings.arrow_type,
         }
 
@@ -425,6 +640,8 @@ class Arrow(SceneObject):
 
 # we should make this just an iter
 class CollectionContents:
+    __slots__ = ()
+
     def __len__(self) -> int:
         pass
 
@@ -433,6 +650,8 @@ class CollectionContents:
 
 
 class Collection(RoundedRect):
+    __slots__ = ('_contents', '_settings')
+
     def construct(self, header: str, contents: CollectionContents, settings: CollectionSettings):
         self._contents = contents
         self._settings = settings
@@ -483,6 +702,8 @@ class Collection(RoundedRect):
 
 
 class Container(RoundedRect):
+    __slots__ = ('_coll', '_hmargin', '_vmargin')
+
     H_MARGIN = 5
     V_MARGIN = 5
 
@@ -505,6 +726,10 @@ class Container(RoundedRect):
 
 
 class Scene:
+    # scenes with fewer arrows than this clip each one as it's exported, since a batch has a fixed cost of its own that
+    # only pays off after a couple hundred arrows
+    BATCH_CLIP_MIN_ARROWS = 256
+
     def __init__(self):
         self._directory: {str : SceneObject} = {}
 
@@ -514,7 +739,17 @@ class Scene:
     def gps(self) -> None:
         pass
 
+    def clip_arrows(self) -> None:
+        '''Work out every arrow's end points in one batch if there are enough of them for it to pay off (and numpy is installed)'''
+
+        arrows = [scene_obj for scene_obj in self._directory.values() if isinstance(scene_obj, Arrow)]
+
+        if len(arrows) >= Scene.BATCH_CLIP_MIN_ARROWS:
+            Arrow.clip_all(arrows)
+
     def export(self) -> dict:
+        self.clip_arrows()
+
         return {
             'width' : self._width,
             'height' : self._height,
@@ -522,6 +757,7 @@ class Scene:
         }
 
     def svg(self) -> str:
+        self.clip_arrows()
         indent = '\n\t'
 
         return f'''
@@ -548,11 +784,22 @@ class Snapshot:
 
     def export(self, scene_format='json'):
         if scene_format == 'json':
-            scene_data = {name : scene.export() for name, scene in self._scenes.items()}
+            export_scene = lambda scene: scene.export()
         elif scene_format == 'svg':
-            scene_data = {name : scene.svg() for name, scene in self._scenes.items()}
+            export_scene = lambda scene: scene.svg()
         else:
-            scene_data = {} # eventually throw error but that's not a priority
+            export_scene = None # eventually throw error but that's not a priority
+
+        # a scene shared under more than one name is only exported once
+        exported = {}
+        scene_data = {}
+
+        if export_scene != None:
+            for name, scene in self._scenes.items():
+                if id(scene) not in exported:
+                    exported[id(scene)] = export_scene(scene)
+
+                scene_data[name] = exported[id(scene)]
 
         json = {
             'scenes' : scene_data,
@@ -0,0 +1,43 @@
+import utils
+utils.setup_pythonpath_for_tests()
+
+from diagrammer.python import engine
+
+import sys
+import time
+
+
+# loop-heavy programs where most lines aren't flagged, so the cost is dominated by how capture hooks into execution
+PROGRAMS = {
+    'flat loop' : ('total = 0\nfor i in range(200000):\n\ttotal += i\nresult = total', [3]),
+    'nested loop' : ('total = 0\nfor i in range(400):\n\tfor j in range(400):\n\t\ttotal += i * j\nresult = total', [4]),
+    'unflagged function' : ('def f(n):\n\treturn n * 2\ntotal = 0\nfor i in range(100000):\n\ttotal += f(i)\nresult = total', [5]),
+    'flagged loop body' : ('l = []\nfor i in range(50):\n\tl.append(i)\n\tx = sum(l)', [3]),
+}
+
+REPEATS = 5
+
+
+def time_run(capture_mode: str, code: str, flags: [int]) -> float:
+    py_engine = engine.PythonEngine(engine.PyEngineSettings(capture_mode=capture_mode))
+    best = None
+
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        py_engine.run(code, flags)
+        elapsed = time.perf_counter() - start
+
+        best = elapsed if best == None else min(best, elapsed)
+
+    return best
+
+
+if __name__ == '__main__':
+    backend = 'sys.monitoring' if hasattr(sys, 'monitoring') else 'sys.settrace'
+    print(f'python {sys.version.split()[0]}, trace backend: {backend}, best of {REPEATS}')
+    print(f'{"program":<22}{"rewrite (ms)":>14}{"trace (ms)":>14}')
+
+    for name, (code, flags) in PROGRAMS.items():
+        rewrite_time = time_run(engine.PyEngineSettings.REWRITE, code, flags)
+        trace_time = time_run(engine.PyEngineSettings.TRACE, code, flags)
+        print(f'{name:<22}{rewrite_time * 1000:>14.2f}{trace_time * 1000:>14.2f}')
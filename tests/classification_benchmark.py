@@ -0,0 +1,101 @@
+import utils
+utils.setup_pythonpath_for_tests()
+
+from diagrammer.python import engine
+from diagrammer.python import utils as py_utils
+
+import collections
+import sys
+import time
+import types
+
+
+REPEATS = 5
+
+
+class Node:
+    def __init__(self, value: int, children: list):
+        self.value = value
+        self.children = children
+
+
+def build_heap() -> dict:
+    # a mix of what programs usually hold: basic values, collections and instances of their own classes
+    return {
+        'numbers' : list(range(20000)),
+        'words' : {f'word{i}' : f'{i}' for i in range(5000)},
+        'points' : [(i, i * 2.5) for i in range(5000)],
+        'tree' : [Node(i, [Node(j, []) for j in range(5)]) for i in range(1000)],
+        'ordered' : collections.OrderedDict((i, {i}) for i in range(2000)),
+    }
+
+
+def classify_per_object(obj: object) -> tuple:
+    # what classification cost before the cache: the type lists were rebuilt and scanned for every object, and
+    # is_basic_value scanned the collection types a second time
+    special_cases = [types.FunctionType, types.BuiltinFunctionType, types.MethodDescriptorType,
+        types.WrapperDescriptorType, types.MethodWrapperType, types.ClassMethodDescriptorType]
+    base_collection_types = {
+        'linear' : {
+            'ordered' : [list, tuple],
+            'unordered' : [set],
+        },
+
+        'mapping' : {
+            'ordered' : [collections.OrderedDict],
+            'unordered' : [dict, types.MappingProxyType],
+        }
+    }
+
+    def is_collection(obj: object) -> tuple:
+        if any(isinstance(obj, collection_type) for collection_type in base_collection_types['linear']['ordered']):
+            return (py_utils.CollectionTypes.LINEAR, py_utils.CollectionTypes.ORDERED)
+        elif any(isinstance(obj, collection_type) for collection_type in base_collection_types['linear']['unordered']):
+            return (py_utils.CollectionTypes.LINEAR, py_utils.CollectionTypes.UNORDERED)
+        elif any(isinstance(obj, collection_type) for collection_type in base_collection_types['mapping']['ordered']):
+            return (py_utils.CollectionTypes.MAPPING, py_utils.CollectionTypes.ORDERED)
+        elif any(isinstance(obj, collection_type) for collection_type in base_collection_types['mapping']['unordered']):
+            return (py_utils.CollectionTypes.MAPPING, py_utils.CollectionTypes.ORDERED)
+        else:
+            return None
+
+    is_basic = type(obj) in special_cases or (not is_collection(obj) and not hasattr(obj, '__dict__'))
+    return (is_basic, is_collection(obj), hasattr(obj, '__dict__'))
+
+
+def time_capture(heap: dict) -> float:
+    py_engine = engine.PythonEngine()
+    best = None
+
+    for _ in range(REPEATS):
+        py_utils.clear_type_cache() # every walk starts cold, like every run does
+        start = time.perf_counter()
+
+        objects = {}
+        budget = engine.CaptureBudget()
+
+        for obj in heap.values():
+            py_engine.generate_table_for_obj(obj, objects, budget=budget)
+
+        elapsed = time.perf_counter() - start
+        best = elapsed if best == None else min(best, elapsed)
+
+    return best
+
+
+if __name__ == '__main__':
+    heap = build_heap()
+    cached_time = time_capture(heap)
+
+    orig_classify = py_utils.classify
+    py_utils.classify = classify_per_object
+
+    try:
+        per_object_time = time_capture(heap)
+    finally:
+        py_utils.classify = orig_classify
+
+    print(f'python {sys.version.split()[0]}, capture walk over {sum(len(obj) for obj in heap.values())} top level elements, best of {REPEATS}')
+    print(f'{"classified per object (ms)":<40}{per_object_time * 1000:>10.2f}')
+    print(f'{"classified per type (ms)":<40}{cached_time * 1000:>10.2f}')
+    print(f'{"speedup":<40}{per_object_time / cached_time:>10.2f}x')
@@ -0,0 +1,63 @@
+import utils
+utils.setup_pythonpath_for_tests()
+
+from diagrammer import python as py_diagrammer
+from diagrammer.python import engine
+
+import builtins
+import os
+import subprocess
+import sys
+import time
+import types
+
+
+CODE = 'x = 1\ny = [x, 2]\nprint(y)'
+FLAGS = [1]
+REQUESTS = 50
+
+
+def time_requests(run_request: 'callable()', requests: int = REQUESTS) -> float:
+    start = time.perf_counter()
+
+    for _ in range(requests):
+        run_request()
+
+    return (time.perf_counter() - start) / requests
+
+
+def build_builtins_per_run() -> types.ModuleType:
+    # what every PythonEngine.run used to do before the sandbox builtins were prebuilt
+    exec_builtins = types.ModuleType('__builtins__')
+
+    for key, value in builtins.__dict__.items():
+        exec_builtins.__dict__[key] = value
+
+    for name in engine.PythonEngine.BLOCKED_BUILTINS:
+        exec_builtins.__dict__[name] = engine.BlockedConstruct(name)
+
+    return exec_builtins
+
+
+def copy_builtins_template() -> types.ModuleType:
+    exec_builtins = types.ModuleType('__builtins__')
+    exec_builtins.__dict__.update(engine.PythonEngine.get_sandbox_builtins())
+    return exec_builtins
+
+
+if __name__ == '__main__':
+    workspace = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    fresh_process_cmd = [sys.executable, '-c', f'from diagrammer import python\npython.generate_diagrams_for_code({CODE!r}, {FLAGS!r})']
+
+    def run_fresh_process():
+        subprocess.run(fresh_process_cmd, cwd=workspace, check=True)
+
+    server = py_diagrammer.ForkServer()
+    server.warm_up()
+
+    print(f'python {sys.version.split()[0]}, mean of {REQUESTS} requests')
+    print(f'{"sandbox builtins per run (us)":<40}{time_requests(build_builtins_per_run, 10000) * 1e6:>10.2f}')
+    print(f'{"sandbox builtins from template (us)":<40}{time_requests(copy_builtins_template, 10000) * 1e6:>10.2f}')
+    print(f'{"fresh interpreter per request (ms)":<40}{time_requests(run_fresh_process) * 1000:>10.2f}')
+    print(f'{"fork server per request (ms)":<40}{time_requests(lambda: server.run(CODE, FLAGS)) * 1000:>10.2f}')
+    print(f'{"in-process, no isolation (ms)":<40}{time_requests(lambda: py_diagrammer.generate_diagrams_for_code(CODE, FLAGS)) * 1000:>10.2f}')
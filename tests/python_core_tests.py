@@ -4,9 +4,18 @@ utils.setup_pythonpath_for_tests()
 from diagrammer import python as py_diagrammer
 
 import unittest
+import asyncio
+import contextlib
+import gc
 import json
+import io
+import multiprocessing
+import os
+import pickle
 import sys
+import time
 import re
+import tempfile
 
 
 class DiagrammerPythonCoreTests(unittest.TestCase):
@@ -22,6 +31,9 @@ class DiagrammerPythonCoreTests(unittest.TestCase):
         self.assertEqual(diagram_data[0]['output'], '')
         self.assertEqual(diagram_data[0]['error'], '')
 
+        # the module level scene is built once and shows up under both names
+        self.assertEqual(diagram_data[0]['scenes']['locals'], diagram_data[0]['scenes']['globals'])
+
 
     def test_conditional_diagram_generation(self):
         diagram_data = py_diagrammer.generate_diagrams_for_code('if True:\n\tx = 1', [1])
@@ -44,6 +56,20 @@ class DiagrammerPythonCoreTests(unittest.TestCase):
             self.assertEqual(diagram['output'], '')
             self.assertEqual(diagram['error'], '')
 
+        # delta encoded snapshots are materialized again before they're turned into diagrams
+        delta_diagram_data = py_diagrammer.generate_diagrams_for_code('for i in range(5):\n\tpass', [1], delta_snapshots=True)
+        self.assertEqual(delta_diagram_data, diagram_data)
+
+    def test_unchanged_diagram_generation(self):
+        code = 'x = [1]\nprint("a")\nprint("b")\nx.append(2)'
+        diagram_data = py_diagrammer.generate_diagrams_for_code(code, [0, 1, 2, 3])
+
+        # skipped snapshots come out as the same diagrams, only without being built again
+        for settings in [{}, {'delta_snapshots' : True}]:
+            self.assertEqual(py_diagrammer.generate_diagrams_for_code(code, [0, 1, 2, 3], skip_unchanged=True, **settings), diagram_data)
+
+        self.assertEqual(list(py_diagrammer.iter_diagrams_for_code(code, [0, 1, 2, 3], skip_unchanged=True)), diagram_data)
+
 
     def test_collection_iterative_diagram_generation(self):
         diagram_data = py_diagrammer.generate_diagrams_for_code('l = []\nfor i in range(5):\n\tl.append(i)', [2])
@@ -88,6 +114,382 @@ class DiagrammerPythonCoreTests(unittest.TestCase):
 
 
 
+    def test_capture_budget_generation(self):
+        diagram_data = py_diagrammer.generate_diagrams_for_code('l = list(range(100000))', [0], max_elements=6)
+
+        self.assertEqual(len(diagram_data), 2)
+
+        # six cells for elements plus one for the ellipsis
+        cells = [obj for obj in diagram_data[0]['scenes']['globals']['contents'] if obj.get('shape') == 'square' and obj['header']['text'] != 'l']
+        self.assertEqual(len(cells), 7)
+        self.assertIn('+99994', [cell['header']['text'] for cell in cells])
+
+
+    def test_batch_diagram_generation(self):
+        jobs = [(f'x = {i}\nprint(x)', [0]) for i in range(6)]
+        results = list(py_diagrammer.generate_diagrams_batch(jobs, workers=2))
+
+        self.assertEqual([result.index for result in results], list(range(6)))
+
+        for i, result in enumerate(results):
+            self.assertTrue(result.is_ok())
+            self.assertEqual(result.diagrams, py_diagrammer.generate_diagrams_for_code(*jobs[i]))
+            self.assertEqual(result.diagrams[-1]['output'], f'{i}\n')
+            self.assertGreater(result.run_time, 0)
+            self.assertNotEqual(result.worker_pid, None)
+
+
+    def test_batch_as_completed(self):
+        # the slow job goes first, so it shouldn't come back first
+        jobs = [('total = 0\nfor i in range(3000000):\n\ttotal += i', [0])] + [('x = 1', [0])] * 3
+        results = list(py_diagrammer.generate_diagrams_batch(jobs, workers=2, ordered=False))
+
+        self.assertEqual(sorted(result.index for result in results), [0, 1, 2, 3])
+        self.assertNotEqual(results[0].index, 0)
+
+
+    def test_batch_job_error(self):
+        # errors in the submitted code are part of the diagrams, while engine failures are reported on the result
+        jobs = [('raise ValueError()', [0]), ('x = 1', [0])]
+        results = list(py_diagrammer.generate_diagrams_batch(jobs, workers=2, capture_mode='invalid'))
+
+        self.assertFalse(results[0].is_ok())
+        self.assertEqual(results[0].diagrams, None)
+        self.assertIn('invalid', results[0].error)
+
+        results = list(py_diagrammer.generate_diagrams_batch(jobs, workers=2))
+
+        self.assertTrue(results[0].is_ok())
+        self.assertNotEqual(results[0].diagrams[-1]['error'], '')
+
+
+    def test_fork_server(self):
+        server = py_diagrammer.ForkServer()
+        result = server.run('x = 1\nprint(x)', [0])
+
+        self.assertTrue(result.is_ok())
+        self.assertEqual(result.diagrams, py_diagrammer.generate_diagrams_for_code('x = 1\nprint(x)', [0]))
+        self.assertNotEqual(result.worker_pid, os.getpid())
+
+        # every job gets a fresh child, so changes to builtins don't carry over
+        results = list(server.run_many([('__builtins__.len = None', [0]), ('x = len([1])', [0])], workers=2))
+
+        self.assertEqual([result.index for result in results], [0, 1])
+        self.assertEqual(results[1].diagrams[-1]['error'], '')
+        self.assertNotEqual(results[0].worker_pid, results[1].worker_pid)
+
+        # only the children run with the gc frozen, the server's own objects can still be collected
+        if hasattr(gc, 'get_freeze_count'):
+            self.assertEqual(gc.get_freeze_count(), 0)
+
+
+    def test_fork_server_unreadable_result(self):
+        server = py_diagrammer.ForkServer()
+        result_data = pickle.dumps(py_diagrammer.BatchResult(0, [], None, 0.0, 1))
+
+        # a result cut off partway, and one naming something other than a result (which is never called)
+        for chunks in [[result_data[:len(result_data) // 2]], [pickle.dumps(os.getcwd)]]:
+            pid = os.fork()
+
+            if pid == 0:
+                os._exit(0)
+
+            forked_job = py_diagrammer.forkserver._ForkedJob(4, pid, -1)
+            forked_job.chunks = chunks
+            result = server._collect_job(forked_job)
+
+            self.assertFalse(result.is_ok())
+            self.assertEqual(result.index, 4)
+            self.assertTrue(result.error.startswith('worker sent a result that couldn\'t be read'), result.error)
+
+
+    def test_fork_server_crashed_worker(self):
+        server = py_diagrammer.ForkServer()
+        results = list(server.run_many([('import os\nos._exit(3)', [0]), ('x = 1', [0])], workers=2, ordered=False))
+
+        self.assertEqual(sorted(result.index for result in results), [0, 1])
+
+        for result in results:
+            self.assertEqual(result.is_ok(), result.index == 1)
+
+
+    def test_fork_server_limits(self):
+        loop_code = 'x = 1\nl = []\nwhile True:\n\tl.append(str(x))'
+        limits = {
+            py_diagrammer.ResourceLimits.CPU : py_diagrammer.ResourceLimits(max_cpu_time=0.2),
+            py_diagrammer.ResourceLimits.WALL : py_diagrammer.ResourceLimits(max_wall_time=0.2),
+            py_diagrammer.ResourceLimits.MEMORY : py_diagrammer.ResourceLimits(max_memory=256 * 2 ** 20),
+        }
+
+        for limit, resource_limits in limits.items():
+            result = py_diagrammer.ForkServer(limits=resource_limits).run(loop_code, [0])
+
+            # the snapshot from before the loop survives, followed by the error snapshot
+            self.assertEqual(result.limit_exceeded, limit)
+            self.assertEqual(result.error, f'ResourceLimitExceeded: {resource_limits.get_message(limit)}')
+            self.assertEqual(len(result.diagrams), 2)
+            self.assertEqual(result.diagrams[-1]['error'], f'{result.error}\n')
+
+
+    def test_fork_server_kills_ignored_limits(self):
+        # the limit error is swallowed over and over, so the child has to be killed from outside
+        swallow_code = 'while True:\n\ttry:\n\t\twhile True:\n\t\t\tpass\n\texcept:\n\t\tpass'
+        result = py_diagrammer.ForkServer(limits=py_diagrammer.ResourceLimits(max_cpu_time=0.2), capture_mode='ast').run(swallow_code, [0])
+
+        self.assertEqual(result.limit_exceeded, py_diagrammer.ResourceLimits.CPU)
+        self.assertEqual(result.diagrams, None)
+        self.assertLess(result.run_time, 5)
+
+
+    def test_batch_limits_and_recycling(self):
+        jobs = [('x = 1\nwhile True:\n\tx += 1', [0]), ('x = 1', [0]), ('y = 2', [0])]
+        results = list(py_diagrammer.generate_diagrams_batch(jobs, workers=1, limits=py_diagrammer.ResourceLimits(max_cpu_time=0.2), max_jobs_per_worker=2))
+
+        self.assertEqual(results[0].limit_exceeded, py_diagrammer.ResourceLimits.CPU)
+        self.assertEqual(len(results[0].diagrams), 2)
+        self.assertTrue(results[1].is_ok())
+        self.assertTrue(results[2].is_ok())
+
+        # the single worker is replaced after two jobs
+        self.assertEqual(results[0].worker_pid, results[1].worker_pid)
+        self.assertNotEqual(results[1].worker_pid, results[2].worker_pid)
+
+
+    def test_batch_kills_ignored_limits(self):
+        # neither of these can be stopped from inside the worker: the first swallows the limit error over and over, and
+        # the second never gets back to the interpreter for the error to be raised
+        jobs = [
+            ('x = 1\nwhile True:\n\ttry:\n\t\twhile True:\n\t\t\tpass\n\texcept BaseException:\n\t\tpass', [0]),
+            ('x = sum(range(10 ** 11))', [0]),
+            ('y = 2', [0]),
+        ]
+
+        for limit, resource_limits in [(py_diagrammer.ResourceLimits.WALL, py_diagrammer.ResourceLimits(max_wall_time=0.2, max_cpu_time=0.2)), (py_diagrammer.ResourceLimits.CPU, py_diagrammer.ResourceLimits(max_cpu_time=0.2))]:
+            results = list(py_diagrammer.generate_diagrams_batch(jobs, workers=1, limits=resource_limits))
+
+            self.assertEqual([result.limit_exceeded for result in results], [limit, limit, None])
+            self.assertEqual(results[0].diagrams, None)
+            self.assertTrue(results[2].is_ok())
+
+            # each killed worker is replaced by a fresh one
+            self.assertEqual(len({result.worker_pid for result in results}), 3)
+
+
+    def test_streamed_diagram_generation(self):
+        code = 'l = []\nfor i in range(4):\n\tl.append(i)\n\tprint(i)'
+
+        for capture_mode in ['ast', 'trace', 'rewrite']:
+            streamed = []
+            consumer_output = io.StringIO()
+
+            with contextlib.redirect_stdout(consumer_output):
+                for diagram in py_diagrammer.iter_diagrams_for_code(code, [2], capture_mode=capture_mode):
+                    # the program runs in its own process, so this never ends up in its output
+                    print('consumer output')
+                    streamed.append(diagram)
+
+            self.assertEqual(streamed, py_diagrammer.generate_diagrams_for_code(code, [2], capture_mode=capture_mode))
+            self.assertEqual(consumer_output.getvalue(), 'consumer output\n' * 5)
+
+
+    def test_streamed_diagrams_before_finish(self):
+        # the program never finishes, so the first diagram can only come out while it's still running
+        programs = {
+            'loop' : 'x = 1\nwhile True:\n\tx += 1',
+            'swallowing loop' : 'x = 1\nwhile True:\n\ttry:\n\t\tx += 1\n\texcept:\n\t\tpass',
+        }
+
+        for name, code in programs.items():
+            diagrams = py_diagrammer.iter_diagrams_for_code(code, [0])
+            self.assertEqual(next(diagrams)['error'], '')
+
+            # closing the stream kills the program instead of leaving it running in the background
+            diagrams.close()
+
+            self.assertEqual(multiprocessing.active_children(), [], name)
+            self.assertIs(sys.stdout, sys.__stdout__)
+
+
+    def test_streamed_limits(self):
+        loop_code = 'x = 1\nwhile True:\n\tpass'
+
+        for limit, resource_limits in [(py_diagrammer.ResourceLimits.CPU, py_diagrammer.ResourceLimits(max_cpu_time=0.2)), (py_diagrammer.ResourceLimits.WALL, py_diagrammer.ResourceLimits(max_wall_time=0.2))]:
+            streamed = []
+
+            # the diagram from before the loop comes out first, and the limit is raised after it
+            with self.assertRaises(py_diagrammer.JobFailed) as context:
+                for diagram in py_diagrammer.iter_diagrams_for_code(loop_code, [0], limits=resource_limits, capture_mode='ast'):
+                    streamed.append(diagram)
+
+            self.assertEqual(context.exception.limit_exceeded, limit)
+            self.assertEqual(len(streamed), 2 if limit == py_diagrammer.ResourceLimits.CPU else 1)
+            self.assertEqual(multiprocessing.active_children(), [])
+
+
+    def test_async_diagram_generation(self):
+        async def generate():
+            pool = py_diagrammer.AsyncDiagramPool(max_workers=2, max_waiting=2)
+            results = await asyncio.gather(*[pool.generate_diagrams(f'x = {i}\nprint(x)', [0]) for i in range(4)])
+
+            # two running and two waiting is as far as the pool goes
+            saturated_results = await asyncio.gather(*[pool.generate_diagrams('x = 1', [0]) for _ in range(5)], return_exceptions=True)
+            self.assertEqual([type(result) for result in saturated_results], [py_diagrammer.BatchResult] * 4 + [py_diagrammer.PoolSaturated])
+
+            streamed = [diagram async for diagram in pool.stream_diagrams('for i in range(3):\n\tprint(i)', [1])]
+            return results, streamed
+
+        results, streamed = asyncio.run(generate())
+
+        for i, result in enumerate(results):
+            self.assertTrue(result.is_ok())
+            self.assertEqual(result.diagrams, py_diagrammer.generate_diagrams_for_code(f'x = {i}\nprint(x)', [0]))
+
+        self.assertEqual(streamed, py_diagrammer.generate_diagrams_for_code('for i in range(3):\n\tprint(i)', [1]))
+
+
+    def test_async_cancellation(self):
+        async def cancel():
+            pool = py_diagrammer.AsyncDiagramPool(max_workers=1, capture_mode='ast')
+
+            job = asyncio.ensure_future(pool.generate_diagrams('while True:\n\tpass', [0]))
+            await asyncio.sleep(0.5)
+            job.cancel()
+
+            with self.assertRaises(asyncio.CancelledError):
+                await job
+
+            # the only slot is free again, so this doesn't wait on the cancelled job
+            stream = pool.stream_diagrams('x = 0\nwhile True:\n\tx += 1', [2])
+            await stream.__anext__()
+            await stream.aclose()
+
+            return pool.get_running_count()
+
+        self.assertEqual(asyncio.run(cancel()), 0)
+
+        # both job processes were killed rather than left running
+        self.assertEqual(multiprocessing.active_children(), [])
+
+
+    def test_async_limits(self):
+        async def run_limited():
+            pool = py_diagrammer.AsyncDiagramPool(limits=py_diagrammer.ResourceLimits(max_cpu_time=0.2, max_wall_time=0.5))
+            result = await pool.generate_diagrams('x = 1\nwhile True:\n\tpass', [0])
+
+            streamed = []
+
+            with self.assertRaises(py_diagrammer.JobFailed) as context:
+                async for diagram in pool.stream_diagrams('x = 1\nwhile True:\n\tpass', [0]):
+                    streamed.append(diagram)
+
+            return result, streamed, context.exception
+
+        result, streamed, failure = asyncio.run(run_limited())
+
+        self.assertEqual(result.limit_exceeded, py_diagrammer.ResourceLimits.CPU)
+        self.assertEqual(len(result.diagrams), 2)
+        self.assertEqual(len(streamed), 2)
+        self.assertEqual(failure.limit_exceeded, py_diagrammer.ResourceLimits.CPU)
+
+    def test_async_stream_kills_ignored_limits(self):
+        async def stream(code: str) -> py_diagrammer.JobFailed:
+            pool = py_diagrammer.AsyncDiagramPool(limits=py_diagrammer.ResourceLimits(max_cpu_time=0.2))
+
+            with self.assertRaises(py_diagrammer.JobFailed) as context:
+                async for diagram in pool.stream_diagrams(code, [0]):
+                    pass
+
+            return context.exception
+
+        # without a wall limit these are only stopped by the deadline the pool keeps for each stream
+        for code in ['x = 1\nwhile True:\n\ttry:\n\t\twhile True:\n\t\t\tpass\n\texcept BaseException:\n\t\tpass', 'x = sum(range(10 ** 11))']:
+            self.assertEqual(asyncio.run(stream(code)).limit_exceeded, py_diagrammer.ResourceLimits.CPU)
+            self.assertEqual(multiprocessing.active_children(), [])
+
+    def test_result_cache(self):
+        cache = py_diagrammer.ResultCache(10 ** 6)
+        code = 'x = [1, 2]\nprint(x)'
+
+        diagram_data = py_diagrammer.generate_diagrams_for_code(code, [0], result_cache=cache)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(py_diagrammer.generate_diagrams_for_code(code, [0], result_cache=cache), diagram_data)
+        self.assertEqual(py_diagrammer.generate_diagrams_for_code(code, [0]), diagram_data)
+
+        # anything that goes into the result is part of the key
+        py_diagrammer.generate_diagrams_for_code(code, [1], result_cache=cache)
+        py_diagrammer.generate_diagrams_for_code(code, [0], result_cache=cache, max_elements=1)
+        py_diagrammer.generate_diagrams_for_code(code, [0], 'svg', result_cache=cache)
+        self.assertEqual(len(cache), 4)
+
+        self.assertEqual(py_diagrammer.ResultCache.make_key(code, [0], 'json', {}), py_diagrammer.ResultCache.make_key(code, {0 : None}, 'json', {}))
+        self.assertEqual(py_diagrammer.ResultCache.make_key(code, {0 : py_diagrammer.engine.FlagPolicy(every_nth=2)}, 'json', {}), py_diagrammer.ResultCache.make_key(code, {0 : py_diagrammer.engine.FlagPolicy(every_nth=2)}, 'json', {}))
+
+    def test_result_cache_nondeterminism(self):
+        cache = py_diagrammer.ResultCache(10 ** 6)
+
+        for code in ['import random\nx = random.random()', 'from time import time\nx = time()', 'x = id(1)', 'x = eval("1")', 'x = {"a", "b"}', 'x = set("ab")', 'x = {c for c in "ab"}']:
+            self.assertFalse(py_diagrammer.ResultCache.is_cacheable(code))
+            py_diagrammer.generate_diagrams_for_code(code, [0], result_cache=cache)
+
+        # an object's default repr has its address in it
+        py_diagrammer.generate_diagrams_for_code('class A:\n\tpass\nprint(A())', [2], result_cache=cache)
+        self.assertEqual(len(cache), 0)
+
+        # a capture cut off by its time budget isn't reproducible either, but one that finished in time is
+        py_diagrammer.generate_diagrams_for_code('x = [1, 2]', [0], result_cache=cache, max_capture_time=0)
+        self.assertEqual(len(cache), 0)
+        py_diagrammer.generate_diagrams_for_code('x = [1, 2]', [0], result_cache=cache, max_capture_time=60)
+        self.assertEqual(len(cache), 1)
+
+    def test_result_cache_bypasses(self):
+        # each of these reaches something nondeterministic without naming it directly
+        bypasses = [
+            'import importlib\nx = importlib.import_module("random").random()',
+            'x = getattr(__builtins__, "id")(1)',
+            'x = open("/proc/self/stat").read()',
+            'import sys\nx = sys.getrefcount(1)',
+            'from sys import modules\nx = len(modules)',
+            'import builtins\nx = builtins.id(1)',
+            'x = print.__self__.id(1)',
+            'x = globals()["__builtins__"]',
+        ]
+
+        for code in bypasses:
+            self.assertFalse(py_diagrammer.ResultCache.is_cacheable(code), code)
+
+        self.assertTrue(py_diagrammer.ResultCache.is_cacheable('class A:\n\tdef __init__(self):\n\t\tsuper().__init__()\nd = {"id" : A()}'))
+
+    def test_result_cache_eviction(self):
+        code = 'x = [1, 2, 3]'
+        diagram_size = len(json.dumps(py_diagrammer.generate_diagrams_for_code(code, [0])))
+        cache = py_diagrammer.ResultCache(diagram_size * 2)
+
+        for i in range(3):
+            py_diagrammer.generate_diagrams_for_code(code, [0], result_cache=cache, max_depth=10 + i)
+
+        # the oldest result is evicted once the cache is full
+        self.assertEqual(len(cache), 2)
+        self.assertTrue(cache.get_size() <= diagram_size * 2)
+        self.assertEqual(cache.get(py_diagrammer.ResultCache.make_key(code, [0], 'json', {'max_depth' : 10})), None)
+        self.assertNotEqual(cache.get(py_diagrammer.ResultCache.make_key(code, [0], 'json', {'max_depth' : 12})), None)
+
+    def test_result_cache_on_disk(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            code = 'x = {"a" : 1}'
+            diagram_data = py_diagrammer.generate_diagrams_for_code(code, [0], result_cache=py_diagrammer.ResultCache(10 ** 6, cache_dir))
+
+            # a second cache on the same directory (like another worker) starts out with the result
+            other_cache = py_diagrammer.ResultCache(10 ** 6, cache_dir)
+            self.assertEqual(other_cache.get(py_diagrammer.ResultCache.make_key(code, [0], 'json', {})), diagram_data)
+            self.assertEqual(len(other_cache), 1)
+
+            # results too big for memory still go to disk
+            tiny_cache = py_diagrammer.ResultCache(1, cache_dir)
+            py_diagrammer.generate_diagrams_for_code(code, [1], result_cache=tiny_cache)
+            self.assertEqual(len(tiny_cache), 0)
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+
 if __name__ == '__main__':
     vrb = 2
 
@@ -2,11 +2,41 @@ import utils
 utils.setup_pythonpath_for_tests()
 
 from diagrammer.python import engine
+from diagrammer.python import tracing
 
 import unittest
 import types
+import time
 import sys
 import re
+import collections
+import tracemalloc
+
+
+def resolve_bare_language_data(bare_lang_data: list, output_buffers: dict = None) -> list:
+    # inline each snapshot's object table (and the text of its output) so it can be compared as nested bld
+    for index, snapshot in enumerate(bare_lang_data):
+        if output_buffers != None:
+            snapshot = bare_lang_data[index] = engine.resolve_output(snapshot, output_buffers)
+
+        objects = snapshot.pop('objects')
+        snapshot.pop('aliases', None)
+        snapshot['scenes'] = {name : engine.resolve_scene_bld(objects, scene_refs) for name, scene_refs in snapshot['scenes'].items()}
+
+    return bare_lang_data
+
+
+def strip_ids(bare_lang_data: list) -> list:
+    # resolve the snapshots and drop what legitimately differs between capture modes
+    for snapshot in resolve_bare_language_data(bare_lang_data):
+        for scene in snapshot['scenes'].values():
+            for value in scene.values():
+                value.pop('id', None) # variables sharing a value share its bld
+
+                if value['type_str'] == 'function':
+                    value['val'] = '...'
+
+    return bare_lang_data
 
 
 class ModuleProxyTests(unittest.TestCase):
@@ -72,6 +102,7 @@ class PythonEngineTests(unittest.TestCase):
         int_data = {
             'id' : f'{id(int_value)}',
             'type_str' : 'int',
+            'kind' : 'basic',
             'val' : '5'
         }
 
@@ -81,6 +112,7 @@ class PythonEngineTests(unittest.TestCase):
         float_data = {
             'id' : f'{id(float_value)}',
             'type_str' : 'float',
+            'kind' : 'basic',
             'val' : '2.5'
         }
 
@@ -90,6 +122,7 @@ class PythonEngineTests(unittest.TestCase):
         str_data = {
             'id' : f'{id(str_value)}',
             'type_str' : 'str',
+            'kind' : 'basic',
             'val' : "'hello, world'"
         }
 
@@ -99,6 +132,7 @@ class PythonEngineTests(unittest.TestCase):
         bool_data = {
             'id' : f'{id(bool_value)}',
             'type_str' : 'bool',
+            'kind' : 'basic',
             'val' : 'True'
         }
 
@@ -108,6 +142,7 @@ class PythonEngineTests(unittest.TestCase):
         range_data = {
             'id' : f'{id(range_value)}',
             'type_str' : 'range',
+            'kind' : 'basic',
             'val' : 'range(0, 5)'
         }
 
@@ -117,6 +152,7 @@ class PythonEngineTests(unittest.TestCase):
         func_data = {
             'id' : f'{id(func_value)}',
             'type_str' : 'function',
+            'kind' : 'basic',
             'val' : f'{repr(func_value)}',
         }
 
@@ -130,20 +166,24 @@ class PythonEngineTests(unittest.TestCase):
         list_data = {
             'id' : f'{id(list_value)}',
             'type_str' : 'list',
+            'kind' : 'ordered',
             'val' : [
                 {
                     'id' : f'{id(list_value[0])}',
                     'type_str' : 'int',
+                    'kind' : 'basic',
                     'val' : '1'
                 },
                 {
                     'id' : f'{id(list_value[1])}',
                     'type_str' : 'int',
+                    'kind' : 'basic',
                     'val' : '2'
                 },
                 {
                     'id' : f'{id(list_value[2])}',
                     'type_str' : 'int',
+                    'kind' : 'basic',
                     'val' : '3'
                 },
             ]
@@ -155,20 +195,24 @@ class PythonEngineTests(unittest.TestCase):
         tuple_data = {
             'id' : f'{id(tuple_value)}',
             'type_str' : 'tuple',
+            'kind' : 'ordered',
             'val' : [
                 {
                     'id' : f'{id(tuple_value[0])}',
                     'type_str' : 'float',
+                    'kind' : 'basic',
                     'val' : '1.1'
                 },
                 {
                     'id' : f'{id(tuple_value[1])}',
                     'type_str' : 'float',
+                    'kind' : 'basic',
                     'val' : '2.2'
                 },
                 {
                     'id' : f'{id(tuple_value[2])}',
                     'type_str' : 'float',
+                    'kind' : 'basic',
                     'val' : '3.3'
                 },
             ]
@@ -180,10 +224,12 @@ class PythonEngineTests(unittest.TestCase):
         set_data = {
             'id' : f'{id(set_value)}',
             'type_str' : 'set',
+            'kind' : 'unordered',
             'val' : [
                 {
                     'id' : f'{id(element)}',
                     'type_str' : type(element).__name__,
+                    'kind' : 'basic',
                     'val' : repr(element)
                 } for element in set_value
             ]
@@ -198,6 +244,7 @@ class PythonEngineTests(unittest.TestCase):
         list_data = {
             'id' : f'{id(a)}',
             'type_str' : 'list',
+            'kind' : 'ordered',
             'val' : [
                 {
                     'id' : f'{id(a)}',
@@ -215,8 +262,9 @@ class PythonEngineTests(unittest.TestCase):
         dict_data = {
             'id' : f'{id(dict_value)}',
             'type_str' : 'dict',
+            'kind' : 'mapping',
             'val' : {
-                key : {'id' : f'{id(value)}', 'type_str' : type(value).__name__, 'val' : repr(value)} for key, value in dict_value.items()
+                key : {'id' : f'{id(value)}', 'type_str' : type(value).__name__, 'kind' : 'basic', 'val' : repr(value)} for key, value in dict_value.items()
             },
         }
 
@@ -234,12 +282,14 @@ class PythonEngineTests(unittest.TestCase):
         instance_data = {
             'id' : f'{id(instance_value)}',
             'type_str' : type(instance_value).__name__,
+            'kind' : 'object',
             'val' : {
                 'id' : f'{id(instance_value.__dict__)}',
                 'type_str' : 'dict',
+                'kind' : 'mapping',
                 'obj_type' : 'obj',
                 'val' : {
-                    key : {'id' : f'{id(value)}', 'type_str' : type(value).__name__, 'val' : repr(value)} for key, value in instance_value.__dict__.items()
+                    key : {'id' : f'{id(value)}', 'type_str' : type(value).__name__, 'kind' : 'basic', 'val' : repr(value)} for key, value in instance_value.__dict__.items()
                 },
             }
         }
@@ -249,9 +299,11 @@ class PythonEngineTests(unittest.TestCase):
         class_data = {
             'id' : f'{id(Test)}',
             'type_str' : 'type',
+            'kind' : 'class',
             'val' : {
                 'id' : f'{type(instance_value).__name__}->ddict',
                 'type_str' : type(Test.__dict__).__name__,
+                'kind' : 'mapping',
                 'obj_type' : 'class',
                 'val' : {
 
@@ -265,6 +317,323 @@ class PythonEngineTests(unittest.TestCase):
         self.assertEqual(generated_class_data, class_data)
 
 
+    def test_data_generation_collection_subclass(self):
+        class Stack(list):
+            pass
+
+        ordered_dict = collections.OrderedDict(a=1, b=2)
+        stack = Stack([1, 2])
+
+        # both have a __dict__, but they're drawn as the collections they are rather than as empty objects
+        ordered_dict_data = self.engine.generate_data_for_obj(ordered_dict)
+        self.assertEqual(ordered_dict_data['kind'], 'mapping')
+        self.assertEqual(list(ordered_dict_data['val']), ['a', 'b'])
+
+        objects = {}
+        stack_id = self.engine.generate_table_for_obj(stack, objects)
+        self.assertEqual(objects[stack_id]['kind'], 'ordered')
+        self.assertEqual(objects[stack_id]['val'], [f'{id(1)}', f'{id(2)}'])
+        self.assertEqual(objects[stack_id]['mro'], ['Stack', 'list', 'object'])
+
+
+    def test_data_generation_shared_ref(self):
+        shared = [1, 2]
+        outer = [shared, shared, {'k' : shared}]
+
+        # siblings sharing an object both get its full value, only real cycles are cut off
+        outer_data = self.engine.generate_data_for_obj(outer)
+        self.assertEqual(outer_data['val'][0], outer_data['val'][1])
+        self.assertEqual(len(outer_data['val'][1]['val']), 2)
+        self.assertEqual(outer_data['val'][2]['val']['k'], outer_data['val'][0])
+
+    def test_data_generation_dag(self):
+        levels = 40
+        dag = []
+        for _ in range(levels):
+            dag = [dag, dag]
+
+        # each level is walked once and its value reused, instead of once per path (2 ** levels)
+        dag_data = self.engine.generate_data_for_obj(dag)
+        level_data = dag_data
+        for _ in range(levels):
+            self.assertIs(level_data['val'][0]['val'], level_data['val'][1]['val'])
+            level_data = level_data['val'][0]
+        self.assertEqual(level_data['val'], [])
+
+    def test_object_table(self):
+        shared = [1, 2]
+        outer = [shared, shared, {'k' : shared}]
+
+        objects = {}
+        outer_id = self.engine.generate_table_for_obj(outer, objects)
+
+        self.assertEqual(outer_id, f'{id(outer)}')
+        self.assertEqual(objects[outer_id]['val'], [f'{id(shared)}', f'{id(shared)}', f'{id(outer[2])}'])
+        self.assertEqual(objects[outer_id]['refs'], engine.BLDRefs.ELEMENTS)
+        self.assertEqual(objects[f'{id(outer[2])}']['val'], {'k' : f'{id(shared)}'})
+        self.assertEqual(objects[f'{id(outer[2])}']['refs'], engine.BLDRefs.ITEMS)
+
+        # outer, shared, the dict and the two ints, each serialized once
+        self.assertEqual(len(objects), 5)
+
+        # a second root reaching the same objects doesn't add anything
+        self.engine.generate_table_for_obj(shared, objects)
+        self.assertEqual(len(objects), 5)
+
+    def test_object_table_instance(self):
+        class Test:
+            def __init__(self):
+                self.x = 1
+
+        instance_value = Test()
+        objects = {}
+        instance_id = self.engine.generate_table_for_obj(instance_value, objects)
+        ddict_id = f'{id(instance_value.__dict__)}'
+
+        self.assertEqual(objects[instance_id]['val'], ddict_id)
+        self.assertEqual(objects[instance_id]['refs'], engine.BLDRefs.DDICT)
+        self.assertEqual(objects[ddict_id]['obj_type'], 'obj')
+        self.assertEqual(objects[ddict_id]['val'], {'x' : f'{id(instance_value.x)}'})
+
+        class_id = self.engine.generate_table_for_obj(Test, objects)
+        self.assertEqual(objects[class_id]['val'], 'Test->ddict')
+        self.assertEqual(objects['Test->ddict']['obj_type'], 'class')
+
+    def test_resolve_scene_bld(self):
+        a = [1]
+        a.append(a)
+        b = [a, a]
+
+        objects = {}
+        scene_refs = {'a' : self.engine.generate_table_for_obj(a, objects), 'b' : self.engine.generate_table_for_obj(b, objects)}
+        scene_bld = engine.resolve_scene_bld(objects, scene_refs)
+
+        # shared objects and cycles resolve to the same linked bld
+        self.assertIs(scene_bld['b']['val'][0], scene_bld['a'])
+        self.assertIs(scene_bld['b']['val'][1], scene_bld['a'])
+        self.assertIs(scene_bld['a']['val'][1], scene_bld['a'])
+        self.assertEqual(scene_bld['a']['val'][0], {'id' : f'{id(a[0])}', 'type_str' : 'int', 'val' : '1', 'kind' : 'basic'})
+        self.assertNotIn('refs', scene_bld['a'])
+
+    def test_code_execution_shared_table(self):
+        self.engine.run('def f(l):\n\tm = l\n\treturn m\nx = [1, 2]\nf(x)', [1])
+
+        snapshot = self.engine.get_bare_language_data()[0]
+        self.assertEqual(snapshot['scenes']['globals']['x'], snapshot['scenes']['locals']['l'])
+        self.assertEqual(snapshot['scenes']['locals']['l'], snapshot['scenes']['locals']['m'])
+        self.assertEqual(len([obj for obj in snapshot['objects'].values() if obj['type_str'] == 'list']), 1)
+
+    def test_object_table_max_elements(self):
+        list_value = list(range(100))
+        objects = {}
+        list_id = self.engine.generate_table_for_obj(list_value, objects, budget=engine.CaptureBudget(max_elements=5))
+
+        # first and last elements are kept, with the gap recorded in between
+        self.assertEqual(objects[list_id]['val'], [f'{id(list_value[i])}' for i in [0, 1, 2, 98, 99]])
+        self.assertEqual(objects[list_id]['elided'], 95)
+        self.assertEqual(objects[list_id]['elided_at'], 3)
+
+        dict_value = {i : i for i in range(10)}
+        objects = {}
+        dict_id = self.engine.generate_table_for_obj(dict_value, objects, budget=engine.CaptureBudget(max_elements=4))
+
+        self.assertEqual(list(objects[dict_id]['val']), [0, 1, 8, 9])
+        self.assertEqual(objects[dict_id]['elided'], 6)
+        self.assertEqual(objects[dict_id]['elided_at'], 2)
+
+        set_value = set(range(10))
+        objects = {}
+        set_id = self.engine.generate_table_for_obj(set_value, objects, budget=engine.CaptureBudget(max_elements=4))
+
+        self.assertEqual(len(set(objects[set_id]['val'])), 4)
+        self.assertEqual(objects[set_id]['elided'], 6)
+
+        # collections that fit aren't marked
+        objects = {}
+        list_id = self.engine.generate_table_for_obj([1, 2], objects, budget=engine.CaptureBudget(max_elements=5))
+        self.assertNotIn('elided', objects[list_id])
+
+    def test_object_table_max_depth(self):
+        chain = [1]
+
+        for _ in range(10):
+            chain = [chain]
+
+        objects = {}
+        chain_id = self.engine.generate_table_for_obj(chain, objects, budget=engine.CaptureBudget(max_depth=2))
+
+        depth_2 = objects[objects[objects[chain_id]['val'][0]]['val'][0]]
+        depth_3 = objects[depth_2['val'][0]]
+        self.assertNotIn('truncated', depth_2)
+        self.assertEqual(depth_3, {'id' : depth_3['id'], 'type_str' : 'list', 'val' : '...', 'kind' : 'basic', 'truncated' : True})
+        self.assertEqual(len(objects), 4)
+
+        # basic values past the depth limit are still shown
+        objects = {}
+        nested_id = self.engine.generate_table_for_obj([[5]], objects, budget=engine.CaptureBudget(max_depth=1))
+        self.assertEqual(objects[objects[objects[nested_id]['val'][0]]['val'][0]]['val'], '5')
+
+    def test_object_table_max_nodes(self):
+        class Node:
+            def __init__(self, next_node):
+                self.next_node = next_node
+
+        head = None
+
+        for _ in range(1000):
+            head = Node(head)
+
+        objects = {}
+        budget = engine.CaptureBudget(max_nodes=50)
+        self.engine.generate_table_for_obj(head, objects, budget=budget)
+
+        # each node is an object plus its __dict__, which is never cut off on its own
+        self.assertLessEqual(budget.get_nodes_used(), 51)
+        self.assertLess(len(objects), 60)
+
+        truncated = [data for data in objects.values() if data.get('truncated', False)]
+        self.assertEqual(len(truncated), 1)
+        self.assertEqual(truncated[0]['type_str'], 'Node')
+
+        # namespaces that are shown always come with their __dict__
+        for data in objects.values():
+            if data.get('refs') == engine.BLDRefs.DDICT:
+                self.assertEqual(objects[data['val']]['obj_type'], 'obj')
+
+    def test_bounded_repr(self):
+        self.assertEqual(engine.bounded_repr('hello', 10), ("'hello'", {}))
+        self.assertEqual(engine.bounded_repr('a' * 20, 5), ("'aaaaa'...", {'length' : 20}))
+        self.assertEqual(engine.bounded_repr(b'x' * 20, 5), ("b'xxxxx'...", {'length' : 20}))
+        self.assertEqual(engine.bounded_repr(bytearray(20), 2), ("bytearray(b'\\x00\\x00')...", {'length' : 20}))
+        self.assertEqual(engine.bounded_repr(10 ** 9, 10), ('1000000000', {}))
+        self.assertEqual(engine.bounded_repr(2 ** 100, 10), ('<int of 101 bits>', {'bit_length' : 101}))
+        self.assertEqual(engine.bounded_repr(range(10 ** 20), 10), ('range(0, 1...', {}))
+        self.assertEqual(engine.bounded_repr(True, 4), ('True', {}))
+        self.assertEqual(engine.bounded_repr('a' * 20), (repr('a' * 20), {}))
+
+        # ints past the interpreter's digit limit can't be repr'd at all, even without a max length
+        if hasattr(sys, 'set_int_max_str_digits'):
+            self.assertEqual(engine.bounded_repr(10 ** 5000), ('<int of 16610 bits>', {'bit_length' : 16610}))
+
+    def test_object_table_max_repr_length(self):
+        objects = {}
+        large_str = 'a' * 100
+        large_list = [large_str, 7 ** 1000]
+        list_id = self.engine.generate_table_for_obj(large_list, objects, budget=engine.CaptureBudget(max_repr_length=10))
+
+        str_data, int_data = [objects[element_id] for element_id in objects[list_id]['val']]
+        self.assertEqual(str_data['val'], "'aaaaaaaaaa'...")
+        self.assertEqual(str_data['length'], 100)
+        self.assertEqual(int_data['val'], '<int of 2808 bits>')
+        self.assertEqual(int_data['bit_length'], 2808)
+
+    def test_code_execution_max_repr_length(self):
+        self.assertEqual(engine.PyEngineSettings().max_repr_length, engine.PyEngineSettings.MAX_REPR_LENGTH)
+        self.assertIsNone(engine.PyEngineSettings.from_dict({'max_repr_length' : None}).max_repr_length)
+
+        repr_engine = engine.PythonEngine(engine.PyEngineSettings.from_dict({'max_repr_length' : 4}))
+        repr_engine.run('s = "hello, world"\nn = 10 ** 5000', [])
+
+        scene = resolve_bare_language_data(repr_engine.get_bare_language_data(), repr_engine.get_output_buffers())[0]['scenes']['globals']
+        self.assertEqual(scene['s']['val'], "'hell'...")
+        self.assertEqual(scene['n']['val'], '<int of 16610 bits>')
+
+    def test_library_summary(self):
+        import collections, fractions, math
+
+        class Local:
+            pass
+
+        self.assertEqual(self.engine.get_library_summary(math), "<module 'math'>")
+        self.assertEqual(self.engine.get_library_summary(fractions.Fraction), "<class 'fractions.Fraction'>")
+        self.assertEqual(self.engine.get_library_summary(fractions.Fraction(1, 3)), '<fractions.Fraction object>')
+        self.assertEqual(self.engine.get_library_summary(collections.deque()), '<collections.deque object>')
+
+        # builtins and the program's own classes are never summarized
+        for value in [5, 'hello', [1], int, ValueError('x'), Local, Local(), print]:
+            self.assertIsNone(self.engine.get_library_summary(value))
+
+        expanding_engine = engine.PythonEngine(engine.PyEngineSettings.from_dict({'expand_modules' : ['collections']}))
+        self.assertIsNone(expanding_engine.get_library_summary(collections.deque()))
+        self.assertIsNone(expanding_engine.get_library_summary(collections.abc))
+        self.assertEqual(expanding_engine.get_library_summary(math), "<module 'math'>")
+
+    def test_code_execution_imports(self):
+        self.engine.run('import math\nimport fractions\nf = fractions.Fraction(1, 3)\nx = math.pi', [])
+
+        snapshot = self.engine.get_bare_language_data()[0]
+        scene = engine.resolve_scene_bld(snapshot['objects'], snapshot['scenes']['globals'])
+
+        self.assertEqual(scene['math'], {'id' : scene['math']['id'], 'type_str' : 'module', 'val' : "<module 'math'>", 'kind' : 'basic', 'summarized' : True})
+        self.assertEqual(scene['f']['val'], '<fractions.Fraction object>')
+        self.assertEqual(scene['x']['val'], '3.141592653589793')
+
+        # only the variables themselves (and the summaries) end up in the table, none of the modules' contents
+        self.assertEqual(len(snapshot['objects']), 4)
+
+        expanding_engine = engine.PythonEngine(engine.PyEngineSettings(expand_modules=['math']))
+        expanding_engine.run('import math', [])
+
+        snapshot = expanding_engine.get_bare_language_data()[0]
+        math_data = snapshot['objects'][snapshot['scenes']['globals']['math']]
+        self.assertEqual(math_data['refs'], engine.BLDRefs.DDICT)
+        self.assertIn('sqrt', snapshot['objects'][math_data['val']]['val'])
+
+    def test_object_table_max_time(self):
+        objects = {}
+        budget = engine.CaptureBudget(max_time=0)
+        time.sleep(0.001)
+        list_id = self.engine.generate_table_for_obj(list(range(1000)), objects, budget=budget)
+
+        self.assertTrue(objects[list_id]['truncated'])
+        self.assertEqual(len(objects), 1)
+
+    def test_code_execution_budget(self):
+        budget_engine = engine.PythonEngine(engine.PyEngineSettings.from_dict({'max_elements' : 4, 'max_nodes' : 100}))
+        budget_engine.run('big = list(range(100000))', [0])
+
+        snapshot = budget_engine.get_bare_language_data()[0]
+        big = snapshot['objects'][snapshot['scenes']['globals']['big']]
+        self.assertEqual(len(big['val']), 4)
+        self.assertEqual(big['elided'], 99996)
+
+    def test_deep_chain_data_generation(self):
+        # 100k levels is far past the recursion limit, so this only works if the walks don't recurse
+        chain = None
+
+        for _ in range(100000):
+            chain = [chain]
+
+        objects = {}
+        chain_id = self.engine.generate_table_for_obj(chain, objects)
+        self.assertEqual(len(objects), 100001)
+
+        scene_bld = engine.resolve_scene_bld(objects, {'chain' : chain_id})
+        chain_data = self.engine.generate_data_for_obj(chain)
+
+        for data in [scene_bld['chain'], chain_data]:
+            depth = 0
+
+            while data['type_str'] == 'list':
+                data = data['val'][0]
+                depth += 1
+
+            self.assertEqual(depth, 100000)
+            self.assertEqual(data['val'], 'None')
+
+    def test_deep_chain_linear_work(self):
+        def count_walk_calls(length: int) -> int:
+            chain = None
+
+            for _ in range(length):
+                chain = [chain]
+
+            return utils.count_calls(lambda: (self.engine.generate_table_for_obj(chain, {}), self.engine.generate_data_for_obj(chain)))
+
+        # 4x the length should take about 4x the work, well short of the 16x a quadratic walk would need
+        count_walk_calls(100) # warm up
+        self.assertLess(count_walk_calls(4000), count_walk_calls(1000) * 5)
+
     def test_code_execution(self):
         simple_code_snippet = 'x=1\ny=2\nz=3\n'
         simple_code_data = [{
@@ -272,28 +641,34 @@ class PythonEngineTests(unittest.TestCase):
                 'globals' : {
                     'x' : {
                         'type_str' : 'int',
+                        'kind' : 'basic',
                         'val' : '1'
                     },
                     'y' : {
                         'type_str' : 'int',
+                        'kind' : 'basic',
                         'val' : '2'
                     },
                     'z' : {
                         'type_str' : 'int',
+                        'kind' : 'basic',
                         'val' : '3'
                     },
                 },
                 'locals' : {
                     'x' : {
                         'type_str' : 'int',
+                        'kind' : 'basic',
                         'val' : '1'
                     },
                     'y' : {
                         'type_str' : 'int',
+                        'kind' : 'basic',
                         'val' : '2'
                     },
                     'z' : {
                         'type_str' : 'int',
+                        'kind' : 'basic',
                         'val' : '3'
                     },
                 },
@@ -304,7 +679,7 @@ class PythonEngineTests(unittest.TestCase):
 
         self.engine.run(simple_code_snippet, [])
 
-        for dataset in self.engine.get_bare_language_data():
+        for dataset in resolve_bare_language_data(self.engine.get_bare_language_data(), self.engine.get_output_buffers()):
             for var, val in dataset['scenes']['globals'].items():
                 del val['id']
 
@@ -320,20 +695,24 @@ class PythonEngineTests(unittest.TestCase):
                 'globals' : {
                     'x' : {
                         'type_str' : 'int',
+                        'kind' : 'basic',
                         'val' : '1'
                     },
                     'y' : {
                         'type_str' : 'int',
+                        'kind' : 'basic',
                         'val' : '3'
                     },
                 },
                 'locals' : {
                     'x' : {
                         'type_str' : 'int',
+                        'kind' : 'basic',
                         'val' : '1'
                     },
                     'y' : {
                         'type_str' : 'int',
+                        'kind' : 'basic',
                         'val' : '3'
                     },
                 },
@@ -346,20 +725,24 @@ class PythonEngineTests(unittest.TestCase):
                 'globals' : {
                     'x' : {
                         'type_str' : 'int',
+                        'kind' : 'basic',
                         'val' : '1'
                     },
                     'y' : {
                         'type_str' : 'int',
+                        'kind' : 'basic',
                         'val' : '3'
                     },
                 },
                 'locals' : {
                     'x' : {
                         'type_str' : 'int',
+                        'kind' : 'basic',
                         'val' : '1'
                     },
                     'y' : {
                         'type_str' : 'int',
+                        'kind' : 'basic',
                         'val' : '3'
                     },
                 },
@@ -370,7 +753,7 @@ class PythonEngineTests(unittest.TestCase):
 
         self.engine.run(conditional_code_snippet, conditional_code_flags)
 
-        for dataset in self.engine.get_bare_language_data():
+        for dataset in resolve_bare_language_data(self.engine.get_bare_language_data(), self.engine.get_output_buffers()):
             for var, val in dataset['scenes']['globals'].items():
                 del val['id']
 
@@ -386,12 +769,14 @@ class PythonEngineTests(unittest.TestCase):
                 'globals' : {
                     'i' : {
                         'type_str' : 'int',
+                        'kind' : 'basic',
                         'val' : '0'
                     },
                 },
                 'locals' : {
                     'i' : {
                         'type_str' : 'int',
+                        'kind' : 'basic',
                         'val' : '0'
                     },
                 },
@@ -404,12 +789,14 @@ class PythonEngineTests(unittest.TestCase):
                 'globals' : {
                     'i' : {
                         'type_str' : 'int',
+                        'kind' : 'basic',
                         'val' : '1'
                     },
                 },
                 'locals' : {
                     'i' : {
                         'type_str' : 'int',
+                        'kind' : 'basic',
                         'val' : '1'
                     },
                 },
@@ -422,12 +809,14 @@ class PythonEngineTests(unittest.TestCase):
                 'globals' : {
                     'i' : {
                         'type_str' : 'int',
+                        'kind' : 'basic',
                         'val' : '2'
                     },
                 },
                 'locals' : {
                     'i' : {
                         'type_str' : 'int',
+                        'kind' : 'basic',
                         'val' : '2'
                     },
                 },
@@ -440,12 +829,14 @@ class PythonEngineTests(unittest.TestCase):
                 'globals' : {
                     'i' : {
                         'type_str' : 'int',
+                        'kind' : 'basic',
                         'val' : '2'
                     },
                 },
                 'locals' : {
                     'i' : {
                         'type_str' : 'int',
+                        'kind' : 'basic',
                         'val' : '2'
                     },
                 },
@@ -456,7 +847,7 @@ class PythonEngineTests(unittest.TestCase):
 
         self.engine.run(loop_code_snippet, loop_code_flags)
 
-        for dataset in self.engine.get_bare_language_data():
+        for dataset in resolve_bare_language_data(self.engine.get_bare_language_data(), self.engine.get_output_buffers()):
             for var, val in dataset['scenes']['globals'].items():
                 del val['id']
 
@@ -468,37 +859,106 @@ class PythonEngineTests(unittest.TestCase):
     def test_code_execution_blacklisted_value(self):
         code = 'oops = input("this shouldnt work")'
         self.engine.run(code, []) # no flags needed for error
-        self.assertEqual(self.engine.get_bare_language_data()[0]['error'].split(':')[0], "RestrictionError")
+        self.assertEqual(self.engine.get_output_buffers()['error'].getvalue().split(':')[0], "RestrictionError")
 
         code = 'oops = open("illegal.txt")'
         self.engine.run(code, [])
-        self.assertEqual(self.engine.get_bare_language_data()[0]['error'].split(':')[0], "RestrictionError")
+        self.assertEqual(self.engine.get_output_buffers()['error'].getvalue().split(':')[0], "RestrictionError")
 
         code = 'oops = exec("nope nope nope")'
         self.engine.run(code, [])
-        self.assertEqual(self.engine.get_bare_language_data()[0]['error'].split(':')[0], "RestrictionError")
+        self.assertEqual(self.engine.get_output_buffers()['error'].getvalue().split(':')[0], "RestrictionError")
 
         code = 'oops = eval("a = 5")'
         self.engine.run(code, [])
-        self.assertEqual(self.engine.get_bare_language_data()[0]['error'].split(':')[0], "RestrictionError")
+        self.assertEqual(self.engine.get_output_buffers()['error'].getvalue().split(':')[0], "RestrictionError")
 
     def test_output_generation(self):
         self.engine.run('print(5)\nprint("hello, world")\nprint(True)', [2])
 
-        bare_lang_data = self.engine.get_bare_language_data()
-        self.assertEqual(bare_lang_data[0]['output'], '5\nhello, world\nTrue\n')
+        output_buffers = self.engine.get_output_buffers()
+        self.assertEqual(engine.resolve_output(self.engine.get_bare_language_data()[0], output_buffers)['output'], '5\nhello, world\nTrue\n')
 
 
     def test_error_output_generation(self):
         self.engine.run('raise ValueError("hello")', [0])
 
+        output_buffers = self.engine.get_output_buffers()
+        self.assertEqual(engine.resolve_output(self.engine.get_bare_language_data()[0], output_buffers)['error'], 'ValueError: hello\n')
+
+    def test_incremental_output(self):
+        self.engine.run('for i in range(4):\n\tprint(i)', [1])
+
         bare_lang_data = self.engine.get_bare_language_data()
-        self.assertEqual(bare_lang_data[0]['error'], 'ValueError: hello\n')
+        output_buffers = self.engine.get_output_buffers()
+        self.assertEqual([engine.resolve_output(snapshot, output_buffers)['output'] for snapshot in bare_lang_data], ['0\n', '0\n1\n', '0\n1\n2\n', '0\n1\n2\n3\n', '0\n1\n2\n3\n'])
+
+        # snapshots only hold the span of the output they show, which is read back from the run's buffer
+        self.assertEqual([snapshot['output'] for snapshot in bare_lang_data], [(0, 2), (0, 4), (0, 6), (0, 8), (0, 8)])
+
+    def test_output_memory(self):
+        # every line printed is flagged, so copying the output into each snapshot would hold on to about
+        # lines ** 2 / 2 characters, where spans only keep each line once
+        lines = 4000
+        self.engine.run(f'for i in range({lines}):\n\tprint("x" * 20)', [1])
+
+        output_buffer = self.engine.get_output_buffers()['output']
+        self.assertEqual(len(self.engine.get_bare_language_data()), lines + 1)
+        self.assertEqual(output_buffer.get_kept_size(), lines * 21)
+
+        tracemalloc.start()
+
+        try:
+            self.engine.run(f'for i in range({lines}):\n\tprint("x" * 20)', [1])
+            held, _ = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        self.assertLess(held, 20 * 10 ** 6)
+
+    def test_max_output(self):
+        capped_engine = engine.PythonEngine(engine.PyEngineSettings.from_dict({'max_output' : 6}))
+        capped_engine.run('for i in range(3):\n\tprint(i)\n\tprint("-" * 1000)', [1])
+
+        # each snapshot shows the output as it was when it was taken, cut to the cap at that point
+        bare_lang_data = capped_engine.get_bare_language_data()
+        output_buffers = capped_engine.get_output_buffers()
+        self.assertEqual([engine.resolve_output(snapshot, output_buffers)['output'] for snapshot in bare_lang_data], ['0\n', '...\n---\n1\n', '...\n---\n2\n', '...\n-----\n'])
+
+        # and only what some snapshot shows is kept, not everything printed between flags
+        self.assertLessEqual(output_buffers['output'].get_kept_size(), 6 * len(bare_lang_data))
+
+    def test_output_buffer(self):
+        output_buffer = engine.OutputBuffer(max_size=4)
+        self.assertEqual(output_buffer.write('ab'), 2)
+        first = output_buffer.get_span()
+
+        output_buffer.write('cdef')
+        self.assertEqual(output_buffer.tell(), 6)
+        self.assertEqual(output_buffer.getvalue(), '...\ncdef')
+
+        # a span's text is kept after the cap would have pushed it out
+        self.assertEqual(first, (0, 2))
+        self.assertEqual(output_buffer.getvalue(first), 'ab')
+
+        output_buffer.write('g')
+        second = output_buffer.get_span()
+        self.assertEqual(output_buffer.getvalue(second), '...\ndefg')
+        self.assertEqual(output_buffer.get_kept_size(), 6)
+
+        # text no span covers is dropped once it's past the cap
+        output_buffer.write('hijklmn')
+        self.assertEqual(output_buffer.getvalue(output_buffer.get_span()), '...\nklmn')
+        self.assertEqual(output_buffer.getvalue(second), '...\ndefg')
+        self.assertEqual(output_buffer.get_kept_size(), 10)
+
+        with self.assertRaises(TypeError):
+            output_buffer.write(b'bytes')
 
     def test_nonglobal_namespace_code_execution(self):
         self.engine.run('g = 3\ndef f():\n\tx = 1\n\ty=2\nf()', [3])
 
-        bare_lang_data = self.engine.get_bare_language_data()
+        bare_lang_data = resolve_bare_language_data(self.engine.get_bare_language_data(), self.engine.get_output_buffers())
 
         for snapshot in bare_lang_data:
             for scene in snapshot['scenes'].values():
@@ -514,20 +974,24 @@ class PythonEngineTests(unittest.TestCase):
                 'globals' : {
                     'g' : {
                         'type_str' : 'int',
+                        'kind' : 'basic',
                         'val' : '3',
                     },
                     'f' : {
                         'type_str' : 'function',
+                        'kind' : 'basic',
                         'val' : '...',
                     }
                 },
                 'locals' : {
                     'x' : {
                         'type_str' : 'int',
+                        'kind' : 'basic',
                         'val' : '1',
                     },
                     'y' : {
                         'type_str' : 'int',
+                        'kind' : 'basic',
                         'val' : '2',
                     },
                 },
@@ -537,6 +1001,458 @@ class PythonEngineTests(unittest.TestCase):
         })
 
 
+class TypeClassificationTests(unittest.TestCase):
+    def setUp(self):
+        engine.utils.clear_type_cache()
+
+    def test_classification(self):
+        class Point:
+            def __init__(self):
+                self.x = 1
+
+        class Slotted:
+            __slots__ = ('x',)
+
+        class Stack(list):
+            pass
+
+        self.assertEqual(engine.utils.classify(5), (True, None, False))
+        self.assertEqual(engine.utils.classify(print), (True, None, False))
+        self.assertEqual(engine.utils.classify(lambda: 1), (True, None, True))
+        self.assertEqual(engine.utils.classify([1]), (False, (engine.utils.CollectionTypes.LINEAR, engine.utils.CollectionTypes.ORDERED), False))
+        self.assertEqual(engine.utils.classify({1}), (False, (engine.utils.CollectionTypes.LINEAR, engine.utils.CollectionTypes.UNORDERED), False))
+        self.assertEqual(engine.utils.classify({}), (False, (engine.utils.CollectionTypes.MAPPING, engine.utils.CollectionTypes.ORDERED), False))
+        self.assertEqual(engine.utils.classify(Point()), (False, None, True))
+        self.assertEqual(engine.utils.classify(Point), (False, None, True))
+        self.assertEqual(engine.utils.classify(Slotted()), (True, None, False))
+        self.assertEqual(engine.utils.classify(Stack()), (False, (engine.utils.CollectionTypes.LINEAR, engine.utils.CollectionTypes.ORDERED), True))
+
+        # the second object of a type comes from the cache
+        self.assertIn(Point, engine.utils._type_cache)
+        self.assertEqual(engine.utils.classify(Point()), (False, None, True))
+
+    def test_dynamic_attributes_not_cached(self):
+        class Chameleon:
+            def __init__(self, is_list: bool):
+                self.is_list = is_list
+
+            def __getattribute__(self, name: str) -> object:
+                if name == '__class__' and object.__getattribute__(self, 'is_list'):
+                    return list
+
+                return object.__getattribute__(self, name)
+
+        self.assertEqual(engine.utils.classify(Chameleon(True))[1], (engine.utils.CollectionTypes.LINEAR, engine.utils.CollectionTypes.ORDERED))
+        self.assertEqual(engine.utils.classify(Chameleon(False))[1], None)
+        self.assertNotIn(Chameleon, engine.utils._type_cache)
+
+    def test_program_types_evicted_after_run(self):
+        engine.PythonEngine().run('import collections\nclass A:\n\tpass\na = A()\nl = [1]\nd = collections.OrderedDict(a=1)', [4])
+
+        # only the program's own class goes, and the builtin and library ones are kept for the next run
+        self.assertEqual({obj_type.__name__ for obj_type in engine.utils._type_cache} & {'A'}, set())
+        self.assertIn(list, engine.utils._type_cache)
+        self.assertIn(collections.OrderedDict, engine.utils._type_cache)
+        self.assertIn(collections.OrderedDict, engine.utils._mro_cache)
+        self.assertEqual(engine.utils._program_types, set())
+
+
+class CaptureComparisonMixin:
+    # for tests of another capture mode, which should capture the same as rewriting. setUp creates rewrite_engine and
+    # compared_engine
+    def assertSameCapture(self, code: str, flags: [int]):
+        self.rewrite_engine.run(code, flags)
+        self.compared_engine.run(code, flags)
+
+        self.assertEqual(strip_ids(self.compared_engine.get_bare_language_data()), strip_ids(self.rewrite_engine.get_bare_language_data()))
+
+
+class PythonEngineTraceCaptureTests(CaptureComparisonMixin, unittest.TestCase):
+    def setUp(self):
+        self.rewrite_engine = engine.PythonEngine(engine.PyEngineSettings(capture_mode=engine.PyEngineSettings.REWRITE))
+        self.trace_engine = engine.PythonEngine(engine.PyEngineSettings(capture_mode=engine.PyEngineSettings.TRACE))
+        self.ast_engine = engine.PythonEngine(engine.PyEngineSettings(capture_mode=engine.PyEngineSettings.AST))
+        self.compared_engine = self.trace_engine
+
+    def test_trace_matches_rewrite(self):
+        self.assertSameCapture('x=1\ny=2\nz=3\n', [])
+        self.assertSameCapture('if True:\n\tx = 1\nelse:\n\tx = 2\ny = 3', [4])
+        self.assertSameCapture('for i in range(3):\n\tpass', [1])
+        self.assertSameCapture('g = 3\ndef f():\n\tx = 1\n\ty=2\nf()', [3])
+        self.assertSameCapture('print(5)\nprint("hello, world")\nprint(True)', [2])
+        self.assertSameCapture('raise ValueError("hello")', [0])
+        self.assertSameCapture('def f(n):\n\tif n == 0:\n\t\treturn 0\n\tt = f(n - 1) + 1\n\tu = t\n\treturn u\nf(3)', [3])
+
+    def test_trace_multiline_statement(self):
+        self.trace_engine.run('x = [\n\t1,\n\t2,\n]\ny = x', [0])
+
+        bare_lang_data = resolve_bare_language_data(self.trace_engine.get_bare_language_data(), self.trace_engine.get_output_buffers())
+        self.assertEqual(len(bare_lang_data), 2)
+        self.assertEqual(bare_lang_data[0]['scenes']['globals'].keys(), {'x'})
+        self.assertEqual(len(bare_lang_data[0]['scenes']['globals']['x']['val']), 2)
+        self.assertEqual(bare_lang_data[0]['error'], '')
+
+    def test_trace_matches_ast(self):
+        # the rewriting backend can't capture inside multi-line statements, so these are checked against the ast one
+        self.rewrite_engine = self.ast_engine
+        self.assertSameCapture('x = [1,\n     2]\ny = 3', [0, 1])
+        self.assertSameCapture('x = [1,\n     2]\ny = 3', [1])
+        self.assertSameCapture('try:\n\tx = 1 / 0\nexcept ZeroDivisionError:\n\tpass\ny = 2', [1])
+        self.assertSameCapture('def f():\n\traise ValueError\ntry:\n\tx = f()\nexcept ValueError:\n\tpass\ny = 1', [1, 3])
+        self.assertSameCapture('def g():\n\ta = 1\n\tyield a\n\ta = 2\n\tyield a\nfor v in g():\n\tw = v', [2, 4, 6])
+
+    def test_trace_leaves_tracing_state(self):
+        orig_trace = sys.gettrace()
+        self.trace_engine.run('for i in range(3):\n\tpass', [1])
+        self.assertIs(sys.gettrace(), orig_trace)
+
+        self.trace_engine.run('raise ValueError("hello")', [0])
+        self.assertIs(sys.gettrace(), orig_trace)
+
+    def test_invalid_capture_mode(self):
+        with self.assertRaises(ValueError):
+            engine.PythonEngine(engine.PyEngineSettings(capture_mode='nope')).run('x = 1', [])
+
+
+class LineCaptureTests(unittest.TestCase):
+    # every backend should report the same flagged lines in the same order, which is the order the ast backend's
+    # captures run in
+    CAPTURE_CLASSES = [tracing.SettraceCapture] + ([tracing.MonitoringCapture] if hasattr(sys, 'monitoring') else [])
+
+    def assertCapturedLines(self, code: str, flagged_lines: {int}, expected_lines: [int]):
+        for capture_class in LineCaptureTests.CAPTURE_CLASSES:
+            compiled = compile(code, '<string>', 'exec')
+            captured_lines = []
+            capture = capture_class(compiled, flagged_lines, lambda frame, lineno: captured_lines.append(lineno), code)
+            capture.start()
+
+            try:
+                exec(compiled, {})
+            finally:
+                capture.stop()
+
+            self.assertEqual(captured_lines, expected_lines, capture_class.__name__)
+
+    def test_multiline_statement(self):
+        self.assertCapturedLines('x = [1,\n     2]\ny = 3', {1, 2}, [1])
+        self.assertCapturedLines('x = [1,\n     2]\ny = 3', {2}, [2])
+        self.assertCapturedLines('for i in range(2):\n\tx = [i,\n\t     2]', {2}, [2, 2])
+
+    def test_raising_line(self):
+        self.assertCapturedLines('try:\n\tx = 1 / 0\nexcept ZeroDivisionError:\n\tpass\ny = 2', {2, 5}, [5])
+        self.assertCapturedLines('def f():\n\traise ValueError\ntry:\n\tx = f()\nexcept ValueError:\n\tpass\ny = 1', {2, 4}, [])
+
+    def test_generator(self):
+        # a yield only finishes when the generator resumes, after the loop body has used the value
+        self.assertCapturedLines('def g():\n\tyield 1\n\tyield 2\nfor v in g():\n\tw = v', {2, 5}, [5, 2, 5])
+
+
+class PythonEngineAstCaptureTests(CaptureComparisonMixin, unittest.TestCase):
+    def setUp(self):
+        self.rewrite_engine = engine.PythonEngine(engine.PyEngineSettings(capture_mode=engine.PyEngineSettings.REWRITE))
+        self.ast_engine = engine.PythonEngine(engine.PyEngineSettings(capture_mode=engine.PyEngineSettings.AST))
+        self.compared_engine = self.ast_engine
+        engine.PythonEngine.CODE_CACHE.clear()
+
+    def test_ast_matches_rewrite(self):
+        self.assertSameCapture('x=1\ny=2\nz=3\n', [])
+        self.assertSameCapture('if True:\n\tx = 1\nelse:\n\tx = 2\ny = 3', [4])
+        self.assertSameCapture('for i in range(3):\n\tpass', [1])
+        self.assertSameCapture('g = 3\ndef f():\n\tx = 1\n\ty=2\nf()', [3])
+        self.assertSameCapture('print(5)\nprint("hello, world")\nprint(True)', [2])
+        self.assertSameCapture('raise ValueError("hello")', [0])
+
+    def test_rewrite_is_default(self):
+        # AST capture is opt in, callers that don't ask for a mode keep the original rewriting
+        self.assertEqual(engine.PyEngineSettings().capture_mode, engine.PyEngineSettings.REWRITE)
+        self.assertEqual(engine.PyEngineSettings.from_dict({}).capture_mode, engine.PyEngineSettings.REWRITE)
+
+    def test_ast_multiline_statement(self):
+        # any line of a multi-line statement flags the whole statement
+        for flag in [0, 1, 2, 3]:
+            self.ast_engine.run('x = [\n\t1,\n\t2,\n]\ny = x', [flag])
+
+            bare_lang_data = resolve_bare_language_data(self.ast_engine.get_bare_language_data(), self.ast_engine.get_output_buffers())
+            self.assertEqual(len(bare_lang_data), 2)
+            self.assertEqual(bare_lang_data[0]['scenes']['globals'].keys(), {'x'})
+            self.assertEqual(bare_lang_data[0]['error'], '')
+
+    def test_ast_loop_header(self):
+        self.ast_engine.run('for i in range(3):\n\tx = i', [0])
+
+        bare_lang_data = resolve_bare_language_data(self.ast_engine.get_bare_language_data(), self.ast_engine.get_output_buffers())
+        self.assertEqual([snapshot['scenes']['globals']['i']['val'] for snapshot in bare_lang_data], ['0', '1', '2', '2', '2'])
+
+    def test_ast_except_clause(self):
+        self.ast_engine.run('try:\n\traise ValueError\nexcept ValueError:\n\tx = 1', [2])
+
+        bare_lang_data = self.ast_engine.get_bare_language_data()
+        self.assertEqual(len(bare_lang_data), 2)
+        self.assertEqual(bare_lang_data[0]['scenes']['globals'], {})
+        self.assertEqual(bare_lang_data[1]['scenes']['globals'].keys(), {'x'})
+
+    def test_ast_code_cache(self):
+        self.ast_engine.run('for i in range(3):\n\tpass', [1])
+        self.assertEqual(len(engine.PythonEngine.CODE_CACHE), 1)
+
+        cache_key = engine.instrument.CodeCache.make_key(engine.PyEngineSettings.AST, 'for i in range(3):\n\tpass', [1])
+        compiled = engine.PythonEngine.CODE_CACHE.get(cache_key)
+        self.assertIsNotNone(compiled)
+
+        # identical submissions reuse the same code object
+        engine.PythonEngine(engine.PyEngineSettings(capture_mode=engine.PyEngineSettings.AST)).run('for i in range(3):\n\tpass', [1])
+        self.assertEqual(len(engine.PythonEngine.CODE_CACHE), 1)
+        self.assertIs(engine.PythonEngine.CODE_CACHE.get(cache_key), compiled)
+        self.assertEqual(len(self.ast_engine.get_bare_language_data()), 4)
+
+        # different flags are a different submission
+        self.ast_engine.run('for i in range(3):\n\tpass', [0])
+        self.assertEqual(len(engine.PythonEngine.CODE_CACHE), 2)
+
+    def test_code_cache_eviction(self):
+        code_cache = engine.instrument.CodeCache(2)
+        code_cache.put('a', compile('a = 1', '<string>', 'exec'))
+        code_cache.put('b', compile('b = 1', '<string>', 'exec'))
+        code_cache.get('a')
+        code_cache.put('c', compile('c = 1', '<string>', 'exec'))
+
+        self.assertEqual(len(code_cache), 2)
+        self.assertIsNotNone(code_cache.get('a'))
+        self.assertIsNone(code_cache.get('b'))
+        self.assertIsNotNone(code_cache.get('c'))
+
+
+class PythonEngineSamplingTests(unittest.TestCase):
+    LOOP_CODE = 'a = 0\nfor i in range(10):\n\ta = i\nb = 1\nfor j in range(5):\n\tb = j'
+    CAPTURE_MODES = [engine.PyEngineSettings.AST, engine.PyEngineSettings.REWRITE, engine.PyEngineSettings.TRACE]
+
+    def capture_values(self, flags: '[int] or {int : FlagPolicy}', **settings) -> {str : list}:
+        # the values of a and b in each snapshot, for every capture mode
+        values = {}
+
+        for capture_mode in PythonEngineSamplingTests.CAPTURE_MODES:
+            py_engine = engine.PythonEngine(engine.PyEngineSettings.from_dict(dict(capture_mode=capture_mode, **settings)))
+            py_engine.run(PythonEngineSamplingTests.LOOP_CODE, flags)
+
+            values[capture_mode] = []
+
+            for snapshot in resolve_bare_language_data(py_engine.get_bare_language_data(), py_engine.get_output_buffers()):
+                scene = snapshot['scenes']['globals']
+                values[capture_mode].append(tuple(scene[name]['val'] if name in scene else None for name in ['a', 'b']))
+
+        return values
+
+    def assertSampled(self, flags: '[int] or {int : FlagPolicy}', expected: list, **settings):
+        for capture_mode, values in self.capture_values(flags, **settings).items():
+            self.assertEqual(values, expected, capture_mode)
+
+    def test_no_policy(self):
+        self.assertSampled([2, 5], [(str(i), None) for i in range(10)] + [('9', str(j)) for j in range(5)] + [('9', '4')])
+
+    def test_every_nth(self):
+        self.assertSampled([2], [('0', None), ('3', None), ('6', None), ('9', None), ('9', '4')], every_nth=3)
+
+    def test_first_k_last_k(self):
+        self.assertSampled([2], [('0', None), ('1', None), ('9', '4')], first_k=2)
+        self.assertSampled([2], [('7', None), ('8', None), ('9', None), ('9', '4')], last_k=3)
+
+        # the last k are kept in order after the first k, without repeating any
+        self.assertSampled([2], [('0', None), ('1', None), ('8', None), ('9', None), ('9', '4')], first_k=2, last_k=2)
+        self.assertSampled([2], [(str(i), None) for i in range(10)] + [('9', '4')], first_k=6, last_k=6)
+
+    def test_per_flag_policy(self):
+        self.assertSampled({2 : engine.FlagPolicy(every_nth=3), 5 : None}, [('0', None), ('3', None), ('6', None), ('9', None)] + [('9', str(j)) for j in range(5)] + [('9', '4')])
+        self.assertSampled({2 : {'first_k' : 2, 'last_k' : 2}, 5 : {'last_k' : 1}}, [('0', None), ('1', None), ('8', None), ('9', None), ('9', '4'), ('9', '4')])
+
+        # flags without a policy of their own use the settings' policy
+        self.assertSampled({2 : None, 5 : {'first_k' : 1}}, [('8', None), ('9', None), ('9', '0'), ('9', '4')], last_k=2)
+
+    def test_max_snapshots(self):
+        self.assertSampled([2, 5], [('0', None), ('1', None), ('2', None), ('3', None), ('9', '4')], max_snapshots=4)
+        self.assertSampled({2 : {'last_k' : 3}, 5 : None}, [('7', None), ('8', None), ('9', None), ('9', '0'), ('9', '4')], max_snapshots=4)
+
+    def test_streamed_snapshots(self):
+        streamed = []
+        py_engine = engine.PythonEngine(engine.PyEngineSettings.from_dict({'first_k' : 1, 'last_k' : 1}))
+        py_engine.run(PythonEngineSamplingTests.LOOP_CODE, [2], snapshot_callback=streamed.append)
+
+        self.assertEqual([engine.resolve_scene_bld(snapshot['objects'], snapshot['scenes']['globals'])['a']['val'] for snapshot in streamed], ['0', '9', '9'])
+
+    def test_conditional_flags(self):
+        self.assertSampled({2 : 'i == 5'}, [('5', None), ('9', '4')])
+        self.assertSampled({2 : {'condition' : 'a % 2 == 1', 'last_k' : 2}, 5 : 'b > j'}, [('7', None), ('9', None), ('9', '4')])
+
+        # a condition that can't be evaluated isn't met
+        self.assertSampled({2 : 'undefined > 0', 5 : 'j > 2'}, [('9', '3'), ('9', '4'), ('9', '4')])
+
+    def test_conditional_flags_in_function(self):
+        code = 'def f(n):\n\tt = n * 2\n\treturn t\nfor i in range(5):\n\tf(i)'
+
+        for capture_mode in PythonEngineSamplingTests.CAPTURE_MODES:
+            py_engine = engine.PythonEngine(engine.PyEngineSettings(capture_mode=capture_mode))
+            py_engine.run(code, {1 : 't > 4 and i < 4'})
+
+            bare_lang_data = resolve_bare_language_data(py_engine.get_bare_language_data(), py_engine.get_output_buffers())
+            self.assertEqual([snapshot['scenes']['locals']['t']['val'] for snapshot in bare_lang_data[:-1]], ['6'], capture_mode)
+
+    def test_module_scope_aliasing(self):
+        code = 'x = [1, 2]\ndef f(n):\n\tt = n * 2\n\treturn t\nf(x[0])'
+
+        for capture_mode in PythonEngineSamplingTests.CAPTURE_MODES:
+            py_engine = engine.PythonEngine(engine.PyEngineSettings(capture_mode=capture_mode))
+            py_engine.run(code, [0, 2])
+
+            module_snapshot, function_snapshot, final_snapshot = py_engine.get_bare_language_data()
+
+            # globals and locals are the same dict at module level, so they're captured once and marked as aliased
+            for snapshot in [module_snapshot, final_snapshot]:
+                self.assertEqual(snapshot['aliases'], {'locals' : 'globals'}, capture_mode)
+                self.assertTrue(snapshot['scenes']['locals'] is snapshot['scenes']['globals'], capture_mode)
+
+            self.assertFalse('aliases' in function_snapshot, capture_mode)
+            self.assertEqual(function_snapshot['scenes']['locals'].keys(), {'n', 't'}, capture_mode)
+
+    def test_conditional_flag_cache(self):
+        engine.PythonEngine.CODE_CACHE.clear()
+
+        ast_settings = engine.PyEngineSettings(capture_mode=engine.PyEngineSettings.AST)
+        engine.PythonEngine(ast_settings).run(PythonEngineSamplingTests.LOOP_CODE, [2])
+        engine.PythonEngine(ast_settings).run(PythonEngineSamplingTests.LOOP_CODE, {2 : 'i == 5'})
+        engine.PythonEngine(ast_settings).run(PythonEngineSamplingTests.LOOP_CODE, {2 : 'i == 6'})
+
+        # conditions are evaluated by the sampler, so different ones share instrumented code
+        self.assertEqual(len(engine.PythonEngine.CODE_CACHE), 2)
+
+    def test_invalid_condition(self):
+        with self.assertRaises(ValueError):
+            engine.PythonEngine().run('x = 1', {0 : 'x =='})
+
+    def test_flag_policy_from_dict(self):
+        policy = engine.FlagPolicy.from_dict({'every_nth' : 2, 'last_k' : 3})
+        self.assertEqual((policy.every_nth, policy.first_k, policy.last_k, policy.condition), (2, None, 3, None))
+        self.assertEqual(engine.FlagPolicy.from_dict({'condition' : 'x > 1'}).condition, 'x > 1')
+
+        settings = engine.PyEngineSettings.from_dict({'max_snapshots' : 10, 'first_k' : 4})
+        self.assertEqual(settings.max_snapshots, 10)
+        self.assertEqual(settings.flag_policy.first_k, 4)
+
+
+class SnapshotDeltaTests(unittest.TestCase):
+    CODE = 'big = list(range(200))\nl = []\nfor i in range(5):\n\tl.append(i)\ndel big\nx = 1'
+
+    def test_delta_round_trip(self):
+        py_engine = engine.PythonEngine()
+        py_engine.run(SnapshotDeltaTests.CODE, [3, 4])
+        full_data = py_engine.get_bare_language_data()
+
+        encoded = engine.encode_snapshot_deltas(full_data)
+        self.assertTrue(encoded[0] is full_data[0])
+        self.assertTrue(all('objects' not in snapshot for snapshot in encoded[1:]))
+
+        reader = engine.SnapshotReader(encoded)
+        self.assertEqual(len(reader), len(full_data))
+        self.assertEqual(list(reader), full_data)
+
+        # going backwards (or jumping around) materializes the same snapshots
+        self.assertEqual([reader[i] for i in [4, 1, -1, 0]], [full_data[i] for i in [4, 1, -1, 0]])
+
+        with self.assertRaises(IndexError):
+            reader[len(full_data)]
+
+    def test_delta_snapshots(self):
+        for capture_mode in PythonEngineSamplingTests.CAPTURE_MODES:
+            py_engine = engine.PythonEngine(engine.PyEngineSettings(capture_mode=capture_mode, delta_snapshots=True))
+            py_engine.run(SnapshotDeltaTests.CODE, [3, 4])
+
+            bare_lang_data = py_engine.get_bare_language_data()
+            self.assertTrue('objects' in bare_lang_data[0], capture_mode)
+
+            # each append only adds the new element and changes the list (and i)
+            for delta in bare_lang_data[1:5]:
+                self.assertTrue(len(delta['changed_objects']) <= 3, capture_mode)
+                self.assertEqual(delta['removed_objects'], [], capture_mode)
+
+            # deleting big removes it along with all of its elements
+            self.assertTrue(len(bare_lang_data[5]['removed_objects']) > 190, capture_mode)
+
+            snapshots = resolve_bare_language_data(list(engine.SnapshotReader(bare_lang_data)))
+            self.assertEqual([[element['val'] for element in snapshot['scenes']['globals']['l']['val']] for snapshot in snapshots[:5]], [[str(j) for j in range(i + 1)] for i in range(5)], capture_mode)
+            self.assertFalse('big' in snapshots[-1]['scenes']['globals'], capture_mode)
+
+    def test_unchanged_objects_shared(self):
+        py_engine = engine.PythonEngine(engine.PyEngineSettings(delta_snapshots=True))
+        py_engine.run(SnapshotDeltaTests.CODE, [3])
+
+        first, second = list(engine.SnapshotReader(py_engine.get_bare_language_data()))[:2]
+        big_id = first['scenes']['globals']['big']
+        self.assertTrue(first['objects'][big_id] is second['objects'][big_id])
+
+    def test_equal_keys_of_other_types(self):
+        self.assertTrue(engine.bld_equal({'val' : {1 : '2'}, 'refs' : engine.BLDRefs.ITEMS}, {'val' : {1 : '2'}, 'refs' : engine.BLDRefs.ITEMS}))
+        self.assertFalse(engine.bld_equal({'val' : {1 : '2'}}, {'val' : {True : '2'}}))
+        self.assertFalse(engine.bld_equal([1], [1.0]))
+        self.assertFalse(engine.bld_equal({'a' : '1', 'b' : '2'}, {'b' : '2', 'a' : '1'}))
+
+        # 1 == True, but the dict is drawn with a different key so it counts as changed
+        py_engine = engine.PythonEngine(engine.PyEngineSettings(delta_snapshots=True, skip_unchanged=True))
+        py_engine.run('x = "v"\nd = {1 : x}\nd.clear()\nd[True] = x', [1, 3])
+
+        bare_lang_data = py_engine.get_bare_language_data()
+        self.assertTrue('unchanged' not in bare_lang_data[1])
+        self.assertEqual(len(bare_lang_data[1]['changed_objects']), 1)
+
+        snapshots = list(engine.SnapshotReader(bare_lang_data))
+        d_id = snapshots[1]['scenes']['globals']['d']
+        self.assertEqual([type(key) for key in snapshots[0]['objects'][d_id]['val']], [int])
+        self.assertEqual([type(key) for key in snapshots[1]['objects'][d_id]['val']], [bool])
+
+
+class UnchangedSnapshotTests(unittest.TestCase):
+    CODE = 'x = [1]\nprint("a")\nprint("b")\nx.append(2)\nprint("c")'
+
+    def test_skip_unchanged(self):
+        for capture_mode in PythonEngineSamplingTests.CAPTURE_MODES:
+            py_engine = engine.PythonEngine(engine.PyEngineSettings(capture_mode=capture_mode, skip_unchanged=True))
+            py_engine.run(UnchangedSnapshotTests.CODE, [0, 1, 2, 3, 4])
+
+            bare_lang_data = py_engine.get_bare_language_data()
+            self.assertEqual([snapshot.get('unchanged') for snapshot in bare_lang_data], [None, 0, 0, None, 3, 3], capture_mode)
+            self.assertEqual(bare_lang_data[1].keys(), {'unchanged', 'output', 'error'}, capture_mode)
+
+            # unchanged records keep their own output, and are read back as the snapshot they point to
+            snapshots = list(engine.SnapshotReader(bare_lang_data, py_engine.get_output_buffers()))
+            self.assertEqual([snapshot['output'] for snapshot in snapshots], ['', 'a\n', 'a\nb\n', 'a\nb\n', 'a\nb\nc\n', 'a\nb\nc\n'], capture_mode)
+            self.assertEqual(snapshots[2]['scenes'], snapshots[0]['scenes'], capture_mode)
+            self.assertEqual(snapshots[2]['objects'], snapshots[0]['objects'], capture_mode)
+
+    def test_skip_unchanged_with_deltas(self):
+        py_engine = engine.PythonEngine(engine.PyEngineSettings(skip_unchanged=True, delta_snapshots=True))
+        py_engine.run(UnchangedSnapshotTests.CODE, [0, 1, 3])
+
+        bare_lang_data = py_engine.get_bare_language_data()
+        self.assertEqual(bare_lang_data[1], {'unchanged' : 0, 'output' : bare_lang_data[1]['output'], 'error' : bare_lang_data[1]['error']})
+        self.assertTrue('changed_objects' in bare_lang_data[2])
+
+        snapshots = resolve_bare_language_data(list(engine.SnapshotReader(bare_lang_data)))
+        self.assertEqual([[element['val'] for element in snapshot['scenes']['globals']['x']['val']] for snapshot in snapshots], [['1'], ['1'], ['1', '2'], ['1', '2']])
+
+    def test_fingerprint(self):
+        snapshot_data = {'scenes' : {'globals' : {'x' : '1'}}, 'objects' : {'1' : {'type_str' : 'list', 'val' : ['2'], 'refs' : engine.BLDRefs.ELEMENTS}, '2' : {'type_str' : 'int', 'val' : '5'}}}
+        same_data = {'scenes' : {'globals' : {'x' : '1'}}, 'objects' : {'1' : {'type_str' : 'list', 'val' : ['2'], 'refs' : engine.BLDRefs.ELEMENTS}, '2' : {'type_str' : 'int', 'val' : '5'}}}
+        changed_data = {'scenes' : {'globals' : {'x' : '1'}}, 'objects' : {'1' : {'type_str' : 'list', 'val' : ['2'], 'refs' : engine.BLDRefs.ELEMENTS}, '2' : {'type_str' : 'int', 'val' : '6'}}}
+
+        self.assertEqual(engine.fingerprint_snapshot(snapshot_data), engine.fingerprint_snapshot(same_data))
+        self.assertNotEqual(engine.fingerprint_snapshot(snapshot_data), engine.fingerprint_snapshot(changed_data))
+
+    def test_fingerprint_hash_collision(self):
+        # hash(-1) == hash(-2), so the two versions of d hash the same even though they're drawn differently
+        py_engine = engine.PythonEngine(engine.PyEngineSettings(skip_unchanged=True))
+        py_engine.run('v = 0\nd = {-1 : v}\ndel d[-1]\nd[-2] = v', [1, 3])
+
+        bare_lang_data = py_engine.get_bare_language_data()
+        self.assertEqual([snapshot.get('unchanged') for snapshot in bare_lang_data], [None, None, 1])
+
+
 if __name__ == '__main__':
     vrb = 2
 
@@ -329,6 +329,122 @@ class PythonBLDToPyConstructTests(unittest.TestCase):
 
         # TODO: add testing erroneous collections
 
+    def test_elided_collection(self):
+        elided_list_bld = {
+            'id': self._counter.next(),
+            'type_str': 'list',
+            'val': [self._int_bld, self._str_bld, self._float_bld],
+            'elided': 7,
+            'elided_at': 2,
+        }
+
+        elided_list = self._scene.create_value(elided_list_bld)
+
+        # the ellipsis sits where the elements were left out, and later elements keep their real indices
+        self.assertEqual([var.get_header() for var in elided_list.get_contents()], ['0', '1', '+7', '9'])
+        self.assertTrue(type(elided_list.get_contents()[2]) is scene.PyEllipsis)
+        self.assertEqual(elided_list.get_contents()[2].get_content(), '...')
+        self.assertEqual(len(elided_list), 4)
+
+        elided_dict_bld = {
+            'id': self._counter.next(),
+            'type_str': 'dict',
+            'val': {'i': self._int_bld, 's': self._str_bld},
+            'elided': 3,
+            'elided_at': 1,
+        }
+
+        elided_dict = self._scene.create_value(elided_dict_bld)
+        self.assertEqual([var.get_header() for var in elided_dict.get_contents()], ['i', '+3', 's'])
+
+    def test_truncated_value(self):
+        truncated_bld = {'id': self._counter.next(), 'type_str': 'list', 'val': '...', 'truncated': True}
+
+        truncated_value = self._scene.create_value(truncated_bld)
+        self.assertTrue(type(truncated_value) is scene.PyBasicValue)
+        self.assertEqual(truncated_value.get_header(), 'list')
+        self.assertEqual(truncated_value.get_content(), '...')
+
+    def test_bounded_basic_value(self):
+        bounded_str_bld = {'id': self._counter.next(), 'type_str': 'str', 'val': "'aaaa'...", 'length': 5000}
+        bytes_bld = {'id': self._counter.next(), 'type_str': 'bytes', 'val': "b'ab'"}
+        func_bld = {'id': self._counter.next(), 'type_str': 'function', 'val': '<function f at 0x7f0000000000>'}
+
+        bounded_str_value = self._scene.create_value(bounded_str_bld)
+        self.assertEqual(bounded_str_value.get_content(), "'aaaa'...")
+        self.assertEqual(bounded_str_value.get_width(), scene.PyBasicValue.TEXT_MARGIN * 2 + len("'aaaa'...") * scene.PyBasicValue.LETTER_WIDTH)
+
+        bytes_value = self._scene.create_value(bytes_bld)
+        self.assertEqual(bytes_value.get_header(), 'bytes')
+        self.assertEqual(bytes_value.get_content(), "b'ab'")
+
+        # sized from what's shown rather than from the full repr
+        func_value = self._scene.create_value(func_bld)
+        self.assertEqual(func_value.get_content(), '...')
+        self.assertEqual(func_value.get_width(), scene.PyBasicValue.RADIUS * 2)
+
+    def test_summarized_value(self):
+        module_bld = {'id': self._counter.next(), 'type_str': 'module', 'val': "<module 'math'>", 'summarized': True}
+        class_bld = {'id': self._counter.next(), 'type_str': 'type', 'val': "<class 'fractions.Fraction'>", 'summarized': True}
+
+        for summarized_bld in [module_bld, class_bld]:
+            summarized_value = self._scene.create_value(summarized_bld)
+            self.assertTrue(type(summarized_value) is scene.PyBasicValue)
+            self.assertEqual(summarized_value.get_header(), summarized_bld['type_str'])
+            self.assertEqual(summarized_value.get_content(), summarized_bld['val'])
+
+    def test_kind_tags(self):
+        # the engine's kind decides what a value is drawn as, whatever its type_str
+        subclass_bld = {'id' : self._counter.next(), 'type_str' : 'Stack', 'kind' : 'ordered', 'mro' : ['Stack', 'list', 'object'], 'val' : [self._int_bld]}
+        frozenset_bld = {'id' : self._counter.next(), 'type_str' : 'frozenset', 'kind' : 'basic', 'val' : 'frozenset({1})'}
+
+        self.assertTrue(type(self._scene.create_value(subclass_bld)) is scene.PySimpleCollection)
+        self.assertTrue(type(self._scene.create_value(frozenset_bld)) is scene.PyBasicValue)
+
+        # bld without tags falls back to its type_str
+        self.assertEqual([scene.get_bld_kind(bld) for bld in [self._int_bld, self._list_bld, self._set_bld, self._dict_bld, self._obj_bld, self._class_bld]],
+            ['basic', 'ordered', 'unordered', 'mapping', 'object', 'class'])
+
+    def test_value_class_registry(self):
+        deque_bld = {'id' : self._counter.next(), 'type_str' : 'deque', 'kind' : 'ordered', 'val' : [self._int_bld]}
+        array_bld = {'id' : self._counter.next(), 'type_str' : 'array', 'kind' : 'array', 'val' : "array('i', [1])"}
+
+        self.assertTrue(scene.PyScene.get_value_class(deque_bld) is scene.PySimpleCollection)
+        self.assertEqual(scene.PyScene.get_value_class(array_bld), None)
+
+        class PyArray(scene.PyBasicValue):
+            pass
+
+        orig_kind_classes = dict(scene.PyScene.KIND_VALUE_CLASSES)
+        orig_type_str_classes = dict(scene.PyScene.TYPE_STR_VALUE_CLASSES)
+
+        try:
+            # a type_str registration takes priority over the value class for its kind
+            scene.PyScene.register_value_class(scene.PyBasicValue, type_str='deque')
+            scene.PyScene.register_value_class(PyArray, kind='array')
+
+            self.assertTrue(type(self._scene.create_value(deque_bld)) is scene.PyBasicValue)
+            self.assertTrue(type(self._scene.create_value(array_bld)) is PyArray)
+            self.assertTrue(type(self._scene.create_value(self._list_bld)) is scene.PySimpleCollection)
+        finally:
+            scene.PyScene.KIND_VALUE_CLASSES = orig_kind_classes
+            scene.PyScene.TYPE_STR_VALUE_CLASSES = orig_type_str_classes
+            scene.PyScene._value_class_cache.clear()
+
+    def test_elided_scene_positioning(self):
+        self._scene.construct({'l': {
+            'id': self._counter.next(),
+            'type_str': 'list',
+            'val': [self._int_bld, self._float_bld],
+            'elided': 5,
+            'elided_at': 1,
+        }})
+        self._scene.gps()
+
+        for obj in self._scene.get_directory().values():
+            if type(obj) is not scene.PyReference:
+                self.assertTrue(obj.is_positioned())
+
     def test_nested_collection(self):
         # this is created here instead of in __init__ because it's a specific bld, not a general reusable one
         nested_list_bld = {
@@ -364,6 +480,37 @@ class PythonBLDToPyConstructTests(unittest.TestCase):
             ['float', 'bool']
         )
 
+    def create_chain_bld(self, length: int) -> dict:
+        chain_bld = {'id': self._counter.next(), 'type_str': 'NoneType', 'val': 'None'}
+
+        for _ in range(length):
+            chain_bld = {'id': self._counter.next(), 'type_str': 'list', 'val': [chain_bld]}
+
+        return chain_bld
+
+    def test_deep_chain_scene(self):
+        # 100k levels is far past the recursion limit, so this only works if construction and gps don't recurse
+        self._scene.construct({'chain': self.create_chain_bld(100000)})
+        self._scene.gps()
+
+        collections = [obj for obj in self._scene.get_directory().values() if type(obj) is scene.PySimpleCollection]
+        self.assertEqual(len(collections), 100000)
+
+        for obj in self._scene.get_directory().values():
+            if type(obj) is not scene.PyReference:
+                self.assertTrue(obj.is_positioned())
+
+    def test_deep_chain_scene_linear_work(self):
+        def count_scene_calls(length: int) -> int:
+            chain_bld = self.create_chain_bld(length)
+            chain_scene = scene.PyScene(scene.PySceneSettings())
+
+            return utils.count_calls(lambda: (chain_scene.construct({'chain': chain_bld}), chain_scene.gps()))
+
+        # 4x the length should take about 4x the work, well short of the 16x a quadratic walk would need
+        count_scene_calls(100) # warm up
+        self.assertLess(count_scene_calls(4000), count_scene_calls(1000) * 5)
+
     def test_self_ref_collection(self):
         # this is created here instead of in __init__ because it's a specific bld, not a general reusable one
         single_self_ref_bld = {
@@ -501,6 +648,13 @@ class PythonBLDToPyConstructTests(unittest.TestCase):
         self.assertEqual(snap._scenes['globals']._scene_settings.show_class_internal_vars, True)
         self.assertEqual(snap._scenes['locals']._scene_settings.show_class_internal_vars, True)
 
+    def test_aliased_snapshot(self):
+        snap = scene.PySnapshot(self._globals_bld, self._globals_bld, '', '', scene.PySceneSettings())
+        self.assertTrue(snap.get_scene('locals') is snap.get_scene('globals'))
+
+        exported = snap.export()
+        self.assertEqual(exported['scenes']['locals'], exported['scenes']['globals'])
+
 
 if __name__ == '__main__':
     vrb = 2
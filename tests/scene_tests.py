@@ -276,6 +276,64 @@ class DiagrammerSceneTests(unittest.TestCase):
         self.assertEqual(container.get_shape(), basic.Shape.ROUNDED_RECT)
         self.assertTrue(container.get_coll() is coll)
 
+    def test_slotted_shapes(self):
+        # shapes keep their state in slots, so none of them carry a __dict__ around
+        for shape_class in [basic.BasicShape, basic.Square, basic.Circle, basic.RoundedRect, basic.Collection, basic.Container]:
+            self.assertFalse(hasattr(shape_class(), '__dict__'), shape_class.__name__)
+
+        arrow = basic.Arrow(basic.Square(), basic.Square(), basic.ArrowSettings(basic.ArrowSettings.SOLID, basic.ArrowSettings.EDGE, basic.ArrowSettings.EDGE))
+        self.assertFalse(hasattr(arrow, '__dict__'))
+
+        # rounded rects of the same size share their precalculated angles
+        first, second = basic.RoundedRect(), basic.RoundedRect()
+        first.construct(60, 40, 10, '', '')
+        second.construct(60, 40, 10, 'a', 'b')
+        self.assertTrue(first._transition_dangles is second._transition_dangles)
+
+    @unittest.skipIf(basic.numpy == None, 'clipping arrows in a batch needs numpy')
+    def test_batch_clipping(self):
+        shapes = []
+
+        for i in range(12):
+            if i % 3 == 0:
+                shape = basic.Square()
+                shape.construct(50, '', '')
+            elif i % 3 == 1:
+                shape = basic.Circle()
+                shape.construct(25, '', '')
+            else:
+                shape = basic.RoundedRect()
+                shape.construct(80, 50, self.corner_radius, '', '')
+
+            # spread around a ring (a little off round) so the arrows between them leave at every angle
+            shape.set_pos(500 + 300 * math.cos(i * math.pi / 6 + 0.1), 500 - 200 * math.sin(i * math.pi / 6 + 0.1))
+            shapes.append(shape)
+
+        unpositioned = basic.Square()
+        unpositioned.construct(50, '', '')
+
+        all_settings = [basic.ArrowSettings(None, tail_position, head_position) for tail_position in (basic.ArrowSettings.EDGE, basic.ArrowSettings.CENTER) for head_position in (basic.ArrowSettings.EDGE, basic.ArrowSettings.CENTER)]
+        make_arrows = lambda: [basic.Arrow(tail_obj, head_obj, settings) for tail_obj in shapes for head_obj in shapes if tail_obj is not head_obj for settings in all_settings]
+
+        # the batch fills every arrow's cache with the same ends it would have worked out on its own
+        batched = make_arrows()
+        basic.Arrow.clip_all(batched)
+
+        for (arrow, expected) in zip(batched, make_arrows()):
+            for (side, position) in ((basic.Arrow.TAIL, arrow._settings.tail_position), (basic.Arrow.HEAD, arrow._settings.head_position)):
+                if position == basic.ArrowSettings.EDGE:
+                    self.assertEqual(arrow._get_end_pos(side, say_cached = True), 'cached')
+
+            for (pos, expected_pos) in ((arrow.get_tail_pos(), expected.get_tail_pos()), (arrow.get_head_pos(), expected.get_head_pos())):
+                self.assertAlmostEqual(pos[0], expected_pos[0])
+                self.assertAlmostEqual(pos[1], expected_pos[1])
+
+        # arrows to shapes that aren't positioned yet are skipped
+        loose_arrow = basic.Arrow(shapes[0], unpositioned, all_settings[0])
+        basic.Arrow.clip_all([loose_arrow])
+        unpositioned.set_pos(0, 0)
+        self.assertNotEqual(loose_arrow._get_end_pos(basic.Arrow.HEAD, say_cached = True), 'cached')
+
     '''def test_snapshot(self):
         scne0 = basic.Scene([])
         scne1 = basic.Scene([])
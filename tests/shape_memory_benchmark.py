@@ -0,0 +1,73 @@
+import utils
+utils.setup_pythonpath_for_tests()
+
+import os
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+
+
+SHAPES = 20000
+
+# the tree right before the shape hierarchy moved to __slots__, which the current classes are measured against
+BASELINE_REVISION = '3983dec^'
+
+
+def make_shapes(scene: 'module', basic: 'module') -> list:
+    # a variable, the basic value it points to and the arrow between them, like every variable in a scene
+    shapes = []
+
+    for i in range(SHAPES):
+        variable = scene.PyVariable(f'v{i}')
+        value = scene.PyBasicValue()
+        basic.RoundedRect.construct(value, 50, 50, 25, 'int', f'{i}')
+        shapes.extend([variable, value, scene.PyReference(variable, value)])
+
+    return shapes
+
+
+def bytes_per_shape(workspace: str) -> float:
+    # diagrammer is imported from workspace, so each tree gets a process of its own
+    sys.path.insert(0, workspace)
+
+    from diagrammer.python import scene
+    from diagrammer.scene import basic
+
+    tracemalloc.start()
+    start = tracemalloc.take_snapshot()
+
+    shapes = make_shapes(scene, basic)
+    shape_count = len(shapes)
+
+    end = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    # the list holding the shapes isn't part of them
+    allocated = sum(stat.size_diff for stat in end.compare_to(start, 'filename')) - sys.getsizeof(shapes)
+    return allocated / shape_count
+
+
+def measure_tree(workspace: str) -> float:
+    result = subprocess.run([sys.executable, os.path.abspath(__file__), '--measure', workspace], check=True, capture_output=True, text=True)
+    return float(result.stdout)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == '--measure':
+        print(bytes_per_shape(sys.argv[2]))
+        sys.exit(0)
+
+    workspace = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    with tempfile.TemporaryDirectory() as baseline_dir:
+        archive = subprocess.run(['git', 'archive', BASELINE_REVISION, 'diagrammer'], cwd=workspace, check=True, capture_output=True).stdout
+        subprocess.run(['tar', '-x', '-C', baseline_dir], input=archive, check=True)
+        baseline_bytes = measure_tree(baseline_dir)
+
+    slot_bytes = measure_tree(workspace)
+
+    print(f'python {sys.version.split()[0]}, {SHAPES} (variable, basic value, reference) triples')
+    print(f'{f"{BASELINE_REVISION} per shape (bytes)":<40}{baseline_bytes:>10.1f}')
+    print(f'{"__slots__ per shape (bytes)":<40}{slot_bytes:>10.1f}')
+    print(f'{"saved":<40}{(1 - slot_bytes / baseline_bytes) * 100:>9.1f}%')
@@ -4,4 +4,25 @@ def setup_pythonpath_for_tests():
     # Add the Diagrammer workspace directory to PYTHONPATH
     # Run this before importing any Diagrammer code in any test file
     file_segments = __file__.split('/')
-    sys.path.append('/'.join(file_segments[:-2]))
\ No newline at end of file
+    sys.path.append('/'.join(file_segments[:-2]))
+
+def count_calls(func: 'callable()') -> int:
+    # the python and builtin function calls made while running func, a measure of the work it does that (unlike timing
+    # it) doesn't depend on how loaded the machine is
+    calls = 0
+
+    def count(frame: 'frame', event: str, arg: object):
+        nonlocal calls
+
+        if event in ('call', 'c_call'):
+            calls += 1
+
+    orig_profile = sys.getprofile()
+    sys.setprofile(count)
+
+    try:
+        func()
+    finally:
+        sys.setprofile(orig_profile)
+
+    return calls